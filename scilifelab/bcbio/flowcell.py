@@ -2,13 +2,13 @@
 import os
 import sys
 import re
-import yaml
 import json
 import csv
 import glob
 import copy
 from cStringIO import StringIO
 from scilifelab.utils.misc import filtered_walk
+from scilifelab.utils.yaml_io import load_run_info, dump as yaml_dump
 
 ## FIX ME: what should be returned from object functions, and what
 ## should be done behind the scenes?
@@ -16,6 +16,28 @@ from scilifelab.utils.misc import filtered_walk
 ## FIX ME: make generic flowcell object, that then Illumina, MiSeq,
 ## SOLiD subclass from
 
+## Pre-casava file names, <lane>_<date>_<fc>[_nophix]_<barcode>
+RE_LANE_FILE = re.compile('^([0-9]+)_[0-9]+_([A-Za-z0-9]+)(_nophix)?(\.(filter|bc)_metrics|_[12]_fastq.txt)')
+RE_SAMPLE_FILE = re.compile('^([0-9]+)_[0-9]+_([A-Za-z0-9]+)(_nophix)?_([0-9]+|unmatched)')
+
+def parse_file_name(f):
+    """Parse a pre-casava file name.
+
+    :param f: file name
+
+    :returns: tuple (lane, flowcell, barcode), where barcode is None
+      for lane files, or None if the name does not follow the naming
+      scheme
+    """
+    fn = os.path.basename(f)
+    m = RE_LANE_FILE.match(fn)
+    if m:
+        return (m.group(1), m.group(2), None)
+    m = RE_SAMPLE_FILE.match(fn)
+    if m:
+        return (m.group(1), m.group(2), m.group(4))
+    return None
+
 class Flowcell(object):
     """Class for handling (Illumina) run information.
 
@@ -28,7 +50,11 @@ class Flowcell(object):
     _keys = dict(lane = ['lane', 'lane_description', 'flowcell_id', 'lane_analysis', 'genome_build'],
                  mp = ['mp_analysis', 'barcode_id', 'barcode_type', 'sample_prj', 'name', 'sequence', 'files', 'genomes_filter_out', 'mp_description', 'results'])
     keys = _keys['lane'] + _keys['mp']
-    
+    ## Column positions
+    _key_index = dict((k, i) for i, k in enumerate(keys))
+    ## Columns with secondary indexes, mapping value to row positions
+    _indexed_columns = ['lane', 'sample_prj', 'name', 'barcode_id']
+
     ## csv keys
     _csv_keys = ['flowcell_id', 'lane', 'name', 'genome_build', 'sequence', 'sample_prj', 'control', 'recipe', 'operator', 'sample_prj']
 
@@ -48,6 +74,13 @@ class Flowcell(object):
         self.path = None
         self.data = None
         self.i = 0
+        self._index = dict((c, {}) for c in self._indexed_columns)
+        ## Row positions that must be copied before they are modified,
+        ## set for copy-on-write clones
+        self._shared_rows = set()
+        ## Flowcell and row position that shared rows of a subset are
+        ## views of, so that copies are also made in the parent
+        self._parent_rows = {}
         if not infile:
             return
         self.data = self._read(infile)
@@ -129,8 +162,7 @@ class Flowcell(object):
         """Reads runinfo yaml file. Returns self converted to tab"""
         if not os.path.exists(infile):
             return None
-        with open(infile) as fh:
-            runinfo_yaml = yaml.load(fh)
+        runinfo_yaml = load_run_info(infile)
         self.filename = os.path.abspath(infile)
         return self._yaml_to_tab(runinfo_yaml)
     
@@ -138,13 +170,38 @@ class Flowcell(object):
         return self._tab_to_yaml()
 
     def _set_sample_dict(self):
-        i = 0
+        """Set sample dict and secondary column indexes"""
         self.samples = {}
-        for row in self.data:
-            d = dict(zip(self.keys, row))
-            key = "{}_{}".format(d['lane'], d['barcode_id'])
-            self.samples[key] = i
-            i += 1
+        self._index = dict((c, {}) for c in self._indexed_columns)
+        if not self.data:
+            return
+        pos = [(c, self._key_index[c]) for c in self._indexed_columns]
+        lane_i, barcode_i = self._key_index['lane'], self._key_index['barcode_id']
+        for j, row in enumerate(self.data):
+            self.samples["{}_{}".format(row[lane_i], row[barcode_i])] = j
+            for c, i in pos:
+                self._index[c].setdefault(row[i], []).append(j)
+
+    def _rows(self, column, query):
+        """Get positions of rows where column equals query"""
+        if column in self._index:
+            return list(self._index[column].get(query, []))
+        i = self._key_index[column]
+        return [j for j, row in enumerate(self.data) if row[i] == query]
+
+    def _writable_row(self, j):
+        """Get row j for modification, copying it first if it is
+        shared with the flowcell this object was cloned from. For
+        subsets, the copy is made by the parent flowcell so that the
+        modification is seen by the parent."""
+        if j in self._shared_rows:
+            if j in self._parent_rows:
+                parent, k = self._parent_rows.pop(j)
+                self.data[j] = parent._writable_row(k)
+            else:
+                self.data[j] = [copy.copy(x) if isinstance(x, list) else x for x in self.data[j]]
+            self._shared_rows.discard(j)
+        return self.data[j]
             
     def _yaml_to_tab(self, runinfo_yaml):
         """Convert yaml to internal representation"""
@@ -193,43 +250,47 @@ class Flowcell(object):
             yaml_out_final['fc_name'] = self.fc_name
         if self.fc_date:
             yaml_out_final['fc_date'] = self.fc_date
-        return yaml.dump(yaml_out_final)
+        return yaml_dump(yaml_out_final)
     
     def get_sample(self, key):
         return self.data[self.samples[key]]
 
     def get_entry(self, key, label):
-        return self.data[self.samples[key]][self.keys.index(label)]
+        return self.data[self.samples[key]][self._key_index[label]]
 
     def set_entry(self, key, label, value):
-        self.data[self.samples[key]][self.keys.index(label)] = value
+        self._writable_row(self.samples[key])[self._key_index[label]] = value
+        if label in self._index:
+            self._set_sample_dict()
 
     def append_to_entry(self, key, label, value):
-        if not self.data[self.samples[key]][self.keys.index(label)]:
-            self.data[self.samples[key]][self.keys.index(label)] = []
-        self.data[self.samples[key]][self.keys.index(label)].append(value)
+        row = self._writable_row(self.samples[key])
+        i = self._key_index[label]
+        if not row[i]:
+            row[i] = []
+        row[i].append(value)
                 
-    def _column(self, label):
-        i = self.keys.index(label)
-        return [row[i] for row in self.data if not row[i] is None]
+    def _column(self, label, rows=None):
+        i = self._key_index[label]
+        if rows is None:
+            return [row[i] for row in self.data if not row[i] is None]
+        return [self.data[j][i] for j in rows if not self.data[j][i] is None]
 
     def projects(self):
         """List flowcell projects"""
-        return list(set(self._column("sample_prj")))
+        return list(set(k for k in self._index['sample_prj'] if not k is None))
 
     def lanes(self):
         """List flowcell lanes"""
-        return list(set(self._column("lane")))
+        return list(set(k for k in self._index['lane'] if not k is None))
 
     def barcodes(self, lane):
         """List barcodes for a lane"""
-        fc = self.subset("lane", lane)
-        return list(fc._column("barcode_id"))
+        return self._column("barcode_id", self._index['lane'].get(lane, []))
 
     def names(self, lane):
         """List names for a lane"""
-        fc = self.subset("lane", lane)
-        return list(fc._column("name"))
+        return self._column("name", self._index['lane'].get(lane, []))
 
     def barcode_id_to_name(self, lane):
         """Map barcode id to name"""
@@ -239,24 +300,36 @@ class Flowcell(object):
         """Map barcode name to id"""
         return dict(zip(self.names(lane), self.barcodes(lane)))
 
+    def clone(self):
+        """Copy flowcell. Rows are shared with the original until
+        they are modified."""
+        new_fc = copy.copy(self)
+        new_fc.data = list(self.data or [])
+        new_fc.i = 0
+        new_fc._shared_rows = set(range(len(new_fc.data)))
+        new_fc._parent_rows = {}
+        new_fc._set_sample_dict()
+        return new_fc
+
     def fc_with_unique_lanes(self):
         """Transform flowcell to one with unique lane numbers"""
-        new_fc = copy.deepcopy(self)
+        new_fc = self.clone()
         new_fc.filename = self.filename.replace(".yaml", "-unique-lane.yaml")
-        lane_index = new_fc.keys.index("lane")
-        lane = 1
+        lane_index = new_fc._key_index["lane"]
         for j in range(0, len(new_fc.data)):
-            new_fc.data[j][lane_index] = str(lane)
-            lane = lane + 1
+            new_fc._writable_row(j)[lane_index] = str(j + 1)
+        new_fc._set_sample_dict()
         new_fc.unique_lanes = True
         return new_fc
             
     def subset(self, column, query):
-        """Subset runinfo. Returns new flowcell object."""
+        """Subset runinfo. Returns new flowcell object whose rows
+        are views of the rows of this object."""
         pruned_fc = Flowcell()
-        vals = list(self._column(column))
-        i = [j for j in range(0, len(vals)) if vals[j]==query]
-        pruned_fc.data = [self.data[j] for j in i]
+        rows = self._rows(column, query)
+        pruned_fc.data = [self.data[j] for j in rows]
+        pruned_fc._shared_rows = set(k for k, j in enumerate(rows) if j in self._shared_rows)
+        pruned_fc._parent_rows = dict((k, (self, j)) for k, j in enumerate(rows) if j in self._shared_rows)
         pruned_fc.filename = self.filename.replace(".yaml", "-pruned.yaml")
         pruned_fc._set_sample_dict()
         pruned_fc.lane_files = dict((x, self.lane_files[x]) for x in pruned_fc.lanes())
@@ -332,50 +405,63 @@ class Flowcell(object):
     # 1_120829_AA001AAAXX_nophix_1-sort-dup.hs_metrics
     # 1_120829_AA001AAAXX_nophix_1-sort-dup.insert_metrics
     # 1_120829_AA001AAAXX_nophix_1-sort.bam
-    def classify_file(self, f):
+    def classify_file(self, f, parsed=None):
         """Classify file by lane and sample.
 
         FIXME: does not work with casava folder and sample naming structure
+
+        :param f: file name
+        :param parsed: result of parse_file_name, if already parsed
         """
-        re_lane = re.compile('^([0-9]+)_[0-9]+_[A-Za-z0-9]+(_nophix)?\.(filter|bc)_metrics|^([0-9]+)_[0-9]+_[A-Za-z0-9]+(_nophix)?_[12]_fastq.txt')
-        m_lane = re_lane.search(os.path.basename(f))
-        if m_lane:
-            lane = os.path.basename(f).split("_")[0]
-            sample = None
-            self.lane_files[lane].append(os.path.abspath(f))
+        if parsed is None:
+            parsed = parse_file_name(f)
+        if parsed is None:
             return
-        re_sample = re.compile('^([0-9]+)_[0-9]+_[A-Za-z0-9]+(_nophix)?_([0-9]+|unmatched).*')
-        m_sample = re_sample.search(os.path.basename(f))
-        if m_sample:
-            lane = m_sample.group(1)
-            sample = m_sample.group(3)
-            key = "{}_{}".format(lane, sample)
-            if sample == "unmatched":
-                self.lane_files[lane].append(os.path.abspath(f))
-                return
-            if f.find("fastq.txt") > 0:
-                self.append_to_entry(key, "files", os.path.abspath(f))
-            else:
-                self.append_to_entry(key, "results", os.path.abspath(f))
+        (lane, fc_id, sample) = parsed
+        if sample is None or sample == "unmatched":
+            self.lane_files.setdefault(lane, []).append(os.path.abspath(f))
+            return
+        key = "{}_{}".format(lane, sample)
+        if f.find("fastq.txt") > 0:
+            self.append_to_entry(key, "files", os.path.abspath(f))
         else:
-            return 
-        return
+            self.append_to_entry(key, "results", os.path.abspath(f))
+
+    def _file_flowcells(self):
+        """Map lane to the flowcell ids that may occur in file names.
+        The file names may have one extra leading character, e.g.
+        AA001AAAXX for flowcell_id A001AAAXX."""
+        lane_i, fc_i = self._key_index['lane'], self._key_index['flowcell_id']
+        fc_ids = {}
+        for row in self.data:
+            fc_ids.setdefault(str(row[lane_i]), set()).add(str(row[fc_i]))
+        return fc_ids
 
     def collect_files(self, path, project=None):
-        """Collect files for a given project.
+        """Collect files for a given project. Files are parsed once
+        and assigned to lanes and samples of the flowcell, or of the
+        project subset, by lane and barcode.
 
         FIXME: does not work entirely for casava-like folder structure"""
         if project:
             fc = self.subset("sample_prj", project)
         else:
             fc = self
-        pattern = "|".join(fc.glob_pfx_str())
+        fc_ids = fc._file_flowcells()
+        parsed_files = {}
         def file_filter(f):
-            if not pattern:
-                return
-            return re.search(pattern, f) != None
+            parsed = parse_file_name(f)
+            if parsed is None:
+                return False
+            (lane, fc_id, sample) = parsed
+            if not (fc_id in fc_ids.get(lane, ()) or fc_id[1:] in fc_ids.get(lane, ())):
+                return False
+            if not (sample is None or sample == "unmatched" or "{}_{}".format(lane, sample) in fc.samples):
+                return False
+            parsed_files[f] = parsed
+            return True
         flist = filtered_walk(path, file_filter)
         for f in flist:
-            self.classify_file(f)
+            self.classify_file(f, parsed_files[os.path.basename(f)])
         fc.path = path
         return fc
@@ -2,7 +2,6 @@
 import os
 import sys
 import re
-import yaml
 import xml.parsers.expat
 import hashlib
 import time
@@ -10,19 +9,38 @@ from uuid import uuid4
 import glob
 import json
 import fnmatch
+import zlib
+import base64
+import warnings
 import numpy as np
 import csv
 from collections import defaultdict
 from itertools import izip
 
-from bs4 import BeautifulSoup
+from HTMLParser import HTMLParser
+from htmlentitydefs import name2codepoint
 
 from cement.core import backend
 LOG = backend.minimal_logger("bcbio")
 
+from scilifelab.db import encode_attachment, attachment_name
+from scilifelab.utils.yaml_io import load_run_info
+
 from bcbio.broad.metrics import *
 from bcbio.pipeline.qcsummary import FastQCParser
 
+## Patterns for classifying run metrics files by kind, lane and
+## barcode id. Files are named <lane>_<date>_<fc>[_nophix]_<barcode_id>...
+## (pre-casava) or <lane>_<date>_<fc>_<barcode_id>[_nophix]... (casava)
+FILE_KIND_RE = [
+    ("picard", re.compile("^(?P<lane>[0-9]+)_[0-9]+_[0-9A-Za-z]+(?:_nophix)?_(?P<barcode_id>[0-9A-Za-z]+)(?:_nophix)?-.*\.(?:align|hs|insert|dup)_metrics$")),
+    ("fastq_screen", re.compile("^(?P<lane>[0-9]+)_[0-9]+_[0-9A-Za-z]+(?:_nophix)?_(?P<barcode_id>[0-9A-Za-z]+)(?:_nophix)?_[12]_fastq_screen\.txt$")),
+    ("filter_metrics", re.compile("^(?P<lane>[0-9]+)_[0-9]+_[0-9A-Za-z]+(?:_(?P<barcode_id>[0-9A-Za-z]+))?(?:_nophix)?.filter_metrics$")),
+    ("bc_metrics", re.compile("^(?P<lane>[0-9]+)_[0-9]+_[0-9A-Za-z]+(?:_nophix)?[\._]bc[\._]metrics$")),
+    ]
+## FastQC output is stored in per-sample directories below fastqc/
+FASTQC_RE = re.compile("fastqc/(?P<lane>[0-9]+)_[0-9]+_[0-9A-Za-z]+(?:_nophix)?_(?P<barcode_id>[0-9A-Za-z]+)")
+
 class MetricsParser():
     """Basic class for parsing metrics"""
     def __init__(self, log=None):
@@ -63,11 +81,57 @@ class MetricsParser():
         return data
 
 
+def _picard_value(val):
+    """Convert a picard metrics value to int or float. Empty and
+    non-finite values are converted to None, other strings are kept."""
+    try:
+        return int(val)
+    except ValueError:
+        pass
+    try:
+        val = float(val)
+    except ValueError:
+        return val if val != "" else None
+    return val if np.isfinite(val) else None
+
+def encode_picard_metrics(metrics):
+    """Encode typed picard metrics for upload, converting histogram
+    arrays to lists of numbers.
+
+    :param metrics: dict as returned by ExtendedPicardMetricsParser.extract_metrics
+
+    :returns: json serializable dict
+    """
+    if isinstance(metrics, np.ndarray):
+        if metrics.dtype.kind == "f":
+            return [None if not np.isfinite(x) else x for x in metrics.tolist()]
+        return metrics.tolist()
+    if isinstance(metrics, dict):
+        return {k:encode_picard_metrics(v) for k, v in metrics.items()}
+    return metrics
+
+def picard_histogram(hist):
+    """Get a picard histogram, e.g. DUP_hist or INS_hist of a sample
+    document, as a dict of numpy arrays.
+
+    :param hist: histogram dict of column name to values
+
+    :returns: dict of column name to numpy array
+    """
+    if hist is None:
+        return None
+    return {k:np.array([np.nan if x is None else x for x in v]) for k, v in hist.items()}
+
 class ExtendedPicardMetricsParser(PicardMetricsParser):
-    """Extend basic functionality and parse all picard metrics"""
+    """Extend basic functionality and parse all picard metrics
 
-    def __init__(self):
+    :param typed: convert metrics to int/float values and histograms
+      to numpy arrays; otherwise all values are kept as strings
+    """
+
+    def __init__(self, typed=False):
         PicardMetricsParser.__init__(self)
+        self.typed = typed
 
     def _get_command(self, in_handle):
         analysis = None
@@ -85,17 +149,17 @@ class ExtendedPicardMetricsParser(PicardMetricsParser):
         return in_handle.readline().rstrip("\n").split("\t")
 
     def _read_vals_of_interest(self, want, header, info):
-        want_indexes = [header.index(w) for w in header]
-        vals = dict()
-        for i in want_indexes:
-            vals[header[i]] = info[i]
-        return vals
+        want = set(want)
+        if self.typed:
+            return {k:_picard_value(v) for k, v in izip(header, info) if k in want}
+        return {k:v for k, v in izip(header, info) if k in want}
 
     def _parse_align_metrics(self, in_handle):
         command = self._get_command(in_handle)
         header = self._read_off_header(in_handle)
-        d = dict([[x, []] for x in header])
-        res = dict(command=command, FIRST_OF_PAIR = d, SECOND_OF_PAIR = d, PAIR = d)
+        res = dict(command=command)
+        for category in ["FIRST_OF_PAIR", "SECOND_OF_PAIR", "PAIR"]:
+            res[category] = dict([[x, []] for x in header])
         while 1:
             info = in_handle.readline().rstrip("\n").split("\t")
             category = info[0]
@@ -132,14 +196,26 @@ class ExtendedPicardMetricsParser(PicardMetricsParser):
         labels = self._read_to_histogram(in_handle)
         if labels is None:
             return None
-        vals = dict([[x, []] for x in labels])
+        rows = []
         while 1:
             line = in_handle.readline()
             info = line.rstrip("\n").split("\t")
             if len(info) < len(labels):
                 break
-            for i in range(0, len(labels)):
-                vals[labels[i]].append(info[i])
+            rows.append(info[0:len(labels)])
+        if not self.typed:
+            return {x:[row[i] for row in rows] for i, x in enumerate(labels)}
+        ## Convert columns in one go, as ints if possible
+        data = np.array(rows, dtype=str).reshape(len(rows), len(labels))
+        vals = {}
+        for i, x in enumerate(labels):
+            try:
+                vals[x] = data[:,i].astype(np.int64)
+            except ValueError:
+                try:
+                    vals[x] = data[:,i].astype(float)
+                except ValueError:
+                    vals[x] = [_picard_value(v) for v in data[:,i]]
         return vals
 
     def _read_to_histogram(self, in_handle):
@@ -190,6 +266,103 @@ class RunInfoParser():
         p.ParseFile(fp)
 
 
+class RTAChart(object):
+    """Full RTA chart metric, e.g. ErrorRate, stored as a float32 array
+    of shape (lanes, tiles, cycles) with NaN for missing values.
+
+    :param data: array of shape (lanes, tiles, cycles)
+    :param cycles: chart index (cycle) of each position along the cycle axis
+    :param header: FlowCellData and Layout attributes of the chart files
+    """
+    def __init__(self, data, cycles, header=None):
+        self.data = data
+        self.cycles = cycles
+        self.header = header or {}
+
+    @classmethod
+    def from_files(cls, files):
+        """Stream chart xml files, one per cycle, into an RTAChart.
+
+        :param files: chart files named Chart_<cycle>.xml
+
+        :returns: RTAChart, or None if there are no files
+        """
+        if len(files) == 0:
+            return None
+        def _cycle(f):
+            c = os.path.basename(f).replace("Chart_", "").replace(".xml", "")
+            return int(c) if c.isdigit() else c
+        files = sorted(files, key=_cycle)
+        chart = cls(None, [_cycle(f) for f in files])
+        state = {}
+        def start_element(name, attrs):
+            if name == "FlowCellData":
+                chart.header.update(attrs)
+            elif name == "Layout" and chart.data is None:
+                chart.header.update(attrs)
+                n_tiles = int(attrs['RowsPerLane']) * int(attrs['ColsPerLane'])
+                chart.data = np.empty((int(attrs['NumLanes']), n_tiles, len(files)), dtype=np.float32)
+                chart.data.fill(np.nan)
+            elif name == "TL":
+                lane, tile = attrs["Key"].split("_")
+                for k, v in attrs.items():
+                    if k != "Key":
+                        chart.data[int(lane) - 1, int(tile) - 1, state["cycle"]] = float(v)
+        for i, f in enumerate(files):
+            state["cycle"] = i
+            p = xml.parsers.expat.ParserCreate()
+            p.StartElementHandler = start_element
+            with open(f) as fp:
+                p.ParseFile(fp)
+        return chart
+
+    def _nanmean(self, axis):
+        ## Silence warnings for all-NaN slices, which become NaN
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            return np.nanmean(self.data, axis=axis)
+
+    def lane_mean(self):
+        """Mean value per lane"""
+        return self._nanmean((1, 2))
+
+    def lane_cycle_mean(self):
+        """Mean value per lane and cycle, shape (lanes, cycles)"""
+        return self._nanmean(1)
+
+    def tile_mean(self):
+        """Mean value per lane and tile, shape (lanes, tiles)"""
+        return self._nanmean(2)
+
+    def tile_outliers(self, cutoff=3.5):
+        """Find tiles whose mean deviates from the other tiles of the
+        lane, using the median absolute deviation.
+
+        :param cutoff: robust z-score cutoff
+
+        :returns: list of (lane, tile) tuples, numbered from 1
+        """
+        tile_mean = self.tile_mean()
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            median = np.nanmedian(tile_mean, axis=1)[:, np.newaxis]
+            mad = 1.4826 * np.nanmedian(np.abs(tile_mean - median), axis=1)[:, np.newaxis]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                z = np.abs(tile_mean - median) / mad
+            outliers = np.argwhere(z > cutoff)
+        return [(int(lane) + 1, int(tile) + 1) for lane, tile in outliers]
+
+    def to_dict(self):
+        """Compact json serializable representation"""
+        return {"shape" : list(self.data.shape), "cycles" : self.cycles, "header" : dict(self.header),
+                "dtype" : "float32", "data" : base64.b64encode(zlib.compress(self.data.tobytes()))}
+
+    @classmethod
+    def from_dict(cls, d):
+        """Create RTAChart from representation returned by to_dict"""
+        data = np.frombuffer(zlib.decompress(base64.b64decode(d["data"])), dtype=d["dtype"]).reshape(d["shape"])
+        return cls(data.copy(), d["cycles"], d.get("header"))
+
 class IlluminaXMLParser():
     """Illumina xml data parser. Parses xml files in flowcell directory."""
     def __init__(self):
@@ -286,9 +459,21 @@ class IlluminaXMLParser():
             fp.close()
 
     ## Caution: no assert statements for file existence
-    def parse(self, files, fullRTA=False):
-        """Full parsing includes all RTA files"""
-        if fullRTA:
+    def parse(self, files, fullRTA=False, dense=True):
+        """Full parsing includes all RTA files.
+
+        :param files: xml files
+        :param fullRTA: parse per tile and cycle charts
+        :param dense: store the ErrorRate, FWHM, Intensity and NumGT30
+          charts as RTAChart dicts (see RTAChart.to_dict) instead of
+          nested dicts keyed by lane_tile and cycle
+        """
+        if fullRTA and dense:
+            for chart in ["ErrorRate", "FWHM", "Intensity", "NumGT30"]:
+                chart_files = filter(lambda x: os.path.dirname(x).endswith(chart) and os.path.basename(x).startswith("Chart_"), files)
+                rtachart = RTAChart.from_files(chart_files)
+                self._data[chart] = rtachart.to_dict() if rtachart else None
+        elif fullRTA:
             error_files = filter(lambda x: os.path.dirname(x).endswith("ErrorRate"), files)
             self._parse_charts(error_files)
             self._data["ErrorRate"] = self._tmp
@@ -305,6 +490,7 @@ class IlluminaXMLParser():
             self._parse_charts(numgt30_files)
             self._data["NumGT30"] = self._tmp
             self._tmp = None
+        if fullRTA:
             chart_files = filter(lambda x: os.path.basename(x).endswith("_Chart.xml"), files)
             self._parse_charts(chart_files)
             self._data["Charts"] = self._tmp
@@ -322,31 +508,346 @@ class IlluminaXMLParser():
 
         return self._data
 
+class HTMLTableParser(HTMLParser):
+    """Extract all tables of an html document in a single pass.
+
+    After feeding a document, tables holds one list of rows per table,
+    in document order. Each row is a list of (tag, value) tuples where
+    tag is 'th' or 'td' and value is the cell string. As with str() of
+    BeautifulSoup's .string, cells with mixed content, e.g.
+    <th>Sample<p></p>ID</th>, and empty cells get the value 'None'.
+    """
+    void_tags = set(["area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "wbr"])
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.tables = []
+        self._open_tables = []
+        self._row = None
+        self._cell = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "table":
+            self._end_cell()
+            self.tables.append([])
+            self._open_tables.append(self.tables[-1])
+        elif tag == "tr" and self._open_tables:
+            self._end_cell()
+            self._row = []
+            self._open_tables[-1].append(self._row)
+        elif tag in ("td", "th") and self._row is not None:
+            self._end_cell()
+            ## Stack of open elements in the cell, each a list of children
+            self._cell = (tag, [[]])
+        elif self._cell is not None:
+            element = []
+            self._cell[1][-1].append(element)
+            if tag not in self.void_tags:
+                self._cell[1].append(element)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in self.void_tags:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag == "table":
+            self._end_cell()
+            self._row = None
+            if self._open_tables:
+                self._open_tables.pop()
+        elif tag == "tr":
+            self._end_cell()
+            self._row = None
+        elif tag in ("td", "th"):
+            self._end_cell()
+        elif self._cell is not None and len(self._cell[1]) > 1:
+            self._cell[1].pop()
+
+    def _string(self, children):
+        if len(children) != 1:
+            return None
+        if isinstance(children[0], list):
+            return self._string(children[0])
+        return children[0]
+
+    def _end_cell(self):
+        if self._cell is None:
+            return
+        tag, stack = self._cell
+        self._row.append((tag, str(self._string(stack[0]))))
+        self._cell = None
+
+    def handle_data(self, data):
+        if self._cell is None:
+            return
+        children = self._cell[1][-1]
+        ## Adjacent strings, e.g. text and entities, form one string
+        if children and isinstance(children[-1], str):
+            children[-1] += data
+        else:
+            children.append(data)
+
+    def handle_entityref(self, name):
+        if name in name2codepoint:
+            self.handle_data(unichr(name2codepoint[name]).encode("utf-8"))
+        else:
+            self.handle_data("&{}".format(name))
+
+    def handle_charref(self, name):
+        if name.lower().startswith("x"):
+            self.handle_data(unichr(int(name[1:], 16)).encode("utf-8"))
+        else:
+            self.handle_data(unichr(int(name)).encode("utf-8"))
+
+    def close(self):
+        HTMLParser.close(self)
+        self._end_cell()
+
+def parse_html_tables(htm_doc):
+    """Parse the tables of an html document.
+
+    :param htm_doc: html document
+
+    :returns: list of tables, see HTMLTableParser
+    """
+    parser = HTMLTableParser()
+    parser.feed(htm_doc)
+    parser.close()
+    return parser.tables
+
+## FastQC modules stored in sample run metrics
+FASTQC_MODULES = ["Per base sequence quality", "Basic Statistics", "Per sequence quality scores",
+                  "Per base sequence content", "Per base GC content", "Per sequence GC content",
+                  "Per base N content", "Sequence Length Distribution", "Sequence Duplication Levels",
+                  "Overrepresented sequences", "Kmer Content"]
+
+def _fastqc_column(values):
+    """Convert a column of FastQC values to an int or float array,
+    or keep it as a list of strings if it is not numeric"""
+    for dtype in [np.int64, np.float64]:
+        try:
+            return np.array(values, dtype=dtype)
+        except ValueError:
+            pass
+    return values
+
+class FastQCData(object):
+    """Modules of a fastqc_data.txt file, read in a single pass.
+
+    Each module is a header line, possibly preceded by '#key\tvalue'
+    lines, followed by tab separated rows.
+
+    :param fh: file handle
+    """
+    def __init__(self, fh):
+        self.version = None
+        ## pass/warn/fail flag of each module
+        self.status = {}
+        self._modules = []
+        self._lines = {}
+        module = None
+        for line in fh:
+            line = line.rstrip("\r\n")
+            if line.startswith(">>END_MODULE"):
+                module = None
+            elif line.startswith(">>"):
+                vals = line[2:].split("\t")
+                module = vals[0]
+                self.status[module] = vals[1] if len(vals) > 1 else None
+                self._modules.append(module)
+                self._lines[module] = []
+            elif module is not None:
+                self._lines[module].append(line)
+            elif line.startswith("##FastQC"):
+                self.version = line.split("\t")[-1]
+
+    @classmethod
+    def from_file(cls, fn):
+        """Read a fastqc_data.txt file"""
+        with open(fn) as fh:
+            return cls(fh)
+
+    def modules(self):
+        """Get the module names in file order"""
+        return self._modules
+
+    def columns(self, module):
+        """Get the columns of a module. Numeric columns are numpy
+        arrays, text columns lists of strings. Values of '#key\tvalue'
+        lines preceding the header are included as scalars.
+
+        :param module: module name
+
+        :returns: dict of column name to values; empty if module is missing
+        """
+        lines = self._lines.get(module, [])
+        i = 0
+        while i < len(lines) and lines[i].startswith("#"):
+            i += 1
+        if i == 0:
+            return {}
+        d = {}
+        for line in lines[0:i-1]:
+            vals = line.lstrip("#").split("\t")
+            d[vals[0]] = _picard_value(vals[1]) if len(vals) > 1 else None
+        header = lines[i-1].lstrip("#").rstrip("\t").split("\t")
+        rows = [line.split("\t") for line in lines[i:]]
+        for j in range(0, len(header)):
+            d[header[j]] = _fastqc_column([row[j] for row in rows])
+        return d
+
+    def strings(self, module):
+        """Get the columns of a module as lists of strings, as stored by
+        previous versions. The first line of the module is taken as
+        the header.
+
+        :param module: module name
+
+        :returns: dict of column name to list of strings; empty if module is missing
+        """
+        lines = self._lines.get(module, [])
+        if len(lines) == 0:
+            return {}
+        header = [x.strip("#") for x in lines[0].rstrip("\t").split("\t")]
+        rows = [line.split("\t") for line in lines[1:]]
+        return {header[j]:[row[j] for row in rows] for j in range(0, len(header))}
+
 class ExtendedFastQCParser(FastQCParser):
     def __init__(self, base_dir):
         FastQCParser.__init__(self, base_dir)
 
-    def get_fastqc_summary(self):
-        metric_labels = ["Per base sequence quality", "Basic Statistics", "Per sequence quality scores",
-                         "Per base sequence content", "Per base GC content", "Per sequence GC content",
-                         "Per base N content", "Sequence Length Distribution", "Sequence Duplication Levels",
-                         "Overrepresented sequences", "Kmer Content"]
-        metrics = {x : self._to_dict(self._fastqc_data_section(x)) for x in metric_labels}
-        return metrics
+    def get_fastqc_summary(self, typed=False):
+        """Get the metrics of the FastQC modules in FASTQC_MODULES.
+
+        :param typed: return numeric columns as numpy arrays
+
+        :returns: dict of module name to columns
+        """
+        data = self.get_fastqc_data()
+        if data is None:
+            data = FastQCData([])
+        if typed:
+            return {x : data.columns(x) for x in FASTQC_MODULES}
+        return {x : data.strings(x) for x in FASTQC_MODULES}
+
+    def get_fastqc_data(self):
+        """Read fastqc_data.txt.
+
+        :returns: FastQCData object, or None if there is no such file
+        """
+        data_file = os.path.join(self._dir, "fastqc_data.txt")
+        if not os.path.exists(data_file):
+            return None
+        return FastQCData.from_file(data_file)
+def parse_demultiplex_stats(htm_doc, log=None):
+    """Get barcode lane statistics and sample information from a
+    Demultiplex_Stats.htm document generated by CASAVA.
+
+    :param htm_doc: html document
+    :param log: logger
+
+    :returns: dict with Barcode_lane_statistics and Sample_information rows
+    """
+    log = log or LOG
+    tables = parse_html_tables(htm_doc)
+    ## Find headers
+    headers = [[v for t, v in row if t == "th"] for table in tables for row in table]
+    headers = [h for h in headers if h]
+    bc_header = headers[0]
+    smp_header = headers[1]
+    ## 'Known' headers from a Demultiplex_Stats.htm document
+    bc_header_known = ['Lane', 'Sample ID', 'Sample Ref', 'Index', 'Description', 'Control', 'Project', 'Yield (Mbases)', '% PF', '# Reads', '% of raw clusters per lane', '% Perfect Index Reads', '% One Mismatch Reads (Index)', '% of >= Q30 Bases (PF)', 'Mean Quality Score (PF)']
+    smp_header_known = ['None', 'Recipe', 'Operator', 'Directory']
+    if not bc_header == bc_header_known:
+        log.warn("Barcode lane statistics header information has changed. New format?\nOld format: {}\nSaw: {}".format(",".join((["'{}'".format(x) for x in bc_header_known])), ",".join(["'{}'".format(x) for x in bc_header])))
+    if not smp_header == smp_header_known:
+        log.warn("Sample header information has changed. New format?\nOld format: {}\nSaw: {}".format(",".join((["'{}'".format(x) for x in smp_header_known])), ",".join(["'{}'".format(x) for x in smp_header])))
+    ## Fix first header name in smp_header since htm document is mal-formatted: <th>Sample<p></p>ID</th>
+    smp_header[0] = "Sample ID"
+
+    def parse_table(table, header):
+        cells = ([v for t, v in row if t == "td"] for row in table)
+        return [{header[i]:row[i] for i in range(0, len(header)) if row} for row in cells]
+    metrics = {}
+    ## Barcode lane statistics and sample information are in the
+    ## second and fourth table, following their header tables
+    metrics["Barcode_lane_statistics"] = parse_table(tables[1], bc_header)
+    metrics["Sample_information"] = parse_table(tables[3], smp_header)
+    return metrics
 
-    def _to_dict(self, section):
-        if len(section) == 0:
-            return {}
-        header = [x.strip("#") for x in section[0].rstrip("\t").split("\t")]
-        d = []
-        for l in section[1:]:
-            d.append(l.split("\t"))
-        data = np.array(d)
-        df = {header[i]:data[:,i].tolist() for i in range(0,len(header))}
-        return df
 ##############################
 ##  objects
 ##############################
+class RunMetricsFileIndex(object):
+    """Index of run metrics files keyed by metric kind, lane and
+    barcode id. The directory tree is walked and every file is
+    classified once, so that metric lookups are dict accesses.
+
+    :param path: root directory to index
+    :param ignore: regular expression for directories to skip
+    """
+    def __init__(self, path, ignore=None):
+        self.path = path
+        self.files = []
+        self._index = defaultdict(list)
+        if not path:
+            return
+        for root, dirs, files in os.walk(path):
+            if ignore and re.search(ignore, root):
+                continue
+            for f in files:
+                self.add(os.path.join(root, f))
+
+    def __len__(self):
+        return len(self.files)
+
+    def _key(self, kind, lane, barcode_id=None):
+        return (kind, str(lane), None if barcode_id is None else str(barcode_id))
+
+    def add(self, f):
+        """Classify file f and add it to the index"""
+        self.files.append(f)
+        for kind, regexp in FILE_KIND_RE:
+            m = regexp.match(os.path.basename(f))
+            if m:
+                break
+        else:
+            kind = "fastqc"
+            m = FASTQC_RE.search(f)
+            if not m:
+                return
+        barcode_id = m.groupdict().get("barcode_id", None)
+        if barcode_id == "nophix":
+            barcode_id = None
+        self._index[self._key(kind, m.group("lane"), barcode_id)].append(f)
+
+    def get(self, kind, lane, barcode_id=None):
+        """Get files of a given kind for a lane, and possibly a barcode id.
+
+        :param kind: one of picard, fastq_screen, fastqc, filter_metrics, bc_metrics
+        :param lane: lane
+        :param barcode_id: barcode id; None for lane-level files
+
+        :returns: list of files
+        """
+        return self._index.get(self._key(kind, lane, barcode_id), [])
+
+    def sample_files(self, lane, barcode_id):
+        """Get the files read by SampleRunMetrics for a lane and barcode id"""
+        files = self.get("bc_metrics", lane)
+        for kind in ["picard", "fastq_screen", "fastqc", "filter_metrics"]:
+            files = files + self.get(kind, lane, barcode_id)
+        return sorted(set(files))
+
+    def flowcell_files(self):
+        """Get the files read by FlowcellRunMetrics"""
+        files = [f for f in self.files if re.search("\.(xml|htm|csv|yaml)$", f)]
+        for kind, lane, barcode_id in self._index.keys():
+            if kind in ["bc_metrics", "filter_metrics"] and barcode_id is None:
+                files = files + self._index[(kind, lane, barcode_id)]
+        return sorted(set(files))
+
 class RunMetrics(dict):
     """Generic Run class"""
     _metrics = []
@@ -361,11 +862,25 @@ class RunMetrics(dict):
         self["creation_time"] = None
         self["modification_time"] = None
         self.files = []
+        self.file_index = RunMetricsFileIndex(None)
         self.path=None
         self.log = LOG
         if log:
             self.log = log
 
+    def __getstate__(self):
+        """Drop logger and file index when pickling, e.g. when passing
+        objects back from worker processes."""
+        state = self.__dict__.copy()
+        state.pop("log", None)
+        state["file_index"] = RunMetricsFileIndex(None)
+        state["files"] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.log = LOG
+
     def entity_type(self):
         return type(self).__name__
     
@@ -378,16 +893,20 @@ class RunMetrics(dict):
     def parse(self):
         raise NotImplementedError
 
-    def _collect_files(self):
-        if not self.path:
-            return
-        if not os.path.exists(self.path):
-            raise IOError
-        self.files = []
-        for root, dirs, files in os.walk(self.path):
-            if re.search(self.reignore, root):
-                continue
-            self.files = self.files + [os.path.join(root, x) for x in files]
+    def _collect_files(self, file_index=None):
+        """Collect files, possibly from a file index shared with other
+        objects in the same directory.
+
+        :param file_index: RunMetricsFileIndex
+        """
+        if file_index is None:
+            if not self.path:
+                return
+            if not os.path.exists(self.path):
+                raise IOError
+            file_index = RunMetricsFileIndex(self.path, ignore=self.reignore)
+        self.file_index = file_index
+        self.files = file_index.files
 
     def filter_files(self, pattern, filter_fn=None):
         """Take file list and return those files that pass the filter_fn criterium"""
@@ -400,7 +919,7 @@ class RunMetrics(dict):
 class SampleRunMetrics(RunMetrics):
     """Sample-level class for holding run metrics data"""
 
-    def __init__(self, path, flowcell, date, lane, barcode_name, barcode_id, sample_prj, sequence="NoIndex", barcode_type=None, genomes_filter_out=None):
+    def __init__(self, path, flowcell, date, lane, barcode_name, barcode_id, sample_prj, sequence="NoIndex", barcode_type=None, genomes_filter_out=None, file_index=None):
         RunMetrics.__init__(self)
         self.path = path
         self["entity_type"] = "sample_run_metrics"
@@ -422,7 +941,7 @@ class SampleRunMetrics(RunMetrics):
         self["fastq_scr"] = {}
         self["picard_metrics"] = {}
 
-        self._collect_files()
+        self._collect_files(file_index)
 
     def __repr__(self):
         return "<sample_run_metrics {}>".format(self["name"])
@@ -430,28 +949,28 @@ class SampleRunMetrics(RunMetrics):
     def __str__(self):
         return repr(self)
         
-    def read_picard_metrics(self):
+    def read_picard_metrics(self, typed=False):
+        """Read picard metrics.
+
+        :param typed: store metric values as numbers instead of strings
+        """
         self.log.debug("read_picard_metrics for sample {}, project {}, lane {} in run {}".format(self["barcode_name"], self["sample_prj"], self["lane"], self["flowcell"]))
-        picard_parser = ExtendedPicardMetricsParser()
-        pattern = "|".join(["{}_[0-9]+_[0-9A-Za-z]+(_nophix)?_{}-.*.(align|hs|insert|dup)_metrics".format(self["lane"], self["barcode_id"]),
-                            "{}_[0-9]+_[0-9A-Za-z]+_{}(_nophix)?-.*.(align|hs|insert|dup)_metrics".format(self["lane"], self["barcode_id"])])
-        files = self.filter_files(pattern)
+        picard_parser = ExtendedPicardMetricsParser(typed=typed)
+        files = self.file_index.get("picard", self["lane"], self["barcode_id"])
         if len(files) == 0:
-            self.log.warn("no picard metrics files for sample {}; pattern {}".format(self["barcode_name"], pattern))
+            self.log.warn("no picard metrics files for sample {}; lane {}, barcode id {}".format(self["barcode_name"], self["lane"], self["barcode_id"]))
             return 
         try:
             self.log.debug("files {}".format(",".join(files)))
             metrics = picard_parser.extract_metrics(files)
-            self["picard_metrics"] = metrics
+            self["picard_metrics"] = encode_picard_metrics(metrics) if typed else metrics
         except:
             self.log.warn("no picard metrics for sample {}".format(self["barcode_name"]))
 
     def parse_fastq_screen(self):
         self.log.debug("parse_fastq_screen for sample {}, project {}, lane {} in run {}".format(self["barcode_name"], self["sample_prj"], self["lane"], self["flowcell"]))
         parser = MetricsParser()
-        pattern = "|".join(["{}_[0-9]+_[0-9A-Za-z]+(_nophix)?_{}_[12]_fastq_screen.txt".format(self["lane"], self["barcode_id"]),
-                            "{}_[0-9]+_[0-9A-Za-z]+_{}(_nophix)?_[12]_fastq_screen.txt".format(self["lane"], self["barcode_id"])])
-        files = self.filter_files(pattern)
+        files = self.file_index.get("fastq_screen", self["lane"], self["barcode_id"])
         self.log.debug("files {}".format(",".join(files)))
         try:
             fp = open(files[0])
@@ -461,27 +980,32 @@ class SampleRunMetrics(RunMetrics):
         except:
             self.log.warn("no fastq screen metrics for sample {}".format(self["barcode_name"]))
 
-    def read_fastqc_metrics(self):
+    def read_fastqc_metrics(self, typed=False):
+        """Read FastQC metrics and module pass/warn/fail flags.
+
+        :param typed: store numeric columns as numbers instead of strings
+        """
         self.log.debug("read_fastq_metrics for sample {}, project {}, lane {} in run {}".format(self["barcode_name"], self["sample_prj"], self["lane"], self["flowcell"]))
         if self["barcode_name"] == "unmatched":
             return
         self["fastqc"] = {'stats':None}
-        pattern = "fastqc/{}_[0-9]+_[0-9A-Za-z]+(_nophix)?_{}-*".format(self["lane"], self["barcode_id"])
-        files = self.filter_files(pattern)
+        ## The fastqc group holds every file of the FastQC output directory
+        files = [f for f in self.file_index.get("fastqc", self["lane"], self["barcode_id"]) if os.path.basename(f) == "fastqc_data.txt"]
         self.log.debug("files {}".format(",".join(files)))
         try:
-            fastqc_dir = os.path.dirname(files[0])
-            fqparser = ExtendedFastQCParser(fastqc_dir)
-            stats = fqparser.get_fastqc_summary()
-            self["fastqc"] = {'stats':stats}
+            data = FastQCData.from_file(files[0])
+            if typed:
+                stats = encode_picard_metrics({x : data.columns(x) for x in FASTQC_MODULES})
+            else:
+                stats = {x : data.strings(x) for x in FASTQC_MODULES}
+            self["fastqc"] = {'stats':stats, 'status':{x : data.status.get(x, None) for x in FASTQC_MODULES}}
         except:
-            self.log.warn("no fastq screen metrics for sample {}".format(self["barcode_name"]))
+            self.log.warn("no fastqc metrics for sample {}".format(self["barcode_name"]))
 
     def parse_filter_metrics(self):
         """CASAVA: Parse filter metrics at sample level"""
         self.log.debug("parse_filter_metrics for lane {}, project {} in flowcell {}".format(self["lane"], self["sample_prj"], self["flowcell"]))
-        pattern = "{}_[0-9]+_[0-9A-Za-z]+_{}(_nophix)?.filter_metrics".format(self["lane"], self["barcode_id"])
-        files = self.filter_files(pattern)
+        files = self.file_index.get("filter_metrics", self["lane"], self["barcode_id"])
         self.log.debug("files {}".format(",".join(files)))
         self["filter_metrics"] = {"reads":None, "reads_aligned":None, "reads_fail_align":None}
         try:
@@ -496,10 +1020,9 @@ class SampleRunMetrics(RunMetrics):
     def parse_bc_metrics(self):
         """Parse bc metrics at sample level"""
         self.log.debug("parse_bc_metrics for sample {}, project {} in flowcell {}".format(self["barcode_name"], self["sample_prj"], self["flowcell"]))
-        pattern = "{}_[0-9]+_[0-9A-Za-z]+(_nophix)?[\._]bc[\._]metrics".format(self["lane"])
-        files = self.filter_files(pattern)
+        files = self.file_index.get("bc_metrics", self["lane"])
         if len(files) == 0:
-            self.log.debug("no bc metrics files for sample {}; pattern {}".format(self["barcode_name"], pattern))
+            self.log.debug("no bc metrics files for sample {}; lane {}".format(self["barcode_name"], self["lane"]))
             return 
         self.log.debug("files {}".format(",".join(files)))
         try:
@@ -511,10 +1034,40 @@ class SampleRunMetrics(RunMetrics):
         except:
             self.log.warn("No bc_metrics info for lane {}".format(self["lane"]))
 
+    def calc_derived_metrics(self):
+        """Calculate summaries used in reports from the parsed metrics
+        and store them in 'derived': average quality score and percent
+        of reads with mean quality >= 30 from FastQC, read count in
+        millions and picard duplication rate. Values that cannot be
+        calculated are None."""
+        derived = {"avg_qv" : None, "pct_q30" : None, "read_count_m" : None, "duplication_rate" : None}
+        try:
+            qscores = self["fastqc"]["stats"]["Per sequence quality scores"]
+            count = np.asarray(qscores["Count"], dtype=np.float64)
+            quality = np.asarray(qscores["Quality"], dtype=np.float64)
+            derived["avg_qv"] = round(float(np.dot(count, quality)/count.sum()), 1)
+            derived["pct_q30"] = round(float(100 * count[quality >= 30].sum()/count.sum()), 1)
+        except:
+            self.log.debug("no FastQC quality scores for sample {}".format(self["barcode_name"]))
+        try:
+            derived["read_count_m"] = round(float(self["bc_count"])/1e6, 1)
+        except (TypeError, ValueError):
+            pass
+        try:
+            derived["duplication_rate"] = float(self["picard_metrics"]["DUP_metrics"]["PERCENT_DUPLICATION"])
+        except (KeyError, TypeError, ValueError):
+            pass
+        self["derived"] = derived
+
 
 class FlowcellRunMetrics(RunMetrics):
     """Flowcell level class for holding qc data."""
-    def __init__(self, path, fc_date, fc_name, runinfo="RunInfo.xml"):#, parse=True, fullRTA=False):
+    ## Bulky parts that can be stored as attachments, leaving RunInfo,
+    ## lane metrics, Summary and NumClusters in the document
+    attachment_parts = ["illumina.ErrorRate", "illumina.FWHM", "illumina.Intensity", "illumina.NumGT30",
+                        "illumina.Charts", "illumina.Demultiplex_Stats", "samplesheet_csv"]
+
+    def __init__(self, path, fc_date, fc_name, runinfo="RunInfo.xml", file_index=None):#, parse=True, fullRTA=False):
         RunMetrics.__init__(self)
         self.path = path
         self.db=None
@@ -527,7 +1080,7 @@ class FlowcellRunMetrics(RunMetrics):
         self["lanes"] = {str(k):{"lane":str(k), "filter_metrics":{}, "bc_metrics":{}} for k in self._lanes}
         self["illumina"] = {}
         self._parseRunInfo(runinfo)
-        self._collect_files()
+        self._collect_files(file_index)
 
     def __repr__(self):
         return "<flowcell_metrics {}>".format(self["name"])
@@ -564,15 +1117,50 @@ class FlowcellRunMetrics(RunMetrics):
         infile = os.path.join(os.path.abspath(self.path), run_info_yaml)
         self.log.debug("parse_run_info_yaml: going to read {}".format(infile))
         try:
-            fp = open(infile)
-            runinfo = yaml.load(fp)
-            fp.close()
+            runinfo = load_run_info(infile)
             self["run_info_yaml"] = runinfo
             return True
         except:
             self.log.warn("No such file {}".format(infile))
             return False
 
+    def split_attachments(self, parts=None):
+        """Move bulky parts to compressed inline attachments, which are
+        uploaded with the document but not downloaded when it is
+        retrieved. Empty parts are dropped.
+
+        :param parts: dotted paths of parts; defaults to attachment_parts
+        """
+        if parts is None:
+            parts = self.attachment_parts
+        attachments = self.get("_attachments", {})
+        for part in parts:
+            keys = part.split(".")
+            d = self
+            for k in keys[:-1]:
+                d = d.get(k, {})
+            value = d.pop(keys[-1], None) if isinstance(d, dict) else None
+            if value:
+                attachments[attachment_name(part)] = encode_attachment(value)
+        if attachments:
+            self["_attachments"] = attachments
+
+    def calc_derived_metrics(self):
+        """Calculate summaries used in reports from the parsed metrics
+        and store them in 'derived': the PhiX error rate of each lane,
+        averaged over read1 and read3."""
+        phix = {}
+        summary = self["illumina"].get("Summary", {})
+        for lane, vals in summary.get("read1", {}).items():
+            ## Lanes are keyed by number, next to the Summary attributes
+            if not isinstance(vals, dict):
+                continue
+            try:
+                phix[lane] = (float(summary["read1"][lane]["ErrRatePhiX"]) + float(summary["read3"][lane]["ErrRatePhiX"]))/2
+            except (KeyError, TypeError, ValueError):
+                self.log.debug("no PhiX error rate for lane {}".format(lane))
+        self["derived"] = {"phix_error_rate" : phix}
+
     def get_full_flowcell(self):
         vals = self["RunInfo"]["Id"].split("_")
         return vals[-1]
@@ -583,7 +1171,12 @@ class FlowcellRunMetrics(RunMetrics):
     def get_run_name(self):
         return "%s_%s" % (self.get_date(), self.get_full_flowcell())
 
-    def parse_illumina_metrics(self, fullRTA):
+    def parse_illumina_metrics(self, fullRTA, dense=True):
+        """Parse illumina RTA xml files.
+
+        :param fullRTA: parse per tile and cycle charts
+        :param dense: store charts as RTAChart dicts
+        """
         self.log.debug("parse_illumina_metrics")
         fn = []
         for root, dirs, files in os.walk(os.path.abspath(self.path)):
@@ -592,16 +1185,15 @@ class FlowcellRunMetrics(RunMetrics):
                     fn.append(os.path.join(root, file))
         self.log.debug("Found {} RTA files {}...".format(len(fn), ",".join(fn[0:10])))
         parser = IlluminaXMLParser()
-        metrics = parser.parse(fn, fullRTA)
+        metrics = parser.parse(fn, fullRTA, dense)
         self["illumina"].update(metrics)
 
     def parse_filter_metrics(self):
         """pre-CASAVA: Parse filter metrics at flowcell level"""
         self.log.debug("parse_filter_metrics for flowcell {}".format(self["RunInfo"]["Flowcell"]))
         for lane in self._lanes:
-            pattern = "{}_[0-9]+_[0-9A-Za-z]+(_nophix)?.filter_metrics".format(lane)
             self["lanes"][str(lane)]["filter_metrics"] = {"reads":None, "reads_aligned":None, "reads_fail_align":None}
-            files = self.filter_files(pattern)
+            files = self.file_index.get("filter_metrics", lane)
             self.log.debug("filter metrics files {}".format(",".join(files)))
             try:
                 fp = open(files[0])
@@ -616,9 +1208,8 @@ class FlowcellRunMetrics(RunMetrics):
         """Parse bc metrics at sample level"""
         self.log.debug("parse_bc_metrics for flowcell {}".format(self["RunInfo"]["Flowcell"]))
         for lane in self._lanes:
-            pattern = "{}_[0-9]+_[0-9A-Za-z]+(_nophix)?[\._]bc[\._]metrics".format(lane)
             self["lanes"][str(lane)]["bc_metrics"] = {"reads":None, "reads_aligned":None, "reads_fail_align":None}
-            files = self.filter_files(pattern)
+            files = self.file_index.get("bc_metrics", lane)
             self.log.debug("bc metrics files {}".format(",".join(files)))
             try:
                 parser = MetricsParser()
@@ -640,41 +1231,7 @@ class FlowcellRunMetrics(RunMetrics):
             return
         with open(htm_file) as fh:
             htm_doc = fh.read()
-        soup = BeautifulSoup(htm_doc)
-        ## 
-        ## Find headers
-        allrows = soup.findAll("tr")
-        column_gen=(row.findAll("th") for row in allrows)
-        parse_row = lambda row: row 
-        headers = [h for h in map(parse_row, column_gen) if h]
-        bc_header = [str(x.string) for x in headers[0]]
-        smp_header = [str(x.string) for x in headers[1]]
-        ## 'Known' headers from a Demultiplex_Stats.htm document
-        bc_header_known = ['Lane', 'Sample ID', 'Sample Ref', 'Index', 'Description', 'Control', 'Project', 'Yield (Mbases)', '% PF', '# Reads', '% of raw clusters per lane', '% Perfect Index Reads', '% One Mismatch Reads (Index)', '% of >= Q30 Bases (PF)', 'Mean Quality Score (PF)']
-        smp_header_known = ['None', 'Recipe', 'Operator', 'Directory']
-        if not bc_header == bc_header_known:
-            self.log.warn("Barcode lane statistics header information has changed. New format?\nOld format: {}\nSaw: {}".format(",".join((["'{}'".format(x) for x in bc_header_known])), ",".join(["'{}'".format(x) for x in bc_header])))
-        if not smp_header == smp_header_known:
-            self.log.warn("Sample header information has changed. New format?\nOld format: {}\nSaw: {}".format(",".join((["'{}'".format(x) for x in smp_header_known])), ",".join(["'{}'".format(x) for x in smp_header])))
-        ## Fix first header name in smp_header since htm document is mal-formatted: <th>Sample<p></p>ID</th>
-        smp_header[0] = "Sample ID"
-
-        metrics = {}
-        ## Parse Barcode lane statistics
-        soup = BeautifulSoup(htm_doc)
-        table = soup.findAll("table")[1]
-        rows = table.findAll("tr")
-        column_gen = (row.findAll("td") for row in rows)
-        parse_row = lambda row: {bc_header[i]:str(row[i].string) for i in range(0, len(bc_header)) if row}
-        metrics["Barcode_lane_statistics"] =  map(parse_row, column_gen)
-
-        ## Parse Sample information
-        soup = BeautifulSoup(htm_doc)
-        table = soup.findAll("table")[3]
-        rows = table.findAll("tr")
-        column_gen = (row.findAll("td") for row in rows)
-        parse_row = lambda row: {smp_header[i]:str(row[i].string) for i in range(0, len(smp_header)) if row}
-        metrics["Sample_information"] = map(parse_row, column_gen)
+        metrics = parse_demultiplex_stats(htm_doc, self.log)
         ## Set data
         self["illumina"].update({"Demultiplex_Stats": metrics})
         return metrics
@@ -1,13 +1,19 @@
 """Database module"""
 import os
 import sys
+import json
+import zlib
+import base64
+import hashlib
 import couchdb
+from collections import OrderedDict
 
 from cement.core import backend
 
 LOG = backend.minimal_logger("db")
 
 from scilifelab.utils.http import check_url
+from scilifelab.db.replica import get_replica, SYNC_TIMEOUT
 
 
 class ConnectionError(Exception):
@@ -24,6 +30,310 @@ class ConnectionError(Exception):
     def __str__(self):
         return self.msg
 
+class LRUCache(object):
+    """Bounded in-process cache that discards the least recently used
+    items first.
+
+    :param size: maximum number of items; 0 disables caching
+    """
+    def __init__(self, size=1000):
+        self.size = size
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __getitem__(self, key):
+        value = self._data.pop(key)
+        self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if self.size <= 0:
+            return
+        self._data.pop(key, None)
+        self._data[key] = value
+        if len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+_MISSING = object()
+
+def row_id(row):
+    """Get the document id of a view row, for use as LazyView value_fn"""
+    return row.id
+
+def row_value(row):
+    """Get the value of a view row, for use as LazyView value_fn"""
+    return row.value
+
+class LazyView(object):
+    """Read-only, dict-like access to a couchdb view. Rows are queried
+    by key on demand instead of downloading the entire view, and
+    recently used keys are kept in an LRU cache.
+
+    :param db: couchdb database
+    :param name: view name
+    :param value_fn: function applied to rows before they are returned; defaults to returning the row
+    :param cache_size: maximum number of cached keys
+    :param options: options passed to every view query, e.g. reduce=False
+    """
+    def __init__(self, db, name, value_fn=None, cache_size=1000, **options):
+        self.db = db
+        self.name = name
+        self.value_fn = value_fn if value_fn else lambda row: row
+        self.options = options
+        self.cache = LRUCache(cache_size)
+
+    def __repr__(self):
+        return "LazyView({})".format(self.name)
+
+    def _query(self, **kw):
+        options = dict(self.options)
+        options.update(kw)
+        return self.db.view(self.name, **options)
+
+    def get(self, key, default=None):
+        if key in self.cache:
+            value = self.cache[key]
+        else:
+            rows = list(self._query(key=key))
+            value = self.value_fn(rows[0]) if rows else _MISSING
+            self.cache[key] = value
+        return default if value is _MISSING else value
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get_many(self, keys):
+        """Look up several keys in one request.
+
+        :param keys: list of keys
+
+        :returns: dict of key to value for keys present in view
+        """
+        res = {}
+        query = []
+        for k in keys:
+            if k in self.cache:
+                if self.cache[k] is not _MISSING:
+                    res[k] = self.cache[k]
+            else:
+                query.append(k)
+        if query:
+            for row in self._query(keys=query):
+                res[row.key] = self.value_fn(row)
+                self.cache[row.key] = res[row.key]
+        return res
+
+    def query(self, **kw):
+        """Query view with additional options, e.g. key ranges.
+
+        :returns: list of values
+        """
+        return [self.value_fn(row) for row in self._query(**kw)]
+
+    def keys(self):
+        """Get all keys. NB: this downloads the entire view."""
+        return [row.key for row in self._query()]
+
+class CouchSession(object):
+    """Server handle shared by all connections to a couchdb server
+    in a process. The underlying http session keeps a pool of
+    keep-alive connections, and database handles and lazy views are
+    created once and then reused.
+
+    :param url_string: server url
+    :param server: server handle; defaults to a couchdb.Server of url_string
+    """
+    def __init__(self, url_string, server=None):
+        self.url_string = url_string
+        self.server = server if server is not None else couchdb.Server(url=url_string, session=couchdb.http.Session())
+        self.dbs = {}
+        self.views = {}
+
+    def __repr__(self):
+        return "CouchSession({})".format(self.url_string)
+
+    def db(self, dbname):
+        """Get shared database handle.
+
+        :param dbname: database name
+        """
+        if not dbname in self.dbs:
+            self.dbs[dbname] = self.server[dbname]
+        return self.dbs[dbname]
+
+    def view(self, db, name, **kw):
+        """Get shared lazy view. Calls with the same database, view
+        name and keyword arguments share a view. To share views
+        between connections, pass module level functions such as
+        row_id as value_fn rather than lambdas.
+
+        :param db: database
+        :param name: view name
+        :param kw: keyword arguments passed to LazyView
+        """
+        ## Replicas of a database get views of their own
+        key = (db.name, getattr(db, "store", None), name, tuple(sorted(kw.items())))
+        if not key in self.views:
+            self.views[key] = LazyView(db, name, **kw)
+        return self.views[key]
+
+class OfflineServer(object):
+    """Stand-in for an unreachable server, used by connections that
+    read from a local replica. See OfflineDatabase.
+
+    :param url_string: server url
+    """
+    def __init__(self, url_string):
+        self.url_string = url_string
+
+    def __repr__(self):
+        return "OfflineServer({})".format(self.url_string)
+
+    def __getitem__(self, dbname):
+        return OfflineDatabase(self.url_string, dbname)
+
+class OfflineDatabase(object):
+    """Database of an unreachable server. Requests that its replica
+    cannot serve raise ConnectionError.
+
+    :param url_string: server url
+    :param name: database name
+    """
+    def __init__(self, url_string, name):
+        self.url_string = url_string
+        self.name = name
+
+    def __repr__(self):
+        return "<OfflineDatabase {}>".format(self.name)
+
+    def _unavailable(self, *args, **kw):
+        raise ConnectionError("server {} is unreachable and the request to database {} cannot be served from the replica".format(self.url_string, self.name))
+
+    get = view = changes = get_attachment = save = update = __getitem__ = _unavailable
+
+## Sessions by url
+_SESSIONS = {}
+## Sessions of unreachable servers, by url
+_OFFLINE_SESSIONS = {}
+
+def get_session(url_string, timeout=None):
+    """Get the session for a server url, creating it if needed. The
+    url is only checked when the session is created.
+
+    :param url_string: server url
+    :param timeout: timeout in seconds of the url check
+
+    :returns: CouchSession if url is reachable, None otherwise
+    """
+    if not url_string in _SESSIONS:
+        if not check_url(url_string, timeout):
+            return None
+        _SESSIONS[url_string] = CouchSession(url_string)
+    return _SESSIONS[url_string]
+
+def get_offline_session(url_string):
+    """Get a session for an unreachable server url, whose databases
+    are only read through local replicas.
+
+    :param url_string: server url
+
+    :returns: CouchSession with an OfflineServer
+    """
+    if not url_string in _OFFLINE_SESSIONS:
+        _OFFLINE_SESSIONS[url_string] = CouchSession(url_string, OfflineServer(url_string))
+    return _OFFLINE_SESSIONS[url_string]
+
+def clear_sessions():
+    """Remove all shared sessions"""
+    _SESSIONS.clear()
+    _OFFLINE_SESSIONS.clear()
+
+## Parts of documents stored as attachments are gzipped json
+ATTACHMENT_CONTENT_TYPE = "application/x-gzip"
+
+def attachment_name(part):
+    """Get the attachment file name of a document part.
+
+    :param part: dotted path of part in document, e.g. illumina.Demultiplex_Stats
+    """
+    return "{}.json.gz".format(part)
+
+def encode_attachment(obj):
+    """Encode an object as an inline document attachment. The
+    encoding is deterministic so that unchanged objects get the same
+    digest.
+
+    :param obj: json serializable object
+
+    :returns: dict with content_type and base64 encoded data
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    data = compressor.compress(json.dumps(obj, sort_keys=True, separators=(",", ":"))) + compressor.flush()
+    return {"content_type" : ATTACHMENT_CONTENT_TYPE, "data" : base64.b64encode(data)}
+
+def decode_attachment(data):
+    """Decode attachment data as written by encode_attachment.
+
+    :param data: gzipped json string
+
+    :returns: object
+    """
+    return json.loads(zlib.decompress(data, 16 + zlib.MAX_WBITS))
+
+def attachment_digest(attachment):
+    """Get the digest of an attachment, as reported by couchdb for
+    attachment stubs.
+
+    :param attachment: attachment stub or inline attachment
+
+    :returns: digest string
+    """
+    if "digest" in attachment:
+        return attachment["digest"]
+    return "md5-{}".format(base64.b64encode(hashlib.md5(base64.b64decode(attachment["data"])).digest()))
+
+def update_design_doc(db, design, views, version=None):
+    """Add or update views of a design document. Views of the design
+    document that are not in views are kept. With a version, the
+    design document is only saved if its stored version is missing or
+    lower, so that older clients don't overwrite newer views.
+
+    :param db: couchdb database
+    :param design: design document id, e.g. _design/names
+    :param views: dict of view name to view definition
+    :param version: version number stored in the design document
+
+    :returns: True if the design document was saved, False if it was up to date or newer
+    """
+    doc = db.get(design, {"_id" : design, "language" : "javascript", "views" : {}})
+    stored = doc.get("version", None)
+    if version is not None and stored is not None:
+        if stored > version:
+            LOG.warn("design document {} has version {}, newer than {}; not updating it".format(design, stored, version))
+        if stored >= version:
+            return False
+    elif stored == version and all(doc["views"].get(k, None) == v for k, v in views.items()):
+        return False
+    doc["views"].update(views)
+    if version is not None:
+        doc["version"] = version
+    db.save(doc)
+    return True
+
 class Database(object):
     """Main database connection object for noSQL databases"""
 
@@ -40,12 +350,24 @@ class Database(object):
 
 ## From http://stackoverflow.com/questions/8780168/how-to-begin-writing-a-python-wrapper-around-another-wrapper
 class Couch(Database):
+    ## Number of documents per bulk request
+    batch_size = 200
+    ## Local views of replicated databases, by database name; see
+    ## scilifelab.db.replica
+    replica_schemas = None
+    ## Design documents of the database of a connection, as a dict of
+    ## design document id to views, and their version; see install_views
+    design_docs = None
+    design_docs_version = None
+
     def __init__(self, log=None, **kwargs):
         self.db = None
+        self.session = None
         self.url = kwargs.get("url", None)
-        self.port = 5984
+        self.port = kwargs.get("port", 5984)
         self.user = kwargs.get("username", None)
         self.pw = kwargs.get("password", None)
+        self.replica = kwargs.pop("replica", None)
         self.url_string = "http://{}:{}".format(self.url, self.port)
         if log:
             self.log = log
@@ -57,10 +379,18 @@ class Couch(Database):
         if not username or not password or not url:
             self.log.warn("please supply username, password, and url")
             return None
-        if not check_url(self.url_string):
+        if self.replica:
+            ## Don't wait longer for the server than for a replica sync
+            self.session = get_session(self.url_string, SYNC_TIMEOUT)
+            if not self.session:
+                self.log.warn("No such url {}; reading from replica {} only".format(self.url_string, self.replica))
+                self.session = get_offline_session(self.url_string)
+        else:
+            self.session = get_session(self.url_string)
+        if not self.session:
             self.log.warn("No such url {}".format(self.url_string))
             return None
-        self.con = couchdb.Server(url=self.url_string)
+        self.con = self.session.server
         self.log.info("Connected to server @{}".format(self.url_string))
         self.user = username
         self.pw = password
@@ -71,10 +401,73 @@ class Couch(Database):
         :param dbname: database name
         """
         try:
-            self.db = self.con[dbname]
+            self.db = self.session.db(dbname)
         except:
             return None
 
+    def install_views(self):
+        """Add or update the design documents in design_docs in the
+        database of the connection."""
+        for design, views in (self.design_docs or {}).items():
+            if update_design_doc(self.session.db(self.db.name), design, views, self.design_docs_version):
+                self.log.info("updated design document {} in {} database".format(design, self.db.name))
+
+    def replicated(self, db):
+        """Get the local replica of a database if the connection was
+        created with a replica file, synced from the server on first
+        use in a process.
+
+        :param db: database
+
+        :returns: replica database, or db if there is no replica
+        """
+        if not self.replica or not self.replica_schemas or not db.name in self.replica_schemas:
+            return db
+        return get_replica(self.replica, self.replica_schemas).database(db)
+
+    def get_attachment(self, doc, filename):
+        """Fetch and decode a document attachment written by
+        encode_attachment.
+
+        :param doc: document
+        :param filename: attachment file name
+
+        :returns: object, or None if there is no such attachment
+        """
+        if not filename in doc.get("_attachments", {}):
+            return None
+        fh = self.db.get_attachment(doc, filename)
+        if fh is None:
+            return None
+        try:
+            return decode_attachment(fh.read())
+        finally:
+            fh.close()
+
+    def get_docs(self, ids, fields=None, batch_size=None):
+        """Fetch documents in batches using _all_docs with
+        include_docs, instead of one request per document.
+
+        :param ids: list of document ids
+        :param fields: list of fields to keep in returned documents (_id is always kept). NB: projection is done after fetching
+        :param batch_size: number of documents per request; defaults to self.batch_size
+
+        :returns: list of documents in the order of ids; missing documents are skipped
+        """
+        if not batch_size:
+            batch_size = self.batch_size
+        docs = []
+        for i in range(0, len(ids), batch_size):
+            for row in self.db.view("_all_docs", keys=ids[i:i + batch_size], include_docs=True):
+                if row.doc is None:
+                    self.log.warn("no document with id '{}'".format(row.key))
+                    continue
+                if fields:
+                    docs.append({k:row.doc.get(k, None) for k in ["_id"] + list(fields)})
+                else:
+                    docs.append(row.doc)
+        return docs
+
         
 class GenoLogics(Database):
     def __init__(**kwargs):
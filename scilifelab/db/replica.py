@@ -0,0 +1,365 @@
+"""Local replica of couchdb databases in an sqlite file.
+
+Documents are synced incrementally from the _changes feed of each
+database, and views that are defined locally with python map functions
+are served from the replica. Other requests go to the server.
+"""
+import json
+import time
+import sqlite3
+import couchdb
+
+from cement.core import backend
+
+LOG = backend.minimal_logger("db")
+
+## Default time budget of a sync, in seconds; also the timeout of
+## each request to the _changes feed
+SYNC_TIMEOUT = 30
+
+## Index columns of replicated documents
+INDEX_FIELDS = ["name", "flowcell", "project"]
+
+class LocalView(object):
+    """View evaluated on replicated documents.
+
+    :param map_fn: function of a document returning a list of (key, value) tuples
+    :param index: index column holding the key, or first element of a
+      list key, used to select documents for key queries; if None,
+      every document of the database is mapped
+    :param reduce: '_sum', '_count' or '_stats', or None
+    """
+    def __init__(self, map_fn, index=None, reduce=None):
+        self.map_fn = map_fn
+        self.index = index
+        self.reduce = reduce
+
+class ReplicaSchema(object):
+    """Index columns and local views of a replicated database.
+
+    :param fields: dict of index column name to function of a document returning the column value
+    :param views: dict of view name, e.g. names/name, to LocalView
+    """
+    def __init__(self, fields, views):
+        self.fields = fields
+        self.views = views
+
+class ReplicaRow(object):
+    """View row, with the attributes of couchdb.client.Row"""
+    def __init__(self, id=None, key=None, value=None, doc=None):
+        self.id = id
+        self.key = key
+        self.value = value
+        self.doc = doc
+
+    def __repr__(self):
+        return "<ReplicaRow id={} key={}>".format(self.id, self.key)
+
+def collate(value):
+    """Get sort key of a json value following the CouchDB view
+    collation order: null, false, true, numbers, strings, arrays,
+    objects."""
+    if value is None:
+        return (0,)
+    if value is False:
+        return (1,)
+    if value is True:
+        return (2,)
+    if isinstance(value, (int, long, float)):
+        return (3, value)
+    if isinstance(value, basestring):
+        return (4, value)
+    if isinstance(value, (list, tuple)):
+        return (5, tuple([collate(x) for x in value]))
+    return (6, tuple([(k, collate(v)) for k, v in sorted(value.items())]))
+
+def _reduce(fn, values):
+    """Apply a builtin couchdb reduce function to values"""
+    if fn == "_count":
+        return len(values)
+    if fn == "_sum":
+        if values and isinstance(values[0], list):
+            return [sum(x) for x in zip(*values)]
+        return sum(values)
+    if fn == "_stats":
+        values = [float(x) for x in values]
+        return {"sum" : sum(values), "count" : len(values), "min" : min(values) if values else None,
+                "max" : max(values) if values else None, "sumsqr" : sum([x * x for x in values])}
+    raise ValueError("unsupported reduce function {}".format(fn))
+
+def _key_prefix(startkey, endkey):
+    """Get the key prefix of a range query of the form
+    startkey=[a, ...], endkey=[a, ..., {}], or None if the range has
+    another form."""
+    if not isinstance(startkey, list) or not isinstance(endkey, list):
+        return None
+    if len(endkey) != len(startkey) + 1 or endkey[:-1] != startkey or endkey[-1] != {}:
+        return None
+    return startkey
+
+class ReplicaStore(object):
+    """Local replica of couchdb databases.
+
+    :param path: sqlite file
+    :param schemas: dict of database name to ReplicaSchema
+    :param timeout: time budget of a sync in seconds, see sync
+    """
+    def __init__(self, path, schemas, timeout=SYNC_TIMEOUT):
+        self.path = path
+        self.schemas = schemas
+        self.timeout = timeout
+        self.synced = set()
+        self.con = sqlite3.connect(path)
+        self.con.executescript("""
+            CREATE TABLE IF NOT EXISTS docs (db TEXT, id TEXT, name TEXT, flowcell TEXT, project TEXT, doc TEXT, PRIMARY KEY (db, id));
+            CREATE INDEX IF NOT EXISTS docs_name ON docs (db, name);
+            CREATE INDEX IF NOT EXISTS docs_flowcell ON docs (db, flowcell);
+            CREATE INDEX IF NOT EXISTS docs_project ON docs (db, project);
+            CREATE TABLE IF NOT EXISTS seqs (db TEXT PRIMARY KEY, seq TEXT);
+            """)
+
+    def __repr__(self):
+        return "ReplicaStore({})".format(self.path)
+
+    def last_seq(self, dbname):
+        """Get the update sequence the replica of a database is synced to"""
+        row = self.con.execute("SELECT seq FROM seqs WHERE db=?", (dbname,)).fetchone()
+        return json.loads(row[0]) if row else 0
+
+    def sync(self, remote, dbname=None, batch_size=1000, timeout=None):
+        """Apply changes since the last sync from the _changes feed of
+        a database. Each batch is stored as it arrives, so a sync that
+        stops early is resumed by the next one.
+
+        :param remote: couchdb database
+        :param dbname: database name; defaults to remote.name
+        :param batch_size: number of changes per request
+        :param timeout: time budget in seconds, after which no more
+          batches are requested, and timeout of each request; defaults
+          to self.timeout
+
+        :returns: number of changed documents
+        """
+        dbname = dbname or remote.name
+        schema = self.schemas[dbname]
+        timeout = self.timeout if timeout is None else timeout
+        feed = _changes_feed(remote, timeout)
+        since = self.last_seq(dbname)
+        n = 0
+        t0 = time.time()
+        while True:
+            changes = feed.changes(since=since, include_docs=True, limit=batch_size)
+            results = changes.get("results", [])
+            with self.con:
+                for change in results:
+                    if change.get("deleted", False):
+                        self.con.execute("DELETE FROM docs WHERE db=? AND id=?", (dbname, change["id"]))
+                    elif change.get("doc", None) is not None:
+                        doc = change["doc"]
+                        cols = [_column(schema.fields[x], doc) if x in schema.fields else None for x in INDEX_FIELDS]
+                        self.con.execute("INSERT OR REPLACE INTO docs (db, id, name, flowcell, project, doc) VALUES (?, ?, ?, ?, ?, ?)",
+                                         [dbname, change["id"]] + cols + [json.dumps(doc)])
+                since = changes.get("last_seq", since)
+                self.con.execute("INSERT OR REPLACE INTO seqs (db, seq) VALUES (?, ?)", (dbname, json.dumps(since)))
+            n += len(results)
+            if len(results) < batch_size:
+                break
+            if timeout and time.time() - t0 > timeout:
+                LOG.warn("syncing database {} to replica {} took more than {} seconds; continuing with next sync".format(dbname, self.path, timeout))
+                break
+        self.synced.add(dbname)
+        return n
+
+    def database(self, remote, sync=True):
+        """Get replica of a database, syncing it once per process. If
+        the sync fails, e.g. because the server is slow, the replica
+        is used as is.
+
+        :param remote: couchdb database
+        :param sync: sync before use
+        """
+        if sync and not remote.name in self.synced:
+            try:
+                n = self.sync(remote)
+                LOG.info("synced {} changes of database {} to replica {}".format(n, remote.name, self.path))
+            except Exception as e:
+                LOG.warn("syncing database {} to replica {} failed: {}; using replica as is".format(remote.name, self.path, e))
+                self.synced.add(remote.name)
+        return ReplicaDatabase(self, remote)
+
+    def docs(self, dbname, column=None, values=None):
+        """Get replicated documents, possibly selected by an index column.
+
+        :param dbname: database name
+        :param column: index column or 'id'
+        :param values: values of column
+
+        :returns: list of documents
+        """
+        if column is None:
+            rows = self.con.execute("SELECT doc FROM docs WHERE db=? ORDER BY id", (dbname,))
+            return [json.loads(r[0]) for r in rows]
+        if not column in INDEX_FIELDS + ["id"]:
+            raise ValueError("no such index column {}".format(column))
+        docs = []
+        values = list(values)
+        for i in range(0, len(values), 500):
+            batch = values[i:i + 500]
+            rows = self.con.execute("SELECT doc FROM docs WHERE db=? AND {} IN ({}) ORDER BY id".format(column, ",".join("?" * len(batch))), [dbname] + batch)
+            docs.extend([json.loads(r[0]) for r in rows])
+        return docs
+
+def _changes_feed(remote, timeout):
+    """Get a handle of a database for reading its _changes feed
+    whose requests time out after timeout seconds.
+
+    :param remote: couchdb database
+    :param timeout: socket timeout in seconds, or None
+    """
+    if not timeout or not isinstance(remote, couchdb.Database):
+        return remote
+    feed = couchdb.Database(remote.resource.url, session=couchdb.http.Session(timeout=timeout))
+    feed.resource.credentials = remote.resource.credentials
+    return feed
+
+def _column(fn, doc):
+    """Get index column value of a document"""
+    try:
+        value = fn(doc)
+    except (KeyError, TypeError, AttributeError):
+        return None
+    return None if value is None else unicode(value)
+
+class ReplicaDatabase(object):
+    """Read access to the replica of a database, with the methods of
+    couchdb.client.Database used by the connection classes. Views that
+    are not defined locally, queries the local views don't support,
+    attachments and writes go to the server.
+
+    :param store: ReplicaStore
+    :param remote: couchdb database
+    """
+    def __init__(self, store, remote):
+        self.store = store
+        self.remote = remote
+        self.name = remote.name
+        self.schema = store.schemas[self.name]
+
+    def __repr__(self):
+        return "<ReplicaDatabase {}>".format(self.name)
+
+    def get(self, id, default=None):
+        docs = self.store.docs(self.name, "id", [id])
+        if not docs:
+            return default
+        return docs[0]
+
+    def __getitem__(self, id):
+        doc = self.get(id)
+        if doc is None:
+            raise KeyError(id)
+        return doc
+
+    def get_attachment(self, doc, filename, default=None):
+        return self.remote.get_attachment(doc, filename, default)
+
+    def save(self, doc, **options):
+        return self.remote.save(doc, **options)
+
+    def update(self, documents, **options):
+        return self.remote.update(documents, **options)
+
+    def changes(self, **opts):
+        return self.remote.changes(**opts)
+
+    def view(self, name, wrapper=None, **options):
+        if name == "_all_docs":
+            rows = self._all_docs(**options)
+        elif name in self.schema.views:
+            rows = self._view(self.schema.views[name], **options)
+        else:
+            rows = None
+        if rows is None:
+            return self.remote.view(name, wrapper, **options)
+        return rows
+
+    def _all_docs(self, keys=None, include_docs=False, **options):
+        if keys is None or options:
+            return None
+        docs = {x["_id"]:x for x in self.store.docs(self.name, "id", keys)}
+        return [ReplicaRow(id=k, key=k, value={"rev" : docs[k].get("_rev", None)} if k in docs else None,
+                           doc=docs.get(k, None) if include_docs else None) for k in keys]
+
+    def _view(self, view, key=None, keys=None, startkey=None, endkey=None, include_docs=False, reduce=None, group=False, group_level=None, **options):
+        """Query a local view. Supports key and keys lookups, range
+        queries of key prefixes and group_level reduction.
+
+        :returns: list of rows, or None for unsupported queries
+        """
+        if options:
+            return None
+        prefix = None
+        if startkey is not None or endkey is not None:
+            prefix = _key_prefix(startkey, endkey)
+            if prefix is None:
+                return None
+        if key is not None:
+            keys = [key]
+        if view.index and keys is not None:
+            docs = self.store.docs(self.name, view.index, set([_index_value(k) for k in keys]))
+        elif view.index and prefix:
+            docs = self.store.docs(self.name, view.index, [_index_value(prefix)])
+        else:
+            docs = self.store.docs(self.name)
+        rows = []
+        for doc in docs:
+            for k, v in view.map_fn(doc):
+                rows.append(ReplicaRow(id=doc["_id"], key=k, value=v, doc=doc if include_docs else None))
+        if keys is not None:
+            rows = [row for k in keys for row in rows if row.key == k]
+        else:
+            if prefix is not None:
+                rows = [row for row in rows if isinstance(row.key, list) and row.key[:len(prefix)] == prefix]
+            rows.sort(key=lambda row: (collate(row.key), row.id))
+        if reduce is None:
+            reduce = view.reduce is not None
+        if not reduce or view.reduce is None:
+            return rows
+        if group:
+            group_level = 999
+        if not group_level:
+            return [ReplicaRow(key=None, value=_reduce(view.reduce, [row.value for row in rows]))]
+        groups = {}
+        order = []
+        for row in rows:
+            k = row.key[:group_level] if isinstance(row.key, list) else row.key
+            gk = collate(k)
+            if not gk in groups:
+                groups[gk] = (k, [])
+                order.append(gk)
+            groups[gk][1].append(row.value)
+        return [ReplicaRow(key=groups[x][0], value=_reduce(view.reduce, groups[x][1])) for x in order]
+
+def _index_value(key):
+    """Get index column value of a view key"""
+    if isinstance(key, list):
+        key = key[0] if key else None
+    return None if key is None else unicode(key)
+
+## Replica stores by path
+_REPLICAS = {}
+
+def get_replica(path, schemas, timeout=SYNC_TIMEOUT):
+    """Get the replica store of a path, creating it if needed.
+
+    :param path: sqlite file
+    :param schemas: dict of database name to ReplicaSchema
+    :param timeout: time budget of a sync in seconds
+    """
+    if not path in _REPLICAS:
+        _REPLICAS[path] = ReplicaStore(path, schemas, timeout)
+    return _REPLICAS[path]
+
+def clear_replicas():
+    """Remove all shared replica stores"""
+    _REPLICAS.clear()
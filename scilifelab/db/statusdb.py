@@ -1,7 +1,125 @@
 """Database backend for connecting to statusdb"""
 import re
-from itertools import izip
-from scilifelab.db import Couch
+import json
+import bisect
+import numpy as np
+from couchdb.http import ResourceNotFound
+from scilifelab.db import Couch, attachment_name, row_id, row_value
+from scilifelab.db.replica import LocalView, ReplicaSchema
+
+## Views for server-side filtering of sample run metrics by flowcell
+## and project. They are added to the 'names' design document of the
+## samples database by pm qc update_views.
+## proj_fc_sample holds the fields used to map project samples to
+## sample run metrics, so that reports need not retrieve documents.
+SAMPLE_VIEWS = {
+    "fc_proj_name" : {"map" : "function(doc) {if (doc.entity_type == 'sample_run_metrics') {emit([doc.flowcell, doc.sample_prj], doc.name);}}"},
+    "proj_name" : {"map" : "function(doc) {if (doc.entity_type == 'sample_run_metrics') {emit(doc.sample_prj, doc.name);}}"},
+    "proj_fc_sample" : {"map" : "function(doc) {if (doc.entity_type == 'sample_run_metrics') {emit([doc.sample_prj, doc.flowcell], {'name' : doc.name, 'barcode_name' : doc.barcode_name, 'date' : doc.date, 'lane' : doc.lane});}}"},
+    }
+
+## Views of flowcell documents, added to the 'names' design document
+## of the flowcells database by pm qc update_views.
+FLOWCELL_VIEWS = {
+    "derived" : {"map" : "function(doc) {if (doc.derived) {emit(doc.name, doc.derived);}}"},
+    }
+
+## Map/reduce views of aggregates used in reports, in the 'reports'
+## design document of each database. Query them with group_level to
+## aggregate by the leading key elements.
+##
+## samples: read counts and average quality keyed by [project,
+## flowcell, lane, barcode name], barcode sequences keyed by
+## [project, sample run metrics name]
+SAMPLE_REPORT_VIEWS = {
+    "read_count" : {"map" : "function(doc) {if (doc.entity_type == 'sample_run_metrics') {var n = parseInt(doc.bc_count, 10); if (!isNaN(n)) {emit([doc.sample_prj, doc.date + '_' + doc.flowcell, doc.lane, doc.barcode_name], n);}}}",
+                    "reduce" : "_sum"},
+    "avg_qv" : {"map" : "function(doc) {if (doc.entity_type == 'sample_run_metrics' && doc.derived && doc.derived.avg_qv != null) {emit([doc.sample_prj, doc.date + '_' + doc.flowcell, doc.lane, doc.barcode_name], doc.derived.avg_qv);}}",
+                "reduce" : "_stats"},
+    "sequence" : {"map" : "function(doc) {if (doc.entity_type == 'sample_run_metrics') {emit([doc.sample_prj, doc.name], doc.sequence);}}"},
+    }
+## flowcells: PhiX error rates keyed by [flowcell, lane]
+FLOWCELL_REPORT_VIEWS = {
+    "phix_error_rate" : {"map" : "function(doc) {if (doc.derived && doc.derived.phix_error_rate) {for (var lane in doc.derived.phix_error_rate) {emit([doc.name, lane], doc.derived.phix_error_rate[lane]);}}}",
+                         "reduce" : "_stats"},
+    }
+## projects: sequenced amounts keyed by [project, sample] and ordered
+## amounts keyed by project
+PROJECT_REPORT_VIEWS = {
+    "sequenced_amount" : {"map" : "function(doc) {if (doc.project_id && doc.samples) {for (var s in doc.samples) {var m = parseFloat(doc.samples[s].m_reads_sequenced); if (!isNaN(m)) {emit([doc.project_id, s], m);}}}}",
+                          "reduce" : "_sum"},
+    "ordered_amount" : {"map" : "function(doc) {if (doc.project_id) {emit(doc.project_id, doc.min_m_reads_per_sample_ordered);}}"},
+    }
+
+## Design documents of statusdb, by database. Increase
+## DESIGN_DOCS_VERSION when changing views; pm qc update_views updates
+## design documents of other versions.
+DESIGN_DOCS_VERSION = 2
+DESIGN_DOCS = {
+    "samples" : {"_design/names" : SAMPLE_VIEWS, "_design/reports" : SAMPLE_REPORT_VIEWS},
+    "flowcells" : {"_design/names" : FLOWCELL_VIEWS, "_design/reports" : FLOWCELL_REPORT_VIEWS},
+    "projects" : {"_design/reports" : PROJECT_REPORT_VIEWS},
+    }
+
+## Python equivalents of the views above, served from a local
+## replica when connections are created with a replica file. Index
+## columns select the documents mapped for key queries.
+def _is_srm(doc):
+    return doc.get("entity_type", None) == "sample_run_metrics"
+
+def _srm_key(doc):
+    return [doc.get("sample_prj", None), "{}_{}".format(doc.get("date", None), doc.get("flowcell", None)), doc.get("lane", None), doc.get("barcode_name", None)]
+
+def _srm_read_count(doc):
+    try:
+        return [(_srm_key(doc), int(doc.get("bc_count", None)))] if _is_srm(doc) else []
+    except (TypeError, ValueError):
+        return []
+
+def _srm_sample(doc):
+    return {"name" : doc.get("name", None), "barcode_name" : doc.get("barcode_name", None), "date" : doc.get("date", None), "lane" : doc.get("lane", None)}
+
+def _float_values(d):
+    res = []
+    for k, v in (d or {}).items():
+        try:
+            res.append((k, float(v)))
+        except (TypeError, ValueError):
+            pass
+    return res
+
+REPLICA_SCHEMAS = {
+    "samples" : ReplicaSchema(
+        {"name" : lambda doc: doc["name"], "flowcell" : lambda doc: doc["flowcell"], "project" : lambda doc: doc["sample_prj"]},
+        {"names/name" : LocalView(lambda doc: [(doc["name"], None)] if _is_srm(doc) else [], "name"),
+         "names/name_fc" : LocalView(lambda doc: [(doc["name"], doc.get("flowcell", None))] if _is_srm(doc) else [], "name"),
+         "names/name_proj" : LocalView(lambda doc: [(doc["name"], doc.get("sample_prj", None))] if _is_srm(doc) else [], "name"),
+         "names/fc_proj_name" : LocalView(lambda doc: [([doc.get("flowcell", None), doc.get("sample_prj", None)], doc.get("name", None))] if _is_srm(doc) else [], "flowcell"),
+         "names/proj_name" : LocalView(lambda doc: [(doc.get("sample_prj", None), doc.get("name", None))] if _is_srm(doc) else [], "project"),
+         "names/proj_fc_sample" : LocalView(lambda doc: [([doc.get("sample_prj", None), doc.get("flowcell", None)], _srm_sample(doc))] if _is_srm(doc) else [], "project"),
+         "reports/read_count" : LocalView(_srm_read_count, "project", "_sum"),
+         "reports/avg_qv" : LocalView(lambda doc: [(_srm_key(doc), doc["derived"]["avg_qv"])] if _is_srm(doc) and (doc.get("derived", None) or {}).get("avg_qv", None) is not None else [], "project", "_stats"),
+         "reports/sequence" : LocalView(lambda doc: [([doc.get("sample_prj", None), doc.get("name", None)], doc.get("sequence", None))] if _is_srm(doc) else [], "project"),
+         }),
+    "flowcells" : ReplicaSchema(
+        {"name" : lambda doc: doc["name"]},
+        {"names/name" : LocalView(lambda doc: [(doc["name"], None)] if "name" in doc else [], "name"),
+         "names/derived" : LocalView(lambda doc: [(doc.get("name", None), doc["derived"])] if doc.get("derived", None) else [], "name"),
+         "reports/phix_error_rate" : LocalView(lambda doc: [([doc.get("name", None), lane], v) for lane, v in _float_values((doc.get("derived", None) or {}).get("phix_error_rate", None))], "name", "_stats"),
+         }),
+    "projects" : ReplicaSchema(
+        {"project" : lambda doc: doc["project_id"]},
+        {"project/project_id" : LocalView(lambda doc: [(doc["project_id"], None)] if doc.get("project_id", None) else [], "project"),
+         "reports/ordered_amount" : LocalView(lambda doc: [(doc["project_id"], doc.get("min_m_reads_per_sample_ordered", None))] if doc.get("project_id", None) else [], "project"),
+         "reports/sequenced_amount" : LocalView(lambda doc: [([doc["project_id"], s], m) for s, m in _float_values(dict((k, v.get("m_reads_sequenced", None)) for k, v in doc["samples"].items()))] if doc.get("project_id", None) and doc.get("samples", None) else [], "project", "_sum"),
+         }),
+    }
+
+def _stats_mean(value):
+    """Get mean of a _stats reduce value"""
+    if not value or not value.get("count", 0):
+        return None
+    return float(value["sum"])/value["count"]
 
 def match_project_name_to_barcode_name(project_sample_name, sample_run_name):
     """Name mapping from project summary sample id to run info sample id"""
@@ -28,6 +146,75 @@ def match_project_name_to_barcode_name(project_sample_name, sample_run_name):
     ## Add cases here
     return False
 
+## Patterns of match_project_name_to_barcode_name for project sample
+## names that don't start with 'P'
+RE_BARCODE_NUMBER = re.compile("(\d+)_?([A-Z])?_")
+RE_BARCODE_INDEX = re.compile("(_index[0-9]+)")
+RE_BARCODE_NAME = re.compile("([A-Za-z0-9\_]+)(\_index[0-9]+)?")
+
+class BarcodeNameIndex(object):
+    """Index of sample run metrics barcode names for matching project
+    sample names, with the semantics of
+    match_project_name_to_barcode_name. Each barcode name is
+    normalised once: for project sample names that don't start with
+    'P', to the leading sample number and to the name without the
+    _index suffix, which are looked up in a dict; for names starting
+    with 'P', which match by prefix, the barcode names are kept sorted
+    and searched by bisection. Barcode names that cannot be
+    normalised, e.g. None, never match.
+
+    :param items: list of (barcode_name, value) tuples
+    """
+    def __init__(self, items):
+        self._values = []
+        self._keys = {}
+        self._names = []
+        for barcode_name, value in items:
+            i = len(self._values)
+            self._values.append(value)
+            if barcode_name is None:
+                continue
+            self._names.append((str(barcode_name), i))
+            for key in self._normalise(barcode_name):
+                self._keys.setdefault(key, set()).add(i)
+        self._names.sort()
+        self._sorted_names = [x[0] for x in self._names]
+
+    def _normalise(self, barcode_name):
+        """Get the names a barcode name matches exactly"""
+        keys = set()
+        m = RE_BARCODE_NUMBER.search(barcode_name)
+        if m:
+            keys.add(str(m.group(1)))
+        m = RE_BARCODE_INDEX.search(barcode_name)
+        m = RE_BARCODE_NAME.search(barcode_name.replace(m.group(1), "") if m else barcode_name)
+        if m:
+            keys.add(str(m.group(1)))
+        return keys
+
+    def _prefix(self, prefix):
+        """Get positions of barcode names starting with prefix"""
+        i = bisect.bisect_left(self._sorted_names, prefix)
+        res = set()
+        while i < len(self._names) and self._sorted_names[i].startswith(prefix):
+            res.add(self._names[i][1])
+            i += 1
+        return res
+
+    def match(self, project_sample_name):
+        """Get the values of barcode names matching a project sample name.
+
+        :param project_sample_name: project sample name
+
+        :returns: list of values, in the order they were added
+        """
+        if not project_sample_name.startswith("P"):
+            res = self._keys.get(str(project_sample_name), set())
+        else:
+            name = str(project_sample_name)
+            res = self._prefix(name) | self._prefix(name.rstrip("F")) | self._prefix(name.rstrip("B"))
+        return [self._values[i] for i in sorted(res)]
+
 def sample_map_fn_id(sample_run_name, prj_sample):
     if 'sample_run_metrics' in prj_sample.keys():
         return prj_sample.get('sample_run_metrics').get(sample_run_name, None)
@@ -45,14 +232,27 @@ def _prune_ps_map(ps_map):
     return ret
 
 class SampleRunMetricsConnection(Couch):
+    replica_schemas = REPLICA_SCHEMAS
+    design_docs = DESIGN_DOCS["samples"]
+    design_docs_version = DESIGN_DOCS_VERSION
+
     ## FIXME: set time limits on which entries to include?
-    def __init__(self, **kwargs):
+    def __init__(self, cache_size=1000, **kwargs):
         super(SampleRunMetricsConnection, self).__init__(**kwargs)
-        self.db = self.con["samples"]
-        self.name_view = {k.key:k.id for k in self.db.view("names/name", reduce=False)}
-        self.name_fc_view = {k.key:k for k in self.db.view("names/name_fc", reduce=False)}
-        self.name_proj_view = {k.key:k for k in self.db.view("names/name_proj", reduce=False)}
-        self.name_fc_proj_view = {k.key:k for k in self.db.view("names/name_fc_proj", reduce=False)}
+        self.db = self.replicated(self.session.db("samples"))
+        self.name_view = self.session.view(self.db, "names/name", value_fn=row_id, cache_size=cache_size, reduce=False)
+        self.name_fc_view = self.session.view(self.db, "names/name_fc", cache_size=cache_size, reduce=False)
+        self.name_proj_view = self.session.view(self.db, "names/name_proj", cache_size=cache_size, reduce=False)
+        self.name_fc_proj_view = self.session.view(self.db, "names/name_fc_proj", cache_size=cache_size, reduce=False)
+        self.fc_proj_name_view = self.session.view(self.db, "names/fc_proj_name", cache_size=0, reduce=False)
+        self.proj_name_view = self.session.view(self.db, "names/proj_name", cache_size=0, reduce=False)
+        self.proj_fc_sample_view = self.session.view(self.db, "names/proj_fc_sample", cache_size=0, reduce=False)
+
+    def _scan_view(self, missing, view, value):
+        """Fallback for databases lacking the views in SAMPLE_VIEWS:
+        scan an entire name view for rows with a given value."""
+        self.log.warn("no such view '{}'; scanning entire view '{}'. Install views with pm qc update_views".format(missing.name, view))
+        return [row.id for row in self.db.view(view, reduce=False) if row.value == value]
 
     def get_entry(self, name, field=None):
         """Retrieve entry from db for a given name, subset to field if
@@ -81,23 +281,44 @@ class SampleRunMetricsConnection(Couch):
         :returns sample_ids: list of couchdb sample ids
         """
         self.log.debug("retrieving sample ids subset by flowcell '{}' and sample_prj '{}'".format(fc_id, sample_prj))
-        sample_ids = [self.name_fc_view[k].id for k in self.name_fc_view.keys() if self.name_fc_view[k].value == fc_id]
-        if sample_prj:
-            prj_sample_ids = [self.name_proj_view[k].id for k in self.name_proj_view.keys() if self.name_proj_view[k].value == sample_prj]
-            sample_ids = list(set(sample_ids).intersection(set(prj_sample_ids)))
-        return sample_ids
+        try:
+            if sample_prj:
+                rows = self.fc_proj_name_view.query(key=[fc_id, sample_prj])
+            else:
+                rows = self.fc_proj_name_view.query(startkey=[fc_id], endkey=[fc_id, {}])
+            return list(set([row.id for row in rows]))
+        except ResourceNotFound:
+            sample_ids = self._scan_view(self.fc_proj_name_view, "names/name_fc", fc_id)
+            if sample_prj:
+                prj_sample_ids = self._scan_view(self.fc_proj_name_view, "names/name_proj", sample_prj)
+                sample_ids = list(set(sample_ids).intersection(set(prj_sample_ids)))
+            return sample_ids
+
+    def get_entries(self, names, fields=None):
+        """Retrieve entries from db for a list of names in bulk.
+
+        :param names: list of unique names
+        :param fields: list of fields to keep in entries
+
+        :returns: dict of name to entry for names present in db
+        """
+        self.log.debug("retrieving entries for {} names".format(len(names)))
+        name_ids = self.name_view.get_many(names)
+        id_names = {v:k for k, v in name_ids.items()}
+        return {id_names[x["_id"]]:x for x in self.get_docs(name_ids.values(), fields=fields)}
 
-    def get_samples(self, fc_id, sample_prj=None):
+    def get_samples(self, fc_id, sample_prj=None, fields=None):
         """Retrieve samples subset by fc_id and possibly sample_prj
 
         :param fc_id: flowcell id
         :param sample_prj: sample project name
+        :param fields: list of fields to keep in samples
 
         :returns samples: list of samples
         """
         self.log.debug("retrieving samples subset by flowcell '{}' and sample_prj '{}'".format(fc_id, sample_prj))
         sample_ids = self.get_sample_ids(fc_id, sample_prj)
-        return [self.db.get(x) for x in sample_ids]
+        return self.get_docs(sample_ids, fields=fields)
 
     def get_project_sample_ids(self, sample_prj):
         """Retrieve sample ids subset by sample_prj
@@ -107,55 +328,141 @@ class SampleRunMetricsConnection(Couch):
         :returns sample_ids: list of couchdb sample ids
         """
         self.log.debug("retrieving sample ids subset by sample_prj '{}'".format(sample_prj))
-        sample_ids = [self.name_proj_view[k].id for k in self.name_proj_view.keys() if self.name_proj_view[k].value == sample_prj]
-        return sample_ids
+        try:
+            return list(set([row.id for row in self.proj_name_view.query(key=sample_prj)]))
+        except ResourceNotFound:
+            return self._scan_view(self.proj_name_view, "names/name_proj", sample_prj)
 
-    def get_project_samples(self, sample_prj):
+    def get_project_samples(self, sample_prj, fields=None):
         """Retrieve samples subset related to a project.
 
         :param sample_prj: sample project name
+        :param fields: list of fields to keep in samples
 
         :returns samples: list of samples
         """
         self.log.debug("retrieving samples subset by sample_prj '{}'".format(sample_prj))
         sample_ids = self.get_project_sample_ids(sample_prj)
-        return [self.db.get(x) for x in sample_ids]
+        return self.get_docs(sample_ids, fields=fields)
         
+    def get_sample_names(self, sample_prj, fc_id=None):
+        """Get the names, barcode names, flowcells, dates and lanes of
+        the sample run metrics of a project, possibly subset by
+        flowcell, from the names/proj_fc_sample view, without
+        retrieving the documents.
+
+        :param sample_prj: sample project name
+        :param fc_id: flowcell id
+
+        :returns: list of dicts with keys _id, name, barcode_name, sample_prj, flowcell, date and lane
+        """
+        try:
+            if fc_id is None:
+                rows = self.proj_fc_sample_view.query(startkey=[sample_prj], endkey=[sample_prj, {}])
+            else:
+                rows = self.proj_fc_sample_view.query(key=[sample_prj, fc_id])
+            return [dict(row.value, _id=row.id, sample_prj=row.key[0], flowcell=row.key[1]) for row in rows]
+        except ResourceNotFound:
+            self.log.warn("no such view 'names/proj_fc_sample'; retrieving documents. Install views with pm qc update_views")
+            fields = ["name", "barcode_name", "sample_prj", "flowcell", "date", "lane"]
+            if fc_id is None:
+                return self.get_project_samples(sample_prj, fields=fields)
+            return self.get_samples(fc_id, sample_prj, fields=fields)
+
     def set_db(self):
         """Make sure we don't change db from samples"""
         pass
 
+    def get_read_counts(self, sample_prj, group_level=4):
+        """Get read counts of a project from the reports/read_count view.
+
+        :param sample_prj: sample project name
+        :param group_level: 1 for the project total, 2 by flowcell, 3
+          by flowcell and lane, 4 by flowcell, lane and barcode name
+
+        :returns: dict of key tuple, without the project, to read
+          count; empty if the view is not installed
+        """
+        try:
+            rows = self.db.view("reports/read_count", startkey=[sample_prj], endkey=[sample_prj, {}], group_level=group_level)
+            return {tuple(row.key[1:]):row.value for row in rows}
+        except ResourceNotFound:
+            self.log.debug("no such view 'reports/read_count'. Install views with pm qc update_views")
+            return {}
+
+    def get_avg_qv(self, sample_prj, group_level=4):
+        """Get mean average quality scores of a project from the
+        reports/avg_qv view.
+
+        :param sample_prj: sample project name
+        :param group_level: see get_read_counts
+
+        :returns: dict of key tuple, without the project, to mean
+          average quality; empty if the view is not installed
+        """
+        try:
+            rows = self.db.view("reports/avg_qv", startkey=[sample_prj], endkey=[sample_prj, {}], group_level=group_level)
+            return {tuple(row.key[1:]):_stats_mean(row.value) for row in rows}
+        except ResourceNotFound:
+            self.log.debug("no such view 'reports/avg_qv'. Install views with pm qc update_views")
+            return {}
+
+    def get_sequences(self, sample_prj):
+        """Get barcode sequences of the samples of a project.
+
+        :param sample_prj: sample project name
+
+        :returns: dict of sample run metrics name to sequence
+        """
+        try:
+            return {row.key[1]:row.value for row in self.db.view("reports/sequence", startkey=[sample_prj], endkey=[sample_prj, {}])}
+        except ResourceNotFound:
+            self.log.warn("no such view 'reports/sequence'; retrieving documents. Install views with pm qc update_views")
+            return {x["name"]:x.get("sequence", None) for x in self.get_project_samples(sample_prj, fields=["name", "sequence"])}
+
     ## FIX ME: operations on sample run metrics objects should be
     ## separated from the connection. Either implement a
     ## sample_run_metrics object (subclassing ViewResults) with this
     ## function or move to utils or similar
-    def calc_avg_qv(self, name):
+    def calc_avg_qv(self, name, srm=None):
         """Calculate average quality score for a sample based on
         FastQC results.
         
         FastQC reports QV results in the field 'Per sequence quality scores', 
         where the subfields 'Count' and 'Quality' refer to the counts of a given quality value.
+        The values are numbers if the metrics were uploaded with typed
+        metrics, and strings otherwise.
         
         :param name: sample name
+        :param srm: sample run metrics entry, if already retrieved
         
         :returns avg_qv: Average quality value score.
         """
-        srm = self.get_entry(name)
+        if srm is None:
+            srm = self.get_entry(name)
+        ## Precomputed at upload
+        if srm.get("derived", {}).get("avg_qv", None) is not None:
+            return srm["derived"]["avg_qv"]
         try:
-            count = [float(x) for x in srm["fastqc"]["stats"]["Per sequence quality scores"]["Count"]]
-            quality = srm["fastqc"]["stats"]["Per sequence quality scores"]["Quality"]
-            return round(sum([x*int(y) for x,y in izip(count, quality)])/sum(count), 1)
+            count = np.asarray(srm["fastqc"]["stats"]["Per sequence quality scores"]["Count"], dtype=np.float64)
+            quality = np.asarray(srm["fastqc"]["stats"]["Per sequence quality scores"]["Quality"], dtype=np.float64)
+            return round(float(np.dot(count, quality)/count.sum()), 1)
         except:
             self.log.warn("Calculation of average quality failed for sample {}, id {}".format(srm["name"], srm["_id"]))
             return None
 
 class FlowcellRunMetricsConnection(Couch):
+    replica_schemas = REPLICA_SCHEMAS
+    design_docs = DESIGN_DOCS["flowcells"]
+    design_docs_version = DESIGN_DOCS_VERSION
+
     def __init__(self, **kwargs):
         super(FlowcellRunMetricsConnection, self).__init__(**kwargs)
         if not self.con:
             return
-        self.db = self.con["flowcells"]
-        self.name_view = {k.key:k.id for k in self.db.view("names/name", reduce=False)}
+        self.db = self.replicated(self.session.db("flowcells"))
+        self.name_view = self.session.view(self.db, "names/name", value_fn=row_id, reduce=False)
+        self.derived_view = self.session.view(self.db, "names/derived", value_fn=row_value, reduce=False)
 
     def set_db(self):
         """Make sure we don't change db from flowcells"""
@@ -174,8 +481,77 @@ class FlowcellRunMetricsConnection(Couch):
         else:
             return self.db.get(self.name_view.get(name))
 
+    def get_part(self, name, part, doc=None):
+        """Get a part of a flowcell document that may be stored as a
+        compressed attachment, e.g. illumina.Demultiplex_Stats. The
+        attachment is only downloaded when requested.
+
+        :param name: flowcell name
+        :param part: dotted path of part in document
+        :param doc: flowcell document, if already retrieved
+
+        :returns: part, or None if it is missing
+        """
+        if doc is None:
+            doc = self.get_entry(name)
+        if doc is None:
+            return None
+        ## Documents saved without attachments hold the part inline
+        value = doc
+        for key in part.split("."):
+            value = value.get(key, None) if isinstance(value, dict) else None
+        if value is not None:
+            return value
+        return self.get_attachment(doc, attachment_name(part))
+
+    def get_demultiplex_stats(self, name, doc=None):
+        """Get the Demultiplex_Stats tables of a flowcell"""
+        return self.get_part(name, "illumina.Demultiplex_Stats", doc)
+
+    def get_samplesheet(self, name, doc=None):
+        """Get the samplesheet of a flowcell as a list of rows"""
+        samplesheet = self.get_part(name, "samplesheet_csv", doc)
+        if not samplesheet:
+            return None
+        return json.loads(samplesheet)
+
+    def get_derived(self, name):
+        """Get the metrics precomputed at upload for a flowcell,
+        without retrieving the document.
+
+        :param name: flowcell name
+
+        :returns: dict, or None if the flowcell has no derived metrics
+          or the derived view is not installed
+        """
+        try:
+            return self.derived_view.get(name, None)
+        except ResourceNotFound:
+            self.log.debug("no such view 'names/derived'. Install views with pm qc update_views")
+            return None
+
+    def get_lane_phix_error_rates(self, name):
+        """Get the mean PhiX error rate of each lane of a flowcell
+        from the reports/phix_error_rate view.
+
+        :param name: flowcell name
+
+        :returns: dict of lane to PhiX error rate; empty if the
+          reports/phix_error_rate view is not installed
+        """
+        try:
+            rows = self.db.view("reports/phix_error_rate", startkey=[name], endkey=[name, {}], group_level=2)
+            return {row.key[1]:_stats_mean(row.value) for row in rows}
+        except ResourceNotFound:
+            self.log.debug("no such view 'reports/phix_error_rate'. Install views with pm qc update_views")
+            return {}
+
     def get_phix_error_rate(self, name, lane, avg=True):
         """Get phix error rate"""
+        if avg:
+            phix = (self.get_derived(name) or {}).get("phix_error_rate", {})
+            if phix.get(str(lane), None) is not None:
+                return phix[str(lane)]
         fc = self.get_entry(name)
         phix_r1 = float(fc['illumina']['Summary']['read1'][lane]['ErrRatePhiX']) 
         phix_r2 = float(fc['illumina']['Summary']['read3'][lane]['ErrRatePhiX'])
@@ -185,12 +561,17 @@ class FlowcellRunMetricsConnection(Couch):
             return (phix_r1, phix_r2)/2
 
 class ProjectSummaryConnection(Couch):
+    replica_schemas = REPLICA_SCHEMAS
+    design_docs = DESIGN_DOCS["projects"]
+    design_docs_version = DESIGN_DOCS_VERSION
+
     def __init__(self, **kwargs):
         super(ProjectSummaryConnection, self).__init__(**kwargs)
         if not self.con:
             return
-        self.db = self.con["projects"]
-        self.name_view = {k.key:k.id for k in self.db.view("project/project_id", reduce=False)}
+        self.db = self.replicated(self.session.db("projects"))
+        self.name_view = self.session.view(self.db, "project/project_id", value_fn=row_id, reduce=False)
+        self.ordered_amount_view = self.session.view(self.db, "reports/ordered_amount", value_fn=row_value)
 
     def get_entry(self, name, field=None):
         """Retrieve entry from db for a given name, subset to field if
@@ -249,11 +630,9 @@ class ProjectSummaryConnection(Couch):
         if project_samples is None:
             return None
         sample_map = {}
-        s_con = SampleRunMetricsConnection(username=self.user, password=self.pw, url=self.url)
-        if fc_id is None:
-            srm_samples = s_con.get_project_samples(project_id)
-        else:
-            srm_samples = s_con.get_samples(fc_id, project_id)
+        s_con = SampleRunMetricsConnection(username=self.user, password=self.pw, url=self.url, port=self.port, replica=self.replica)
+        srm_samples = s_con.get_sample_names(project_id, fc_id)
+        srm_index = BarcodeNameIndex([(s.get("barcode_name", None), s) for s in srm_samples])
         for k, v in project_samples.items():
             sample_map[k] = None
             if check_consistency:
@@ -264,7 +643,7 @@ class ProjectSummaryConnection(Couch):
                 sample_map[k] = _prune_ps_map(ps_map)
             if use_bc_map or not sample_map[k]:
                 if not sample_map[k]: self.log.info("Using barcode map since no information in project summary for sample '{}'".format(k))
-                bc_map = {s["name"]:s["_id"] for s in srm_samples if match_project_name_to_barcode_name(k, s.get("barcode_name", None))}
+                bc_map = {s["name"]:s["_id"] for s in srm_index.match(k)}
                 sample_map[k] = bc_map
             if check_consistency:
                 if ps_map == bc_map:
@@ -282,10 +661,29 @@ class ProjectSummaryConnection(Couch):
 
         :returns: ordered amount of reads if present, None otherwise
         """
-        amount = self.get_entry(project_id, 'min_m_reads_per_sample_ordered')
+        try:
+            amount = self.ordered_amount_view.get(project_id, None)
+        except ResourceNotFound:
+            amount = self.get_entry(project_id, 'min_m_reads_per_sample_ordered')
         self.log.debug("got amount {}".format(amount))
         if not amount:
             return None
         else:
             return round(amount, dec)
 
+    def get_sequenced_amounts(self, project_id):
+        """Get the amount of reads sequenced in millions for each
+        sample of a project from the reports/sequenced_amount view.
+
+        :param project_id: project id
+
+        :returns: dict of project sample name to reads sequenced in
+          millions; empty if the view is not installed
+        """
+        try:
+            rows = self.db.view("reports/sequenced_amount", startkey=[project_id], endkey=[project_id, {}], group_level=2)
+            return {row.key[1]:row.value for row in rows}
+        except ResourceNotFound:
+            self.log.debug("no such view 'reports/sequenced_amount'. Install views with pm qc update_views")
+            return {}
+
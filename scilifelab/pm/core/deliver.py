@@ -42,7 +42,9 @@ class DeliveryReportController(AbstractBaseController):
             (['-q', '--qcinfo'], dict(help="Write qcinfo to console", default=False, action="store_true")),
             (['--check_consistency'], dict(help="Check consistency of project sample name mapping to sample run metrics names", default=False, action="store_true")),
             (['--use_ps_map'], dict(help="Use project summary mapping in cases where no sample_run_metrics is available", default=True, action="store_false")),
-            (['--use_bc_map'], dict(help="Use sample run metrics barcode mapping in cases where no sample_run_metrics is available", default=False, action="store_true"))
+            (['--use_bc_map'], dict(help="Use sample run metrics barcode mapping in cases where no sample_run_metrics is available", default=False, action="store_true")),
+            (['--replica'], dict(help="Read statusdb through a local replica file, synced from the server before use", default=None, action="store", type=str)),
+            (['--workers'], dict(help="Number of processes building sample notes", default=1, action="store", type=int))
             ]
 
     def _process_args(self):
@@ -74,7 +76,7 @@ class DeliveryReportController(AbstractBaseController):
             }
         ## key mapping from sample_run_metrics to parameter keys
         srm_to_parameter = {"project_name":"sample_prj", "FC_id":"flowcell", 
-                            "scilifelab_name":"barcode_name", "start_date":"date", "rounded_read_count":"bc_count"}
+                            "scilifelab_name":"barcode_name", "start_date":"date"}
 
         self.log.debug("got parameters {}".format(parameters))
         ## Write qcinfo if needed
@@ -83,34 +85,57 @@ class DeliveryReportController(AbstractBaseController):
             self.app._output_data["stdout"].write("Scilifelab ID\tPhiXError\tAvgQV\n")
 
         ## Connect and run
-        s_con = SampleRunMetricsConnection(username=self.pargs.user, password=self.pargs.password, url=self.pargs.url)
-        fc_con = FlowcellRunMetricsConnection(username=self.pargs.user, password=self.pargs.password, url=self.pargs.url)
-        p_con = ProjectSummaryConnection(username=self.pargs.user, password=self.pargs.password, url=self.pargs.url)
-        paragraphs = sample_note_paragraphs()
-        headers = sample_note_headers()
+        s_con = SampleRunMetricsConnection(username=self.pargs.user, password=self.pargs.password, url=self.pargs.url, replica=self.pargs.replica)
+        fc_con = FlowcellRunMetricsConnection(username=self.pargs.user, password=self.pargs.password, url=self.pargs.url, replica=self.pargs.replica)
+        p_con = ProjectSummaryConnection(username=self.pargs.user, password=self.pargs.password, url=self.pargs.url, replica=self.pargs.replica)
         project = p_con.get_entry(self.pargs.project_id)
 
         if not project:
             self.log.warn("No such project '{}'".format(self.pargs.project_id))
             return
         samples = p_con.map_srm_to_name(self.pargs.project_id, include_all=False, fc_id=self.pargs.flowcell_id, use_ps_map=self.pargs.use_ps_map, use_bc_map=self.pargs.use_bc_map, check_consistency=self.pargs.check_consistency)
+        ## Sample run metrics of the project, with read counts and
+        ## average quality scores keyed by flowcell, lane and barcode name
+        srm_samples = {x["name"]:x for x in s_con.get_sample_names(self.pargs.project_id)}
+        srm_keys = {k:("{}_{}".format(x["date"], x["flowcell"]), x["lane"], x["barcode_name"]) for k, x in srm_samples.items()}
+        read_counts = s_con.get_read_counts(self.pargs.project_id)
+        avg_qvs = s_con.get_avg_qv(self.pargs.project_id)
+        ## Documents are only retrieved for samples missing from the
+        ## report views, e.g. metrics uploaded without derived values
+        srm_entries = s_con.get_entries([k for k in samples.keys() if k in srm_samples and srm_samples[k]["flowcell"] == self.pargs.flowcell_id and
+                                         not (srm_keys[k] in read_counts and srm_keys[k] in avg_qvs)])
+        ## PhiX error rates by flowcell and lane, retrieved once per flowcell
+        phix_error_rates = {}
+        notes = []
         for k,v  in samples.items():
             s_param = {}
             self.log.debug("working on sample '{}', sample run metrics name '{}', id '{}'".format(v["sample"], k, v["id"]))
             s_param.update(parameters)
+            s = srm_samples.get(k, None)
             if not v['id'] is None:
-                if not s_con.name_fc_view[k].value == self.pargs.flowcell_id:
+                if s is not None and not s["flowcell"] == self.pargs.flowcell_id:
                     self.log.debug("skipping sample '{}' since it isn't run on flowcell {}".format(k, self.pargs.flowcell_id))
                     continue
             else:
                 if re.search("NOSRM", k):
                     self.log.warn("No sample run metrics information for project sample '{}'".format(k.strip("NOSRM_")))
                     continue
-            s = s_con.get_entry(k)
+            if s is None:
+                self.log.warn("no sample run metrics entry for '{}'".format(k))
+                continue
             s_param.update({key:s[srm_to_parameter[key]] for key in srm_to_parameter.keys()})
             fc = "{}_{}".format(s["date"], s["flowcell"])
-            s_param["phix_error_rate"] = fc_con.get_phix_error_rate(str(fc), s["lane"])
-            s_param['avg_quality_score'] = s_con.calc_avg_qv(s["name"])
+            if not fc in phix_error_rates:
+                phix_error_rates[fc] = fc_con.get_lane_phix_error_rates(fc)
+            if phix_error_rates[fc].get(str(s["lane"]), None) is None:
+                phix_error_rates[fc][str(s["lane"])] = fc_con.get_phix_error_rate(str(fc), s["lane"])
+            s_param["phix_error_rate"] = phix_error_rates[fc][str(s["lane"])]
+            if k in srm_entries:
+                s_param['rounded_read_count'] = srm_entries[k]["bc_count"]
+                s_param['avg_quality_score'] = s_con.calc_avg_qv(k, srm=srm_entries[k])
+            else:
+                s_param['rounded_read_count'] = read_counts.get(srm_keys[k], None)
+                s_param['avg_quality_score'] = avg_qvs.get(srm_keys[k], None)
             if self.pargs.qcinfo:
                 self.app._output_data["stdout"].write("{}\t{}\t{}\n".format(s["barcode_name"], s_param["phix_error_rate"], s_param["avg_quality_score"]))
             s_param['rounded_read_count'] = round(float(s_param['rounded_read_count'])/1e6,1) if s_param['rounded_read_count'] else None
@@ -126,7 +151,8 @@ class DeliveryReportController(AbstractBaseController):
             s_param['customer_name'] = project['samples'].get(v["sample"], {}).get("customer_name", None)
             s_param['success'] = sequencing_success(s_param, cutoffs)
             s_param.update({k:"N/A" for k in s_param.keys() if s_param[k] is None})
-            make_note("{}_{}_{}.pdf".format(s["barcode_name"], s["date"], s["flowcell"]), headers, paragraphs, **s_param)
+            notes.append(("{}_{}_{}.pdf".format(s["barcode_name"], s["date"], s["flowcell"]), s_param))
+        make_notes(notes, sample_note_headers, sample_note_paragraphs, workers=self.pargs.workers)
 
     @controller.expose(help="Make project status note")
     def project_status(self):
@@ -144,9 +170,9 @@ class DeliveryReportController(AbstractBaseController):
         prjs_to_table = {'ScilifeID':'scilife_name', 'CustomerID':'customer_name', 'MSequenced':'m_reads_sequenced'}#, 'MOrdered':'min_m_reads_per_sample_ordered', 'Status':'status'}
         
         ## Connect and run
-        s_con = SampleRunMetricsConnection(username=self.pargs.user, password=self.pargs.password, url=self.pargs.url)
-        fc_con = FlowcellRunMetricsConnection(username=self.pargs.user, password=self.pargs.password, url=self.pargs.url)
-        p_con = ProjectSummaryConnection(username=self.pargs.user, password=self.pargs.password, url=self.pargs.url)
+        s_con = SampleRunMetricsConnection(username=self.pargs.user, password=self.pargs.password, url=self.pargs.url, replica=self.pargs.replica)
+        fc_con = FlowcellRunMetricsConnection(username=self.pargs.user, password=self.pargs.password, url=self.pargs.url, replica=self.pargs.replica)
+        p_con = ProjectSummaryConnection(username=self.pargs.user, password=self.pargs.password, url=self.pargs.url, replica=self.pargs.replica)
         paragraphs = project_note_paragraphs()
         headers = project_note_headers()
         param = parameters
@@ -158,6 +184,8 @@ class DeliveryReportController(AbstractBaseController):
         self.log.debug("Working on project '{}'.".format(self.pargs.project_id))
         samples = p_con.map_srm_to_name(self.pargs.project_id, use_ps_map=self.pargs.use_ps_map, use_bc_map=self.pargs.use_bc_map, check_consistency=self.pargs.check_consistency)
         sample_list = project['samples']
+        srm_sequences = s_con.get_sequences(self.pargs.project_id)
+        sequenced_amounts = p_con.get_sequenced_amounts(self.pargs.project_id)
         param.update({key:project.get(ps_to_parameter[key], None) for key in ps_to_parameter.keys()})
         param["ordered_amount"] = param.get("ordered_amount", p_con.get_ordered_amount(self.pargs.project_id))
         param['customer_reference'] = param.get('customer_reference', project.get('customer_reference'))
@@ -180,10 +208,11 @@ class DeliveryReportController(AbstractBaseController):
                 continue
             project_sample = sample_list[v['sample']]
             vals = {x:project_sample.get(prjs_to_table[x], None) for x in prjs_to_table.keys()}
+            vals['MSequenced'] = sequenced_amounts.get(v['sample'], vals['MSequenced'])
             ## Set status
             vals['Status'] = project_sample.get("status", "N/A")
             vals['MOrdered'] = param["ordered_amount"]
-            vals['BarcodeSeq'] = s_con.get_entry(k, "sequence")
+            vals['BarcodeSeq'] = srm_sequences.get(k, None)
             vals.update({k:"N/A" for k in vals.keys() if vals[k] is None})
             if vals['Status']=="N/A" or vals['Status']=="NP": all_passed = False
             sample_table.append([vals[k] for k in table_keys])
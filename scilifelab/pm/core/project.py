@@ -2,11 +2,11 @@
 import os
 import sys
 import re
-import yaml
 
 from cement.core import controller, hook
 from scilifelab.pm.core.controller import AbstractExtendedBaseController, AbstractBaseController
 from scilifelab.utils.misc import query_yes_no, filtered_walk, walk
+from scilifelab.utils.yaml_io import load_run_info, dump as yaml_dump
 
 ## Main project controller
 class ProjectController(AbstractExtendedBaseController):
@@ -216,8 +216,7 @@ class BcbioRunController(AbstractBaseController):
         if len(flist) > 0 and not query_yes_no("Going to start {} jobs... Are you sure you want to continue?".format(len(flist)), force=self.pargs.force):
             return
         for f in flist:
-            with open(f) as fh:
-                config = yaml.load(fh)
+            config = load_run_info(f)
             if self.pargs.analysis_type:
                 config["details"][0]["multiplex"][0]["analysis"] = self.pargs.analysis_type
                 config["details"][0]["analysis"] = self.pargs.analysis_type
@@ -231,7 +230,7 @@ class BcbioRunController(AbstractBaseController):
                 else:
                     config["details"][0]["multiplex"][0]["files"] = ["{}.gz".format(x) for x in config["details"][0]["multiplex"][0]["files"]]
             config_file = f.replace("-bcbb-config.yaml", "-pm-bcbb-analysis-config.yaml")
-            self.app.cmd.write(config_file, yaml.dump(config))
+            self.app.cmd.write(config_file, yaml_dump(config))
             ## Run automated_initial_analysis.py
             cur_dir = os.getcwd()
             new_dir = os.path.abspath(os.path.dirname(f))
@@ -2,12 +2,11 @@
 
 import os
 import sys
-import couchdb
 
 from cement.core import backend, handler, hook
 
 from scilifelab.pm.core import command
-from scilifelab.utils.http import check_url
+from scilifelab.db import get_session, update_design_doc
 from scilifelab.utils.timestamp import utc_time
 
 LOG = backend.minimal_logger(__name__)
@@ -49,10 +48,11 @@ class CouchdbCommandHandler(command.CommandHandler):
     def connect(self, url, port="5984"):
         def runpipe():
             self._meta.url="http://{}:{}".format(url,port)
-            if not check_url(self._meta.url):
+            session = get_session(self._meta.url)
+            if not session:
                 self.app.log.warn("Connecting to server at {} failed. No such url." % self._meta.url)
                 return
-            self._meta.conn = couchdb.Server(url=self._meta.url)
+            self._meta.conn = session.server
             self.app.log.info("Connecting to server at {} succeeded".format(self._meta.url))
         return self.dry("Connecting to database @{}:{}".format(url, port), runpipe)
 
@@ -95,6 +95,60 @@ class CouchdbCommandHandler(command.CommandHandler):
                     self.app.log.info("Object {} with id {} present and not in need of updating".format(repr(obj), obj["_id"]))
         return self.dry("Saving object {}".format(repr(obj)), runpipe)
 
+    def bulk_save(self, dbname, objs, update_fn=None, batch_size=500):
+        """Save/update database objects <objs> in database <dbname>
+        using batched _bulk_docs requests. If <update_fn> is passed,
+        only the objects it returns are saved.
+
+        :param dbname: database name
+        :param objs: list of database objects to save
+        :param update_fn: function that operates on database and list of objects and returns the objects in need of saving
+        :param batch_size: number of documents per _bulk_docs request
+
+        :returns: list of (success, docid, rev_or_exc) tuples, one per saved object
+        """
+        def runpipe():
+            db = self.db(dbname)
+            if not update_fn:
+                new_objs = objs
+            else:
+                new_objs = update_fn(db, objs)
+                self.app.log.info("{} of {} objects in need of updating".format(len(new_objs), len(objs)))
+            results = []
+            for i in range(0, len(new_objs), batch_size):
+                batch = new_objs[i:i + batch_size]
+                results.extend(db.update(batch))
+            for (success, docid, rev_or_exc), obj in zip(results, new_objs):
+                if success:
+                    self.app.log.info("Saving object {} with id {}".format(repr(obj), docid))
+                else:
+                    self.app.log.warn("Saving object {} with id {} failed: {}".format(repr(obj), docid, rev_or_exc))
+            return results
+        return self.dry("Saving {} objects in database {}".format(len(objs), dbname), runpipe)
+
+    def update_design_docs(self, design_docs, version=None):
+        """Add or update design documents.
+
+        :param design_docs: dict of database name to dict of design document id to views
+        :param version: version number stored in the design documents
+
+        :returns: list of (database name, design document id) tuples of updated design documents
+        """
+        def runpipe():
+            updated = []
+            for dbname, docs in design_docs.items():
+                db = self.db(dbname)
+                if not db:
+                    continue
+                for design, views in docs.items():
+                    if update_design_doc(db, design, views, version):
+                        self.app.log.info("Updated design document {} in database {}".format(design, dbname))
+                        updated.append((dbname, design))
+                    else:
+                        self.app.log.info("Design document {} in database {} is up to date".format(design, dbname))
+            return updated
+        return self.dry("Updating design documents in databases {}".format(", ".join(design_docs.keys())), runpipe)
+
     def get_view(self, dbname, design, name):
         """Get view from a database <dbname> with design document <design>, named <name>
 
@@ -2,17 +2,21 @@
 import os
 import re
 import csv
-import yaml
 import couchdb
 from datetime import datetime
 import time
+import multiprocessing
 from scilifelab.utils.timestamp import utc_time
 
 from cement.core import backend, controller, handler, hook
 from scilifelab.pm.core.controller import AbstractBaseController
 from scilifelab.utils.timestamp import modified_within_days
+from scilifelab.utils.manifest import FileManifest
+from scilifelab.utils.yaml_io import load_run_info
+from scilifelab.db import attachment_digest
+from scilifelab.db.statusdb import DESIGN_DOCS, DESIGN_DOCS_VERSION
 
-from scilifelab.bcbio.qc import FlowcellRunMetrics, SampleRunMetrics
+from scilifelab.bcbio.qc import FlowcellRunMetrics, SampleRunMetrics, RunMetrics, RunMetricsFileIndex
 
 class RunMetricsController(AbstractBaseController):
     """
@@ -31,6 +35,13 @@ class RunMetricsController(AbstractBaseController):
             (['--project'], dict(help="Project id", default=None, action="store", type=str)),
             (['--sample'], dict(help="Sample id", default=None, action="store", type=str)),
             (['--mtime'], dict(help="Last modification time of directory (days): skip if older. Defaults to 1 day.", default=1, action="store", type=int)),
+            (['--workers'], dict(help="Number of worker processes used for parsing qc data. Defaults to 1.", default=1, action="store", type=int)),
+            (['--incremental'], dict(help="Only parse and upload flowcells and samples whose metrics files have changed since the last upload, as recorded in a manifest. Overrides --mtime.", default=False, action="store_true")),
+            (['--manifest_dir'], dict(help="Directory for incremental upload manifests. Defaults to ~/.pm/qc_manifest", default=os.path.join(os.path.expanduser("~"), ".pm", "qc_manifest"), action="store", type=str)),
+            (['--hash'], dict(help="In incremental mode, compare md5 sums of files whose modification time has changed", default=False, action="store_true")),
+            (['--fullRTA'], dict(help="Parse and upload per tile and cycle RTA charts", default=False, action="store_true")),
+            (['--attachments'], dict(help="Store RTA charts, Demultiplex_Stats and the samplesheet of flowcells as compressed attachments", default=False, action="store_true")),
+            (['--typed_metrics'], dict(help="Store picard and FastQC metrics as numbers instead of strings", default=False, action="store_true")),
             ]
 
     @controller.expose(hide=True)
@@ -61,28 +72,23 @@ class RunMetricsController(AbstractBaseController):
     ## New structures
     ##############################
     def _collect_pre_casava_qc(self):
-        qc_objects = []
         runinfo_yaml = os.path.join(os.path.abspath(self.pargs.flowcell), "run_info.yaml")
         try:
-            with open(runinfo_yaml) as fh:
-                runinfo = yaml.load(fh)
-        except IOError as e:
+            runinfo = load_run_info(runinfo_yaml)
+        except (IOError, OSError) as e:
             self.app.log.warn(str(e))
             raise e
         fcdir = os.path.abspath(self.pargs.flowcell)
         (fc_date, fc_name) = self._fc_parts()
         ## Check modification time
-        if modified_within_days(fcdir, self.pargs.mtime):
-            fc_kw = dict(path=fcdir, fc_date = fc_date, fc_name=fc_name)
-            fcobj = FlowcellRunMetrics(**fc_kw)
-            fcobj.parse_illumina_metrics(fullRTA=False)
-            fcobj.parse_bc_metrics()
-            fcobj.parse_filter_metrics()
-            if not fcobj.parse_samplesheet_csv():
-                fcobj.parse_run_info_yaml()
-            qc_objects.append(fcobj)
-        else:
-            return qc_objects
+        if self._manifest is None and not modified_within_days(fcdir, self.pargs.mtime):
+            return []
+        ## Flowcell and samples share the same directory so index it once
+        file_index = RunMetricsFileIndex(fcdir, ignore=RunMetrics.reignore)
+        fc_kw = dict(path=fcdir, fc_date = fc_date, fc_name=fc_name, file_index=file_index)
+        if not self._changed(fc_kw, file_index.flowcell_files()):
+            fc_kw = None
+        sample_kws = []
         for info in runinfo:
             if not info.get("multiplex", None):
                 self.app.log.warn("No multiplex information for lane {}".format(info.get("lane")))
@@ -92,17 +98,13 @@ class RunMetricsController(AbstractBaseController):
             for sample in info["multiplex"]:
                 sample.update({k: info.get(k, None) for k in ('analysis', 'description', 'flowcell_id', 'lane')})
                 sample_kw = dict(path=fcdir, flowcell=fc_name, date=fc_date, lane=sample['lane'], barcode_name=sample['name'], sample_prj=sample.get('sample_prj', None),
-                                 barcode_id=sample['barcode_id'], sequence=sample.get('sequence', "NoIndex"))
-                obj = SampleRunMetrics(**sample_kw)
-                obj.read_picard_metrics()
-                obj.parse_fastq_screen()
-                obj.parse_bc_metrics()
-                obj.read_fastqc_metrics()
-                qc_objects.append(obj)
-        return qc_objects
+                                 barcode_id=sample['barcode_id'], sequence=sample.get('sequence', "NoIndex"), file_index=file_index)
+                if not self._changed(sample_kw, file_index.sample_files(sample_kw['lane'], sample_kw['barcode_id'])):
+                    continue
+                sample_kws.append(sample_kw)
+        return self._parse_qc_objects(fc_kw, sample_kws, casava=False)
 
     def _collect_casava_qc(self):
-        qc_objects = []
         runinfo_csv = os.path.join(os.path.abspath(self.pargs.flowcell), "{}.csv".format(self._fc_id()))
         try:
             with open(runinfo_csv) as fh:
@@ -114,15 +116,15 @@ class RunMetricsController(AbstractBaseController):
         fcdir = os.path.join(os.path.abspath(self.pargs.analysis), self.pargs.flowcell)
         (fc_date, fc_name) = self._fc_parts()
         ## Check modification time
-        if modified_within_days(fcdir, self.pargs.mtime):
+        fc_kw = None
+        if self._manifest is not None:
+            fc_kw = dict(path=fcdir, fc_date = fc_date, fc_name=fc_name, file_index=RunMetricsFileIndex(fcdir, ignore=RunMetrics.reignore))
+            if not self._changed(fc_kw, fc_kw['file_index'].flowcell_files()):
+                fc_kw = None
+        elif modified_within_days(fcdir, self.pargs.mtime):
             fc_kw = dict(path=fcdir, fc_date = fc_date, fc_name=fc_name)
-            fcobj = FlowcellRunMetrics(**fc_kw)
-            fcobj.parse_illumina_metrics(fullRTA=False)
-            fcobj.parse_bc_metrics()
-            fcobj.parse_demultiplex_stats_htm()
-            fcobj.parse_samplesheet_csv()
-            qc_objects.append(fcobj)
 
+        sample_kws = []
         for sample in runinfo[1:]:
             d = dict(zip(runinfo[0], sample))
             if self.app.pargs.project and self.app.pargs.project != d['SampleProject']:
@@ -138,24 +140,72 @@ class RunMetricsController(AbstractBaseController):
             if not os.path.exists(sample_fcdir):
                 self.app.log.warn("No such sample flowcell directory: {}".format(sample_fcdir))
                 continue
-            if not modified_within_days(sample_fcdir, self.pargs.mtime):
+            if self._manifest is None and not modified_within_days(sample_fcdir, self.pargs.mtime):
                 continue
             runinfo_yaml_file = os.path.join(sample_fcdir, "{}-bcbb-config.yaml".format(d['SampleID']))
             if not os.path.exists(runinfo_yaml_file):
                 self.app.log.warn("No such yaml file for sample: {}".format(runinfo_yaml_file))
                 raise IOError(2, "No such yaml file for sample: {}".format(runinfo_yaml_file), runinfo_yaml_file)
-            with open(runinfo_yaml_file) as fh:
-                runinfo_yaml = yaml.load(fh)
+            runinfo_yaml = load_run_info(runinfo_yaml_file)
             if not runinfo_yaml['details'][0].get("multiplex", None):
                 self.app.log.warn("No multiplex information for sample {}".format(d['SampleID']))
                 continue
             sample_kw = dict(path=sample_fcdir, flowcell=fc_name, date=fc_date, lane=d['Lane'], barcode_name=d['SampleID'], sample_prj=d['SampleProject'].replace("__", "."), barcode_id=runinfo_yaml['details'][0]['multiplex'][0]['barcode_id'], sequence=runinfo_yaml['details'][0]['multiplex'][0]['sequence'])
-            obj = SampleRunMetrics(**sample_kw)
-            obj.read_picard_metrics()
-            obj.parse_fastq_screen()
-            obj.parse_bc_metrics()
-            obj.read_fastqc_metrics()
-            qc_objects.append(obj)
+            if self._manifest is not None:
+                sample_kw['file_index'] = RunMetricsFileIndex(sample_fcdir, ignore=RunMetrics.reignore)
+                if not self._changed(sample_kw, sample_kw['file_index'].sample_files(sample_kw['lane'], sample_kw['barcode_id'])):
+                    continue
+            sample_kws.append(sample_kw)
+        return self._parse_qc_objects(fc_kw, sample_kws, casava=True)
+
+    def _changed(self, kw, files):
+        """In incremental mode, check whether the metrics files of a
+        flowcell or sample have changed since the last upload.
+
+        :param kw: keyword arguments for FlowcellRunMetrics or SampleRunMetrics
+        :param files: metrics files
+
+        :returns: boolean; always True if not in incremental mode
+        """
+        if self._manifest is None:
+            return True
+        group = manifest_group(kw)
+        if self._manifest.changed(group, files):
+            return True
+        ## Store refreshed fingerprints, e.g. new modification times of
+        ## touched but unmodified files, so they aren't hashed again
+        self._manifest.commit([group])
+        self.log.debug("No changed files for {}; skipping".format(group))
+        return False
+
+    def _parse_qc_objects(self, fc_kw, sample_kws, casava=True):
+        """Parse flowcell and sample run metrics, possibly in a pool of
+        worker processes.
+
+        :param fc_kw: keyword arguments for FlowcellRunMetrics; None if flowcell should be skipped
+        :param sample_kws: list of keyword arguments for SampleRunMetrics
+        :param casava: parse flowcell as casava run
+
+        :returns: list of qc objects
+        """
+        if self.pargs.workers <= 1:
+            qc_objects = [parse_sample_run_metrics(kw, self.pargs.typed_metrics) for kw in sample_kws]
+            if fc_kw:
+                qc_objects.insert(0, parse_flowcell_run_metrics(fc_kw, casava, self.pargs.fullRTA, self.pargs.attachments))
+            return qc_objects
+        self.log.info("Parsing qc data for {} samples using {} workers".format(len(sample_kws), self.pargs.workers))
+        pool = multiprocessing.Pool(self.pargs.workers)
+        try:
+            fc_result = None
+            if fc_kw:
+                fc_result = pool.apply_async(parse_flowcell_run_metrics, (fc_kw, casava, self.pargs.fullRTA, self.pargs.attachments))
+            results = [pool.apply_async(parse_sample_run_metrics, (kw, self.pargs.typed_metrics)) for kw in sample_kws]
+            qc_objects = [x.get() for x in results]
+            if fc_result:
+                qc_objects.insert(0, fc_result.get())
+        finally:
+            pool.close()
+            pool.join()
         return qc_objects
 
     @controller.expose(help="Upload run metrics to statusdb")
@@ -165,6 +215,9 @@ class RunMetricsController(AbstractBaseController):
         runinfo_csv = os.path.join(os.path.abspath(self.pargs.flowcell), "{}.csv".format(self._fc_id()))
         runinfo_yaml = os.path.join(os.path.abspath(self.pargs.flowcell), "run_info.yaml")
         (fc_date, fc_name) = self._fc_parts()
+        self._manifest = None
+        if self.pargs.incremental:
+            self._manifest = FileManifest(os.path.join(self.pargs.manifest_dir, "{}.json".format(self._fc_fullname())), content_hash=self.pargs.hash)
         if int(fc_date) < 120815:
             self.log.info("Assuming pre-casava based file structure for {}".format(self._fc_id()))
             qc_objects = self._collect_pre_casava_qc()
@@ -174,6 +227,7 @@ class RunMetricsController(AbstractBaseController):
 
         if len(qc_objects) == 0:
             self.log.info("No out-of-date qc objects for {}".format(self._fc_id()))
+            self._save_manifest(qc_objects, [])
             return
         else:
             self.log.info("Retrieved {} updated qc objects".format(len(qc_objects)))
@@ -183,37 +237,109 @@ class RunMetricsController(AbstractBaseController):
             self.app._meta.cmd_handler = 'couchdb'
             self.app._setup_cmd_handler()
         self.app.cmd.connect(self.pargs.url, self.pargs.port)
-        for obj in qc_objects:
-            if self.app.pargs.debug:
+        if self.app.pargs.debug:
+            for obj in qc_objects:
                 self.log.debug("{}: {}".format(str(obj), obj["_id"]))
-                continue
-            if isinstance(obj, FlowcellRunMetrics):
-                self.app.cmd.save("flowcells", obj, update_fn)
-            if isinstance(obj, SampleRunMetrics):
-                self.app.cmd.save("samples", obj, update_fn)
+            return
+        fc_results = self.app.cmd.bulk_save("flowcells", [x for x in qc_objects if isinstance(x, FlowcellRunMetrics)], bulk_update_fn)
+        sample_results = self.app.cmd.bulk_save("samples", [x for x in qc_objects if isinstance(x, SampleRunMetrics)], bulk_update_fn)
+        ## Nothing is saved in dry runs
+        if fc_results is not None and sample_results is not None:
+            self._save_manifest(qc_objects, fc_results + sample_results)
 
-def update_fn(db, obj):
-    t_utc = utc_time()
-    def equal(a, b):
-        a_keys = [str(x) for x in a.keys() if x not in ["_id", "_rev", "creation_time", "modification_time"]]
-        b_keys = [str(x) for x in b.keys() if x not in ["_id", "_rev", "creation_time", "modification_time"]]
-        keys = list(set(a_keys + b_keys))
-        return {k:a.get(k, None) for k in keys} == {k:b.get(k, None) for k in keys}
+    @controller.expose(help="Install or update the statusdb design documents used by reports")
+    def update_views(self):
+        if not self._check_pargs(['url']):
+            return
+        if not '--couchdb' in self.app._meta.argv:
+            self.app._meta.cmd_handler = 'couchdb'
+            self.app._setup_cmd_handler()
+        self.app.cmd.connect(self.pargs.url, self.pargs.port)
+        self.app.cmd.update_design_docs(DESIGN_DOCS, DESIGN_DOCS_VERSION)
 
-    if isinstance(obj, FlowcellRunMetrics):
-        view = db.view("names/id_to_name")
-    if isinstance(obj, SampleRunMetrics):
-        view = db.view("names/id_to_name")
+    def _save_manifest(self, qc_objects, results):
+        """Record the fingerprints of uploaded objects in the manifest.
+        Objects that failed to parse or save are checked again on the
+        next run.
 
-    d_view = {k.value:k for k in view}
-    dbid =  d_view.get(obj["name"], None)
-    dbobj = None
-    if dbid:
-        dbobj = db.get(dbid.id, None)
+        :param qc_objects: parsed qc objects
+        :param results: bulk_save results
+        """
+        if self._manifest is None:
+            return
+        failed = set([docid for success, docid, rev_or_exc in results if not success])
+        self._manifest.commit([x["name"] for x in qc_objects if x["_id"] not in failed])
+        self._manifest.save()
+        self.log.info("Saved manifest {}".format(self._manifest.path))
+
+def manifest_group(kw):
+    """Get the manifest group of a flowcell or sample, which is the name
+    of the corresponding FlowcellRunMetrics or SampleRunMetrics object.
+
+    :param kw: keyword arguments for FlowcellRunMetrics or SampleRunMetrics
+    """
+    if "fc_name" in kw:
+        return "{}_{}".format(kw["fc_date"], kw["fc_name"])
+    return "{}_{}_{}_{}".format(kw["lane"], kw["date"], kw["flowcell"], kw.get("sequence", "NoIndex"))
+
+def parse_flowcell_run_metrics(fc_kw, casava=True, fullRTA=False, attachments=False):
+    """Create and parse a FlowcellRunMetrics object.
+
+    :param fc_kw: keyword arguments for FlowcellRunMetrics
+    :param casava: parse casava output (Demultiplex_Stats.htm)
+    :param fullRTA: parse per tile and cycle RTA charts
+    :param attachments: store bulky parts as compressed attachments
+
+    :returns: FlowcellRunMetrics object
+    """
+    fcobj = FlowcellRunMetrics(**fc_kw)
+    fcobj.parse_illumina_metrics(fullRTA=fullRTA)
+    fcobj.parse_bc_metrics()
+    if casava:
+        fcobj.parse_demultiplex_stats_htm()
+        fcobj.parse_samplesheet_csv()
+    else:
+        fcobj.parse_filter_metrics()
+        if not fcobj.parse_samplesheet_csv():
+            fcobj.parse_run_info_yaml()
+    fcobj.calc_derived_metrics()
+    if attachments:
+        fcobj.split_attachments()
+    return fcobj
+
+def parse_sample_run_metrics(sample_kw, typed_metrics=False):
+    """Create and parse a SampleRunMetrics object.
+
+    :param sample_kw: keyword arguments for SampleRunMetrics
+    :param typed_metrics: store picard and FastQC metrics as numbers instead of strings
+
+    :returns: SampleRunMetrics object
+    """
+    obj = SampleRunMetrics(**sample_kw)
+    obj.read_picard_metrics(typed=typed_metrics)
+    obj.parse_fastq_screen()
+    obj.parse_bc_metrics()
+    obj.read_fastqc_metrics(typed=typed_metrics)
+    obj.calc_derived_metrics()
+    return obj
+
+def _equal(a, b):
+    """Compare objects, ignoring id, revision and time stamps.
+    Attachments are compared by digest."""
+    a_keys = [str(x) for x in a.keys() if x not in ["_id", "_rev", "creation_time", "modification_time", "_attachments"]]
+    b_keys = [str(x) for x in b.keys() if x not in ["_id", "_rev", "creation_time", "modification_time", "_attachments"]]
+    keys = list(set(a_keys + b_keys))
+    if {k:attachment_digest(v) for k, v in a.get("_attachments", {}).items()} != {k:attachment_digest(v) for k, v in b.get("_attachments", {}).items()}:
+        return False
+    return {k:a.get(k, None) for k in keys} == {k:b.get(k, None) for k in keys}
+
+def _update_obj(obj, dbobj, t_utc):
+    """Prepare obj for saving given the corresponding database object
+    dbobj. Returns None if obj doesn't need updating."""
     if dbobj is None:
         obj["creation_time"] = t_utc
         return obj
-    if equal(obj, dbobj):
+    if _equal(obj, dbobj):
         return None
     else:
         obj["creation_time"] = dbobj.get("creation_time")
@@ -222,6 +348,38 @@ def update_fn(db, obj):
         obj["_id"] = dbobj.get("_id")
         return obj
 
+def update_fn(db, obj):
+    t_utc = utc_time()
+    view = db.view("names/id_to_name")
+    d_view = {k.value:k for k in view}
+    dbid =  d_view.get(obj["name"], None)
+    dbobj = None
+    if dbid:
+        dbobj = db.get(dbid.id, None)
+    return _update_obj(obj, dbobj, t_utc)
+
+def bulk_update_fn(db, objs):
+    """Bulk version of update_fn. Fetches the id to name view and the
+    matching database objects once, and diffs all objects locally.
+
+    :param db: database
+    :param objs: list of objects
+
+    :returns: list of objects in need of saving
+    """
+    t_utc = utc_time()
+    d_view = {k.value:k.id for k in db.view("names/id_to_name")}
+    dbids = list(set([d_view[obj["name"]] for obj in objs if obj["name"] in d_view]))
+    dbobjs = {}
+    if dbids:
+        dbobjs = {row.id:row.doc for row in db.view("_all_docs", keys=dbids, include_docs=True) if row.doc}
+    new_objs = []
+    for obj in objs:
+        new_obj = _update_obj(obj, dbobjs.get(d_view.get(obj["name"], None), None), t_utc)
+        if not new_obj is None:
+            new_objs.append(new_obj)
+    return new_objs
+
 
 def load():
     """Called by the framework when the extension is 'loaded'."""
@@ -2,6 +2,9 @@
 
 import sys
 import os
+import hashlib
+import tempfile
+import multiprocessing
 from datetime import datetime
 
 from collections import OrderedDict
@@ -26,40 +29,80 @@ h2 = styles['Heading2']
 h3 = styles['Heading3']
 h4 = styles['Heading4']
 
+## Compiled templates, by template text
+_TEMPLATES = {}
+
+def get_template(text):
+    """Get a compiled mako template, compiling it once per process.
+    Set environment variable PM_MAKO_MODULE_DIR to a directory to also
+    keep the compiled template modules on disk between runs.
+
+    :param text: template text
+
+    :returns: mako Template
+    """
+    if not text in _TEMPLATES:
+        module_directory = os.environ.get("PM_MAKO_MODULE_DIR", None)
+        if module_directory:
+            ## mako only keeps modules of file based templates on disk
+            filename = os.path.join(module_directory, "rl_{}.mako".format(hashlib.md5(text).hexdigest()))
+            if not os.path.exists(filename):
+                if not os.path.exists(module_directory):
+                    try:
+                        os.makedirs(module_directory)
+                    except OSError:
+                        if not os.path.isdir(module_directory):
+                            raise
+                ## Other processes may be reading or writing the same
+                ## file, so write to a temporary file and rename it
+                fd, tmpname = tempfile.mkstemp(suffix=".tmp", dir=module_directory)
+                try:
+                    with os.fdopen(fd, "w") as fh:
+                        fh.write(text)
+                    os.chmod(tmpname, 0644)
+                    os.rename(tmpname, filename)
+                except:
+                    os.unlink(tmpname)
+                    raise
+            _TEMPLATES[text] = Template(filename=filename, module_directory=module_directory)
+        else:
+            _TEMPLATES[text] = Template(text)
+    return _TEMPLATES[text]
+
 ## FIXME: should mako templates go to data/templates?
 def sample_note_paragraphs():
     """Get paragraphs for sample notes."""
     paragraphs = OrderedDict()
     paragraphs["Project name"] = dict(style=h3, 
-                                      tpl=Template("${project_name} (${customer_reference})"))
+                                      tpl=get_template("${project_name} (${customer_reference})"))
     
     paragraphs["UPPNEX project id"] = dict(style=h3, 
-                                           tpl=Template("${uppnex_project_id}"))
+                                           tpl=get_template("${uppnex_project_id}"))
     
     paragraphs["Flow cell id"] = dict(style=h3, 
-                                      tpl=Template("${FC_id}"))
+                                      tpl=get_template("${FC_id}"))
     
     paragraphs["Sequence data directory"] = dict(style=h3, 
-                                                 tpl=Template("/proj/${uppnex_project_id}/INBOX/${project_name}/${scilifelab_name}/${start_date}_${FC_id}"))
+                                                 tpl=get_template("/proj/${uppnex_project_id}/INBOX/${project_name}/${scilifelab_name}/${start_date}_${FC_id}"))
     
     paragraphs["Sample"] = dict(style=h3,
-                                tpl=Template("""${scilifelab_name} / ${customer_name}.
+                                tpl=get_template("""${scilifelab_name} / ${customer_name}.
 Ordered amount: ${ordered_amount} million paired reads."""))
     
     paragraphs["Method"] = dict(style=h3,
-                                tpl = Template("""Clustered on cBot and sequenced on HiSeq 2000
+                                tpl = get_template("""Clustered on cBot and sequenced on HiSeq 2000
 according to manufacturer's instructions. Base
 conversion using OLB v1.9, demultiplexed and
 converted to fastq using CASAVA v1.8. The quality scale
 is Sanger / phred33 / Illumina 1.8+."""))
     
     paragraphs["Results"] = dict(style=h3,
-                                 tpl = Template("""${rounded_read_count} million reads in lane with PhiX
+                                 tpl = get_template("""${rounded_read_count} million reads in lane with PhiX
 error rate ${phix_error_rate}%. Average quality score
 ${avg_quality_score}."""))
     
     paragraphs["Comments"] = dict(style=h3,
-                                  tpl = Template("${success}"))
+                                  tpl = get_template("${success}"))
     return paragraphs
 
 def sample_note_headers():
@@ -87,21 +130,21 @@ def make_sample_table(data):
 def project_note_paragraphs():
     """Get paragraphs for project notes."""
     paragraphs = OrderedDict()
-    paragraphs["Project name"] = dict(style=h3, tpl=Template("${project_name} (${customer_reference})"))
+    paragraphs["Project name"] = dict(style=h3, tpl=get_template("${project_name} (${customer_reference})"))
     
-    paragraphs["UPPNEX project id"] = dict(style=h3, tpl=Template("${uppnex_project_id}"))
+    paragraphs["UPPNEX project id"] = dict(style=h3, tpl=get_template("${uppnex_project_id}"))
     
-    paragraphs["Sequence data directories"] = dict(style=h3, tpl=Template("/proj/${uppnex_project_id}/INBOX/${project_name}/"))
+    paragraphs["Sequence data directories"] = dict(style=h3, tpl=get_template("/proj/${uppnex_project_id}/INBOX/${project_name}/"))
     
-    paragraphs["Samples"] = dict(style=h3, tpl=Template(""))
+    paragraphs["Samples"] = dict(style=h3, tpl=get_template(""))
     
-    paragraphs["Comments"] = dict(style=h3, tpl=Template("${finished}"))
+    paragraphs["Comments"] = dict(style=h3, tpl=get_template("${finished}"))
     
     paragraphs["Information"] = OrderedDict()
     
     paragraphs["Information"]["Naming conventions"] = dict(
         style=h4,
-        tpl=Template("""The data is delivered in fastq format using Illumina 1.8
+        tpl=get_template("""The data is delivered in fastq format using Illumina 1.8
 quality scores. There will be one file for the forward reads and
 one file for the reverse reads. More information on our naming
 conventions can be found at
@@ -109,7 +152,7 @@ http://www.scilifelab.se/archive/pdf/tmp/SciLifeLab_Sequencing_FAQ.pdf."""))
     
     paragraphs["Information"]["Data access at UPPMAX"] = dict(
         style=h4,
-        tpl=Template("""Data from the sequencing will be uploaded to the UPPNEX (UPPMAX Next
+        tpl=get_template("""Data from the sequencing will be uploaded to the UPPNEX (UPPMAX Next
 Generation sequence Cluster & Storage, www.uppmax.uu.se), from which
 the user can access it. If you have problems to access your data,
 please contact SciLifeLab genomics_support@scilifelab.se. If you have
@@ -119,7 +162,7 @@ http://www.scilifelab.se/archive/pdf/tmp/SciLifeLab_Sequencing_FAQ.pdf."""))
     
     paragraphs["Information"]["Acknowledgement"] = dict(
         style=h4,
-        tpl=Template("""Please notify us when you publish using data
+        tpl=get_template("""Please notify us when you publish using data
 produced at Science For Life Laboratory (SciLifeLab)
 Stockholm. To acknowledge SciLifeLab Stockholm in your
 'article, you can use a sentence like "The authors would like
@@ -174,6 +217,36 @@ def make_note(outfile, headers, paragraphs, **kw):
     doc.build(story, onFirstPage=formatted_page, onLaterPages=formatted_page)
     return doc
 
+def _make_note(args):
+    """Build a note in a worker process. Headers and paragraphs are
+    created by the worker, since reportlab objects don't pickle."""
+    outfile, headers_fn, paragraphs_fn, kw = args
+    make_note(outfile, headers_fn(), paragraphs_fn(), **kw)
+    return outfile
+
+def make_notes(notes, headers_fn, paragraphs_fn, workers=1):
+    """Build several pdf files with the same headers and paragraphs,
+    possibly in a pool of worker processes.
+
+    :param notes: list of (outfile, kw) tuples, where kw are keyword arguments for formatting
+    :param headers_fn: function returning headers, e.g. sample_note_headers
+    :param paragraphs_fn: function returning paragraphs, e.g. sample_note_paragraphs
+    :param workers: number of worker processes
+
+    :returns: list of outfile names
+    """
+    if workers > 1 and len(notes) > 1:
+        pool = multiprocessing.Pool(min(workers, len(notes)))
+        try:
+            return pool.map(_make_note, [(outfile, headers_fn, paragraphs_fn, kw) for outfile, kw in notes])
+        finally:
+            pool.close()
+            pool.join()
+    headers = headers_fn()
+    paragraphs = paragraphs_fn()
+    for outfile, kw in notes:
+        make_note(outfile, headers, paragraphs, **kw)
+    return [outfile for outfile, kw in notes]
 
 def make_example_project_note(outfile):
     """Make a note with some simple nonsensical data. Looking at this function
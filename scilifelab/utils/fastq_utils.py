@@ -1,20 +1,286 @@
 """Utilities for handling FastQ data"""
+import bz2
 import gzip
+import itertools
+import collections
+import subprocess
+import threading
+import Queue
+import numpy as np
+from distutils.spawn import find_executable
 
 PHRED_OFFSET = 33
-         
+
+## Compression programs per file suffix. The first program is the
+## parallel implementation that is preferred when auto-detecting
+COMPRESS_PROGS = {".gz": ["pigz", "gzip"], ".bz2": ["pbzip2", "bzip2"]}
+## Codecs: 'auto' uses the parallel program if installed and 'thread'
+## otherwise, 'python' runs the codec in-process, 'thread' runs the
+## in-process codec in a separate thread, and any other value is taken
+## as the name of a compression program
+CODECS = ["auto", "python", "thread"] + sorted(reduce(lambda x, y: x + y, COMPRESS_PROGS.values()))
+DEFAULT_CODEC = "auto"
+
+def _compress_suffix(file):
+    for suffix in COMPRESS_PROGS.keys():
+        if file.endswith(suffix):
+            return suffix
+    return None
+
+def select_codec(file,codec=None):
+    """Select the codec to use for a file. Returns None for uncompressed files.
+
+    :param file: file name
+    :param codec: codec, one of CODECS. Defaults to DEFAULT_CODEC
+    """
+    suffix = _compress_suffix(file)
+    if suffix is None:
+        return None
+    codec = codec or DEFAULT_CODEC
+    if codec == "auto":
+        prog = COMPRESS_PROGS[suffix][0]
+        return prog if find_executable(prog) else "thread"
+    return codec
+
+class _BZ2Appender(object):
+    """Appends a new bzip2 stream to a file, since BZ2File can't"""
+
+    def __init__(self,file):
+        self._fh = open(file,"ab")
+        self._compressor = bz2.BZ2Compressor()
+
+    def write(self,data):
+        self._fh.write(self._compressor.compress(data))
+
+    def close(self):
+        self._fh.write(self._compressor.flush())
+        self._fh.close()
+
+def _open_python(file,mode="rb"):
+    if _compress_suffix(file) == ".bz2":
+        if "a" in mode:
+            return _BZ2Appender(file)
+        return bz2.BZ2File(file,mode)
+    return gzip.GzipFile(file,mode)
+
+def open_fastq(file,mode="rb",codec=None):
+    """Open a possibly compressed file for reading or writing. The
+    compression is determined by the file suffix.
+
+    :param file: file name
+    :param mode: 'rb', 'wb' or 'ab'. Appending to a compressed file adds
+      a new gzip member or bzip2 stream; note that bz2.BZ2File only reads
+      the first stream, so use an external program to read such files
+    :param codec: codec, one of CODECS. Defaults to DEFAULT_CODEC
+
+    :returns: file object
+    """
+    codec = select_codec(file,codec)
+    if codec is None:
+        return open(file,mode)
+    if codec == "python":
+        return _open_python(file,mode)
+    if codec == "thread":
+        return ThreadedFile(file,mode)
+    return PipeFile(codec,file,mode)
+
+class PipeFile(object):
+    """File object that streams data through an external compression 
+       program, such as pigz or pbzip2, running in a subprocess"""
+
+    def __init__(self,prog,file,mode="rb"):
+        if not find_executable(prog):
+            raise IOError("No such compression program: %s" % prog)
+        self.name = file
+        self.mode = mode
+        self._prog = prog
+        self._open()
+
+    def _open(self):
+        if "r" in self.mode:
+            self._out = None
+            self._proc = subprocess.Popen([self._prog, "-dc", self.name], stdout=subprocess.PIPE, bufsize=-1)
+            self._fh = self._proc.stdout
+        else:
+            self._out = open(self.name,"ab" if "a" in self.mode else "wb")
+            self._proc = subprocess.Popen([self._prog, "-c"], stdin=subprocess.PIPE, stdout=self._out, bufsize=-1)
+            self._fh = self._proc.stdin
+
+    def _wait(self):
+        returncode = self._proc.wait()
+        if returncode != 0:
+            raise IOError("%s exited with code %d for %s" % (self._prog, returncode, self.name))
+
+    def read(self,size=-1):
+        data = self._fh.read(size)
+        if not data:
+            self._wait()
+        return data
+
+    def write(self,data):
+        self._fh.write(data)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return self._fh.next()
+        except StopIteration:
+            self._wait()
+            raise
+
+    def seek(self,offset,whence=0):
+        """Only rewinding a file opened for reading is supported, by
+        restarting the program"""
+        if "r" not in self.mode or offset != 0 or whence != 0:
+            raise IOError("Can only rewind %s pipes opened for reading" % self._prog)
+        self.close()
+        self._open()
+
+    def close(self):
+        if self._proc.poll() is None and "r" in self.mode:
+            self._proc.terminate()
+        self._fh.close()
+        returncode = self._proc.wait()
+        if self._out is not None:
+            self._out.close()
+            if returncode != 0:
+                raise IOError("%s exited with code %d for %s" % (self._prog, returncode, self.name))
+
+class ThreadedFile(object):
+    """File object that runs an in-process codec in a separate thread,
+       passing blocks of data through a bounded queue"""
+
+    def __init__(self,file,mode="rb",block_size=1024*1024,queue_size=8):
+        self.name = file
+        self.mode = mode
+        self._block_size = block_size
+        self._queue_size = queue_size
+        self._open()
+
+    def _open(self):
+        self._fh = _open_python(self.name,self.mode)
+        self._queue = Queue.Queue(self._queue_size)
+        self._stop = threading.Event()
+        self._error = None
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+        self._pending = []
+        self._pending_size = 0
+        self._thread = threading.Thread(target=self._reader if "r" in self.mode else self._writer)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _reader(self):
+        try:
+            while not self._stop.is_set():
+                data = self._fh.read(self._block_size)
+                self._queue.put(data)
+                if not data:
+                    break
+        except Exception, e:
+            self._queue.put(e)
+
+    def _writer(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+            ## Keep consuming after an error so that write never blocks
+            if self._error is not None:
+                continue
+            try:
+                self._fh.write(data)
+            except Exception, e:
+                self._error = e
+
+    def _fill(self):
+        data = self._queue.get()
+        if isinstance(data, Exception):
+            self._eof = True
+            raise data
+        self._buf = self._buf[self._pos:] + data
+        self._pos = 0
+        if not data:
+            self._eof = True
+
+    def read(self,size=-1):
+        while not self._eof and (size < 0 or len(self._buf) - self._pos < size):
+            self._fill()
+        end = len(self._buf) if size < 0 else min(len(self._buf), self._pos + size)
+        data = self._buf[self._pos:end]
+        self._pos = end
+        return data
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while True:
+            i = self._buf.find("\n", self._pos)
+            if i >= 0:
+                line = self._buf[self._pos:i+1]
+                self._pos = i + 1
+                return line
+            if self._eof:
+                line = self._buf[self._pos:]
+                self._pos = len(self._buf)
+                if not line:
+                    raise StopIteration
+                return line
+            self._fill()
+
+    def write(self,data):
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= self._block_size:
+            self._flush()
+
+    def _flush(self):
+        if self._error is not None:
+            raise self._error
+        if self._pending:
+            self._queue.put("".join(self._pending))
+            self._pending = []
+            self._pending_size = 0
+
+    def seek(self,offset,whence=0):
+        """Only rewinding a file opened for reading is supported"""
+        if "r" not in self.mode or offset != 0 or whence != 0:
+            raise IOError("Can only rewind threaded files opened for reading")
+        self.close()
+        self._open()
+
+    def close(self):
+        if "r" in self.mode:
+            self._stop.set()
+            while self._thread.is_alive():
+                try:
+                    self._queue.get(timeout=0.1)
+                except Queue.Empty:
+                    pass
+            self._fh.close()
+            return
+        try:
+            self._flush()
+        finally:
+            self._queue.put(None)
+            self._thread.join()
+            self._fh.close()
+        if self._error is not None:
+            raise self._error
+
 class FastQParser:
-    """Parser for fastq files, possibly compressed with gzip. 
+    """Parser for fastq files, possibly compressed with gzip or bzip2.
        Iterates over one record at a time. A record consists 
        of a list with 4 elements corresponding to 1) Header, 
-       2) Nucleotide sequence, 3) Optional header, 4) Qualities"""
+       2) Nucleotide sequence, 3) Optional header, 4) Qualities.
+       See open_fastq for the available codecs"""
     
-    def __init__(self,file):
-        fh = open(file,"rb")
-        if file.endswith(".gz"):
-            self._fh = gzip.GzipFile(fileobj=fh)
-        else:
-            self._fh = fh
+    def __init__(self,file,codec=None):
+        self._fh = open_fastq(file,"rb",codec)
         self._records_read = 0
         
     def __iter__(self):
@@ -30,27 +296,208 @@ class FastQParser:
     def rread(self):
         return self._records_read
 
-    def seek(self,offset,whence=None):
+    def seek(self,offset,whence=0):
         self._fh.seek(offset,whence)
         
     def close(self):
         self._fh.close()
 
+class FastQRecord(object):
+    """View of a fastq record in the buffer of a FastQBlockParser.
+       Behaves like the 4 element list returned by FastQParser, but
+       the line strings are only created when accessed.
+
+       NB: a record keeps a reference to the entire block it was read
+       from, so use tolist() for records that are stored for long"""
+    __slots__ = ("_buf", "_ends", "_i")
+
+    def __init__(self,buf,ends,i):
+        self._buf = buf
+        self._ends = ends
+        self._i = i
+
+    def __getitem__(self,k):
+        if k.__class__ is not int:
+            if isinstance(k, slice):
+                return [self[j] for j in range(*k.indices(4))]
+            raise TypeError("fastq record indices must be integers")
+        if k < 0:
+            k += 4
+        if k < 0 or k > 3:
+            raise IndexError("fastq record index out of range")
+        j = self._i + k
+        return self._buf[self._ends[j]+1:self._ends[j+1]].strip()
+
+    def __len__(self):
+        return 4
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __eq__(self,other):
+        return self.tolist() == list(other)
+
+    def __ne__(self,other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self.tolist())
+
+    def tolist(self):
+        return [self[k] for k in range(4)]
+
+    def raw(self):
+        """The record text as read from file, including the final newline"""
+        return self._buf[self._ends[self._i]+1:self._ends[self._i+4]+1]
+
+class FastQBlockParser(FastQParser):
+    """Parser for fastq files, possibly compressed with gzip, that reads
+       the input in large blocks and locates the records by scanning the
+       block for newlines. Iterates over FastQRecord views into the
+       block rather than lists of strings"""
+
+    def __init__(self,file,block_size=4*1024*1024,codec=None):
+        FastQParser.__init__(self,file,codec)
+        self._block_size = block_size
+        self._reset()
+
+    def _reset(self):
+        self._buf = ""
+        self._ends = [-1]
+        self._i = 0
+        self._rest = ""
+
+    def _read_block(self):
+        while True:
+            data = self._fh.read(self._block_size)
+            buf = self._rest + data
+            if not data:
+                if not buf.strip():
+                    raise StopIteration
+                if not buf.endswith("\n"):
+                    buf += "\n"
+            ## Positions of all newlines, of which every fourth ends a record
+            ends = np.flatnonzero(np.frombuffer(buf, dtype=np.uint8) == 10)
+            n = len(ends) - len(ends) % 4
+            if not data and n < len(ends):
+                raise ValueError("Truncated fastq record at end of file: %s" % buf.strip())
+            if n > 0:
+                break
+            self._rest = buf
+        ## Prepend -1 so that line j spans ends[j]+1 to ends[j+1]
+        self._ends = [-1] + ends[0:n].tolist()
+        self._buf = buf
+        self._rest = buf[self._ends[-1]+1:]
+        self._i = 0
+
+    def __iter__(self):
+        while True:
+            if self._i >= len(self._ends) - 1:
+                self._read_block()
+            buf, ends, i = self._buf, self._ends, self._i
+            n = len(ends) - 1
+            while i < n:
+                self._i = i + 4
+                self._records_read += 1
+                yield FastQRecord(buf, ends, i)
+                i += 4
+
+    def next(self):
+        if self._i >= len(self._ends) - 1:
+            self._read_block()
+        record = FastQRecord(self._buf, self._ends, self._i)
+        self._i += 4
+        self._records_read += 1
+        return record
+
+    def seek(self,offset,whence=0):
+        self._reset()
+        self._fh.seek(offset,whence)
+
+class FastQWriterPool(object):
+    """Writes fastq records to a set of output files, e.g. one per index
+       when demultiplexing. Records are buffered per output and written
+       in large blocks. At most max_open files are kept open at a time;
+       when more are needed the least recently written file is closed
+       and later reopened for appending (see open_fastq).
+
+       bzip2 outputs are never closed before close() is called:
+       appending to them gives multi-stream files, of which bz2.BZ2File
+       in python 2, used by the python and thread codecs, only reads
+       the first stream. With many bzip2 outputs more than max_open
+       files may therefore be open"""
+
+    def __init__(self,codec=None,buffer_size=1024*1024,max_open=256):
+        self._codec = codec
+        self._buffer_size = buffer_size
+        self._max_open = max_open
+        self._handles = collections.OrderedDict()
+        self._buffers = {}
+        self._sizes = {}
+        self._counts = {}
+        self._opened = set()
+
+    def write(self,file,record):
+        """Write a record to file"""
+        if isinstance(record, FastQRecord):
+            data = record.raw()
+        else:
+            data = "".join(["%s\n" % row.strip("\n") for row in record])
+        if file not in self._buffers:
+            self._buffers[file] = []
+            self._sizes[file] = 0
+            self._counts[file] = 0
+        self._buffers[file].append(data)
+        self._sizes[file] += len(data)
+        self._counts[file] += 1
+        if self._sizes[file] >= self._buffer_size:
+            self._flush(file)
+
+    def _handle(self,file):
+        fh = self._handles.pop(file, None)
+        if fh is None:
+            if len(self._handles) >= self._max_open:
+                evict = [x for x in self._handles.keys() if not x.endswith(".bz2")]
+                if evict:
+                    self._handles.pop(evict[0]).close()
+            ## Files that have been closed to make room are appended to
+            fh = open_fastq(file,"ab" if file in self._opened else "wb",self._codec)
+            self._opened.add(file)
+        self._handles[file] = fh
+        return fh
+
+    def _flush(self,file):
+        if self._buffers[file]:
+            self._handle(file).write("".join(self._buffers[file]))
+            self._buffers[file] = []
+            self._sizes[file] = 0
+
+    def rwritten(self):
+        """Number of records written per file"""
+        return dict(self._counts)
+
+    def close(self):
+        for file in self._buffers.keys():
+            self._flush(file)
+        while self._handles:
+            self._handles.popitem(last=False)[1].close()
+
 class FastQWriter:
     """Writes fastq records, where each record is a list with 4 elements
        corresponding to 1) Header, 2) Nucleotide sequence, 3) Optional header, 
-       4) Qualities. If the supplied filename ends with .gz, the output file 
-       will be compressed with gzip"""
+       4) Qualities. If the supplied filename ends with .gz or .bz2, the 
+       output file will be compressed with gzip or bzip2. See open_fastq
+       for the available codecs"""
        
-    def __init__(self,file):
-        fh = open(file,"wb")
-        if file.endswith(".gz"):
-            self._fh = gzip.GzipFile(fileobj=fh)
-        else:    
-            self._fh = fh
+    def __init__(self,file,codec=None):
+        self._fh = open_fastq(file,"wb",codec)
         self._records_written = 0
         
     def write(self,record):
+        if isinstance(record, FastQRecord):
+            self._fh.write(record.raw())
+            self._records_written += 1
+            return
         for row in record:
             self._fh.write("%s\n" % row.strip("\n"))
         self._records_written += 1
@@ -61,20 +508,72 @@ class FastQWriter:
     def close(self):
         self._fh.close()
 
+def fastq_chunks(parser, size=100000):
+    """Iterate over lists of at most size records from a FastQParser"""
+    while True:
+        chunk = list(itertools.islice(parser, size))
+        if not chunk:
+            break
+        yield chunk
+
+def round_half_up(x, decimals=0):
+    """Round array like the builtin round, i.e. halves away from zero"""
+    m = 10**decimals
+    return np.sign(x) * np.floor(np.abs(x) * m + 0.5) / m
+
+class QualityChunk:
+    """Quality values of a chunk of fastq records, stored as phred
+       scores in one int16 buffer, for computing per-record and 
+       per-position statistics for the whole chunk at once. Quality
+       characters below the offset give negative scores, and records
+       without bases get statistics 0"""
+
+    def __init__(self,records,offset=PHRED_OFFSET):
+        quals = [r[3].strip() for r in records]
+        self.lengths = np.array([len(q) for q in quals], dtype=np.int64)
+        self.starts = np.zeros(len(quals), dtype=np.int64)
+        np.cumsum(self.lengths[:-1], out=self.starts[1:])
+        self.qual = np.frombuffer("".join(quals), dtype=np.uint8).astype(np.int16) - offset
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def _sum_by_record(self,vals):
+        ## Differences of cumulative sums, which unlike
+        ## np.add.reduceat give 0 for records without bases
+        cumsum = np.zeros(len(vals) + 1, dtype=np.int64)
+        np.cumsum(vals, out=cumsum[1:])
+        return cumsum[self.starts + self.lengths] - cumsum[self.starts]
+
+    def _mean_by_record(self,vals):
+        return np.where(self.lengths > 0, self._sum_by_record(vals).astype(float)/np.maximum(self.lengths, 1), 0.0)
+
+    def avgQ(self):
+        """Average quality per record"""
+        return round_half_up(self._mean_by_record(self.qual), 1)
+
+    def gtQ30(self):
+        """Percentage of bases with quality >= 30 per record"""
+        return round_half_up(100*self._mean_by_record(self.qual >= 30), 1)
+
+    def position_histogram(self,max_qual=50):
+        """Counts of quality values per read position. Returns an
+           array with one row per position and one column per quality 
+           value in 0..max_qual; higher values are counted as max_qual
+           and negative values as 0"""
+        if len(self.qual) == 0:
+            return np.zeros((0, max_qual+1), dtype=np.int64)
+        pos = np.arange(len(self.qual)) - np.repeat(self.starts, self.lengths)
+        qual = np.clip(self.qual, 0, max_qual)
+        n_pos = self.lengths.max()
+        counts = np.bincount(pos*(max_qual+1) + qual, minlength=n_pos*(max_qual+1))
+        return counts.reshape(n_pos, max_qual+1)
+
 def avgQ(record,offset=PHRED_OFFSET):
-    qual = record[3].strip()
-    l = len(qual)
-    s = sum([ord(c) for c in qual])
-    return round(float(s - l*offset)/l,1)
+    return float(QualityChunk([record],offset).avgQ()[0])
     
 def gtQ30(record,offset=PHRED_OFFSET):
-    qual = record[3].strip()
-    cutoff = 30 + offset
-    g = 0
-    for c in qual:
-        if ord(c) >= cutoff:
-            g += 1
-    return round(100*float(g)/len(qual),1)
+    return float(QualityChunk([record],offset).gtQ30()[0])
 
 def parse_header(header):
     """Parses the FASTQ header as specified by CASAVA 1.8.2 and returns the fields in a dictionary
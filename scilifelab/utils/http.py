@@ -3,23 +3,27 @@ import httplib
 import urlparse
 
 ## From http://pythonadventures.wordpress.com/2010/10/17/check-if-url-exists/
-def get_server_status_code(url):
+def get_server_status_code(url, timeout=None):
     """
     Download just the header of a URL and
     return the server's status code.
+
+    :param timeout: socket timeout in seconds
     """
     host, path = urlparse.urlparse(url)[1:3]
     try:
-        conn = httplib.HTTPConnection(host)
+        conn = httplib.HTTPConnection(host, timeout=timeout)
         conn.request('HEAD', path)
         return conn.getresponse().status
     except StandardError:
         return None
 
-def check_url(url):
+def check_url(url, timeout=None):
     """
     Check if a URL exists without downloading the whole file.
     We only check the URL header.
+
+    :param timeout: socket timeout in seconds
     """
     good_codes = [httplib.OK, httplib.FOUND, httplib.MOVED_PERMANENTLY]
-    return get_server_status_code(url) in good_codes
+    return get_server_status_code(url, timeout) in good_codes
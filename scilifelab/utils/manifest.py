@@ -0,0 +1,111 @@
+"""File fingerprint manifests for detecting changed files"""
+import os
+import json
+import hashlib
+
+def md5sum(path, block_size=1024*1024):
+    """Calculate md5 hex digest of a file.
+
+    :param path: file name
+    :param block_size: read block size
+
+    :returns: hex digest
+    """
+    md5 = hashlib.md5()
+    with open(path, "rb") as fh:
+        while True:
+            data = fh.read(block_size)
+            if not data:
+                break
+            md5.update(data)
+    return md5.hexdigest()
+
+def fingerprint(path):
+    """Get fingerprint of a file.
+
+    :param path: file name
+
+    :returns: dict with size and mtime_ns
+    """
+    st = os.stat(path)
+    return {"size" : st.st_size, "mtime_ns" : int(round(st.st_mtime * 1e9)), "md5" : None}
+
+class FileManifest(object):
+    """Fingerprints of groups of files, e.g. the metric files of each
+    sample in a flowcell, persisted as a json file. A group has changed
+    if its set of files differs from the saved one, or if the size or
+    modification time of any file differs. With content_hash, files
+    whose size is unchanged but modification time differs are compared
+    by md5 sum, so that touched but unmodified files don't count as
+    changes.
+
+    New fingerprints are staged by changed() and only stored by
+    commit(), so that groups that failed to be processed are checked
+    again next time.
+
+    :param path: manifest file
+    :param content_hash: compare md5 sums of files with new modification times
+    """
+    def __init__(self, path, content_hash=False):
+        self.path = path
+        self.content_hash = content_hash
+        self.groups = {}
+        self._staged = {}
+        if os.path.exists(path):
+            with open(path) as fh:
+                self.groups = json.load(fh).get("groups", {})
+
+    def changed(self, group, files):
+        """Check whether the files of group have changed since the last
+        commit, and stage their new fingerprints.
+
+        :param group: group name
+        :param files: list of files in group
+
+        :returns: boolean
+        """
+        old = self.groups.get(group, None)
+        changed = old is None or set(old.keys()) != set(files)
+        new = {}
+        for f in files:
+            fp = fingerprint(f)
+            prev = (old or {}).get(f, None)
+            if prev and prev["size"] == fp["size"] and prev["mtime_ns"] == fp["mtime_ns"]:
+                fp["md5"] = prev.get("md5", None)
+            elif self.content_hash:
+                fp["md5"] = md5sum(f)
+                if not prev or prev["size"] != fp["size"] or prev.get("md5", None) != fp["md5"]:
+                    changed = True
+            else:
+                changed = True
+            new[f] = fp
+        self._staged[group] = new
+        return changed
+
+    def commit(self, groups=None):
+        """Store staged fingerprints.
+
+        :param groups: groups to commit; defaults to all staged groups
+        """
+        if groups is None:
+            groups = self._staged.keys()
+        for group in groups:
+            if group in self._staged:
+                self.groups[group] = self._staged.pop(group)
+
+    def discard(self, groups):
+        """Drop staged fingerprints, e.g. for groups that failed to upload.
+
+        :param groups: groups to discard
+        """
+        for group in groups:
+            self._staged.pop(group, None)
+
+    def save(self):
+        """Write manifest to file"""
+        if not os.path.exists(os.path.dirname(os.path.abspath(self.path))):
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)))
+        tmp = "{}.tmp".format(self.path)
+        with open(tmp, "w") as fh:
+            json.dump({"groups" : self.groups}, fh)
+        os.rename(tmp, self.path)
@@ -0,0 +1,123 @@
+"""YAML input/output using the libyaml bindings when available, and an
+optionally persistent cache of parsed run information files"""
+import os
+import atexit
+import cPickle
+import yaml
+from collections import OrderedDict
+
+try:
+    from yaml import CLoader as Loader, CDumper as Dumper
+except ImportError:
+    from yaml import Loader, Dumper
+
+## Maximum number of files in the parsed yaml cache
+MAX_ENTRIES = 1000
+
+def load(stream):
+    """Load yaml from a string or file handle.
+
+    :param stream: string or file handle
+
+    :returns: parsed object
+    """
+    return yaml.load(stream, Loader=Loader)
+
+def dump(data, stream=None, **kw):
+    """Dump object as yaml.
+
+    :param data: object
+    :param stream: file handle; if None, return yaml as string
+    :param kw: keyword arguments passed to yaml.dump
+    """
+    return yaml.dump(data, stream, Dumper=Dumper, **kw)
+
+class YamlCache(object):
+    """Cache of parsed yaml files, keyed by absolute path and
+    invalidated when the size or modification time of a file
+    changes. Objects are stored pickled, so that every lookup returns a
+    new copy that callers are free to modify. When the cache is full,
+    the least recently used entry is dropped.
+
+    :param path: cache file; if None, the cache is kept in memory only
+    :param max_entries: maximum number of cached files
+    """
+    def __init__(self, path=None, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.dirty = False
+        if path and os.path.exists(path):
+            try:
+                with open(path, "rb") as fh:
+                    self.entries = OrderedDict(cPickle.load(fh))
+            except Exception:
+                self.entries = OrderedDict()
+            self._evict()
+
+    def _evict(self):
+        """Drop least recently used entries exceeding max_entries"""
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.dirty = True
+
+    def load(self, infile):
+        """Load a yaml file, parsing it only if it has changed.
+
+        :param infile: yaml file
+
+        :returns: parsed object
+        """
+        infile = os.path.abspath(infile)
+        st = os.stat(infile)
+        key = (st.st_size, st.st_mtime)
+        entry = self.entries.pop(infile, None)
+        if entry and entry[0] == key:
+            self.entries[infile] = entry
+            return cPickle.loads(entry[1])
+        with open(infile) as fh:
+            data = load(fh)
+        self.entries[infile] = (key, cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL))
+        self.dirty = True
+        self._evict()
+        return data
+
+    def save(self):
+        """Write cache to file, dropping entries of removed files"""
+        if not self.path or not self.dirty:
+            return
+        self.entries = OrderedDict((k, v) for k, v in self.entries.items() if os.path.exists(k))
+        try:
+            if not os.path.exists(os.path.dirname(os.path.abspath(self.path))):
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)))
+            tmp = "{}.{}.tmp".format(self.path, os.getpid())
+            with open(tmp, "wb") as fh:
+                cPickle.dump(self.entries, fh, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, self.path)
+            self.dirty = False
+        except (IOError, OSError):
+            pass
+
+_CACHE = None
+
+def get_cache():
+    """Get the shared yaml cache. The cache is kept in memory, unless
+    environment variable PM_YAML_CACHE is set to a cache file, e.g.
+    ~/.pm/yaml_cache.pickle, that is read on first use and saved at
+    exit."""
+    global _CACHE
+    if _CACHE is None:
+        _CACHE = YamlCache(os.environ.get("PM_YAML_CACHE", None) or None)
+        if _CACHE.path:
+            atexit.register(_CACHE.save)
+    return _CACHE
+
+def load_run_info(infile):
+    """Load a run information file, e.g. run_info.yaml or a
+    bcbb-config.yaml, through the shared cache.
+
+    :param infile: yaml file
+
+    :returns: parsed object
+    """
+    return get_cache().load(infile)
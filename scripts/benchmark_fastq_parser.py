@@ -0,0 +1,63 @@
+"""
+Benchmark the throughput of FastQParser and FastQBlockParser on plain and gzipped fastq input
+usage:
+    %s [-n records] [-r read length] [-c codec] [fastq files]
+
+Compressed files are read with each of the given codecs (option can be repeated)
+
+If no fastq files are given, files with random records are generated in a temporary directory
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+from optparse import OptionParser
+from scilifelab.utils.fastq_utils import (FastQParser, FastQBlockParser, FastQWriter, CODECS, select_codec)
+
+def make_fastq(outfile, n, read_length):
+    fw = FastQWriter(outfile)
+    for i in xrange(n):
+        seq = "".join(random.choice("ACGTN") for j in xrange(read_length))
+        qual = "".join(chr(random.randint(35, 73)) for j in xrange(read_length))
+        fw.write(["@HWI-ST1018:1:1101:%d:%d 1:N:0:ACGTAC" % (i % 20000, i), seq, "+", qual])
+    fw.close()
+
+def time_parser(cls, fastq_file, access, codec=None):
+    t0 = time.time()
+    n = 0
+    for record in cls(fastq_file, codec=codec):
+        if access:
+            record[1]
+            record[3]
+        n += 1
+    return n, time.time() - t0
+
+def main(fastq_files, n, read_length, codecs):
+    tmpdir = None
+    if not fastq_files:
+        tmpdir = tempfile.mkdtemp(prefix="benchmark_fastq_parser_")
+        fastq_files = [os.path.join(tmpdir, "reads.fastq"), os.path.join(tmpdir, "reads.fastq.gz")]
+        for f in fastq_files:
+            make_fastq(f, n, read_length)
+    try:
+        print "\t".join(["file", "parser", "codec", "access", "records", "seconds", "records/s"])
+        for f in fastq_files:
+            for codec in sorted(set([select_codec(f, c) for c in codecs])):
+                for cls in [FastQParser, FastQBlockParser]:
+                    for access in [False, True]:
+                        nrec, t = time_parser(cls, f, access, codec)
+                        print "\t".join([os.path.basename(f), cls.__name__, str(codec), str(access), str(nrec), "%.2f" % t, "%.0f" % (nrec/max(t, 1e-9))])
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    parser = OptionParser(usage=__doc__ % sys.argv[0])
+    parser.add_option("-n", "--records", dest="records", type="int", default=500000)
+    parser.add_option("-r", "--read-length", dest="read_length", type="int", default=100)
+    parser.add_option("-c", "--codec", dest="codecs", action="append", choices=CODECS)
+    options, args = parser.parse_args()
+
+    main(args, options.records, options.read_length, options.codecs or ["python"])
@@ -1,7 +1,8 @@
 import os
 import sys
-import scilifelab.utils.fastq_utils
+from scilifelab.utils import fastq_utils
 import argparse
+import numpy as np
 
 def main():
     
@@ -14,13 +15,16 @@ def main():
                         help="if any read in the pair has an average quality below this threshold, the pair is discarded. Default is 20.")
     parser.add_argument('-p','--phred', action='store', default=33, 
                         help="the Phred quality score offset. Default is 33 (Sanger)")
+    parser.add_argument('-c','--codec', action='store', default=None, choices=fastq_utils.CODECS,
+                        help="the codec to use for compressed files. Default is to use pigz or pbzip2 if available, "\
+                        "and otherwise to (de)compress in a separate thread")
     parser.add_argument('fastq1', action='store', default=None, 
                         help="the first sequence file of the pair")
     parser.add_argument('fastq2', action='store', default=None, 
                         help="the second sequence file of the pair")
     
     args = parser.parse_args()
-    process_fastq(args.fastq1, args.fastq2, [int(args.threshold)], int(args.phred))
+    process_fastq(args.fastq1, args.fastq2, [int(args.threshold)], int(args.phred), args.codec)
 
 def print_average_quals(qualities):
     
@@ -32,30 +36,36 @@ def print_average_quals(qualities):
         avg_quality.insert(0,bin)
         print ",".join([str(i) for i in avg_quality])
         
-def process_fastq(fastq_r1, fastq_r2, bins, phred_offset):
+def process_fastq(fastq_r1, fastq_r2, bins, phred_offset, codec=None):
     
-    fh_r1 = fastq_utils.FastQParser(fastq_r1)
-    fh_r2 = fastq_utils.FastQParser(fastq_r2)
+    fh_r1 = fastq_utils.FastQBlockParser(fastq_r1, codec=codec)
+    fh_r2 = fastq_utils.FastQBlockParser(fastq_r2, codec=codec)
     oh1 = {}
     oh2 = {}
     root1, ext1 = os.path.splitext(fastq_r1)
     root2, ext2 = os.path.splitext(fastq_r2)
     for b in bins:
-        oh1[b] = fastq_utils.FastQWriter("%s.Q%d%s" % (root1,b,ext1))
-        oh2[b] = fastq_utils.FastQWriter("%s.Q%d%s" % (root2,b,ext2))
+        oh1[b] = fastq_utils.FastQWriter("%s.Q%d%s" % (root1,b,ext1), codec)
+        oh2[b] = fastq_utils.FastQWriter("%s.Q%d%s" % (root2,b,ext2), codec)
     
-    for r1 in fh_r1:
-        r2 = fh_r2.next()
-        r1h = r1[0].split()
-        r2h = r2[0].split()
-        assert r2h[0] == r1h[0] and r2h[1][1:] == r1h[1][1:], "FATAL: Read identifiers differ for paired reads (%s and %s)" % (r1[0],r2[0])
-            
-        bin = min(int(round(fastq_utils.avgQ(r1,phred_offset))),int(round(fastq_utils.avgQ(r2,phred_offset))))
+    chunks_r2 = fastq_utils.fastq_chunks(fh_r2)
+    for chunk_r1 in fastq_utils.fastq_chunks(fh_r1):
+        chunk_r2 = next(chunks_r2, [])
+        assert len(chunk_r1) == len(chunk_r2), "FATAL: Files contain different number of reads (%s and %s)" % (fastq_r1,fastq_r2)
+        ## Compute the average qualities of the entire chunk at once
+        avgq_r1 = fastq_utils.QualityChunk(chunk_r1,phred_offset).avgQ()
+        avgq_r2 = fastq_utils.QualityChunk(chunk_r2,phred_offset).avgQ()
+        qbins = fastq_utils.round_half_up(np.minimum(avgq_r1,avgq_r2)).astype(int)
         
-        for b in bins:
-            if bin >= b:
-                oh1[b].write(r1)
-                oh2[b].write(r2)
+        for r1, r2, bin in zip(chunk_r1, chunk_r2, qbins):
+            r1h = r1[0].split()
+            r2h = r2[0].split()
+            assert r2h[0] == r1h[0] and r2h[1][1:] == r1h[1][1:], "FATAL: Read identifiers differ for paired reads (%s and %s)" % (r1[0],r2[0])
+            
+            for b in bins:
+                if bin >= b:
+                    oh1[b].write(r1)
+                    oh2[b].write(r2)
         
     for oh in oh1.values() + oh2.values():
         oh.close()
@@ -10,7 +10,7 @@ import collections
 import sys
 
 # Slight modification to read from input file instead of stdin
-from scilifelab.utils.fastq_utils import (FastQParser, FastQWriter)
+from scilifelab.utils.fastq_utils import (FastQBlockParser, FastQWriter)
 
 __doc__ %= sys.argv[0]
 if len(sys.argv) > 2:
@@ -20,7 +20,7 @@ if len(sys.argv) > 2:
 
 print >>sys.stderr, "Command: ", " ".join(sys.argv)
 infile = sys.argv[1]
-fp = FastQParser(infile)
+fp = FastQBlockParser(infile)
 for _ in fp:
     pass
 records = fp.rread()
@@ -27,7 +27,6 @@ import os
 import sys
 from optparse import OptionParser
 from operator import itemgetter
-import yaml
 import glob
 import re
 from mako.template import Template
@@ -42,6 +41,7 @@ from bcbio.google import bc_metrics
 from bcbio.solexa.flowcell import get_flowcell_info 
 import read_illumina_summary_xml as summ
 from bcbio.pipeline.config_loader import load_config
+from scilifelab.utils.yaml_io import load_run_info
 from bcbio.scilifelab.google.project_metadata import ProjectMetaData
 
 
@@ -205,8 +205,7 @@ ${errorrate}
 def main(flowcell_id, qual_scale, archive_dir, analysis_dir, config_file):
     if qual_scale not in ["phred64", "phred33"]: sys.exit("You must provide either 'phred64' or 'phred33' as the quality scale! Exiting ...")
     fp = os.path.join(archive_dir, flowcell_id, "run_info.yaml")
-    with open(fp) as in_handle:
-        run_info = yaml.load(in_handle)
+    run_info = load_run_info(fp)
     if config_file:
         config = load_config(config_file)
     else:
@@ -614,8 +613,7 @@ def generate_report(proj_conf):
         print("WARNING: could not find required run_info.yaml configuration file at '%s'" % run_info_yaml)
         return
 
-    with open(run_info_yaml) as in_handle:
-        run_info = yaml.load(in_handle)
+    run_info = load_run_info(run_info_yaml)
 
     fc_name, fc_date = get_flowcell_info(proj_conf['flowcell'])
     low_yield = False
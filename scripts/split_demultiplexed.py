@@ -6,12 +6,13 @@ import os
 import csv
 import re
 import operator
+import multiprocessing
 from scilifelab.miseq import (MiSeqSampleSheet, group_fastq_files)
-from scilifelab.utils.fastq_utils import (FastQParser, FastQWriter)
+from scilifelab.utils.fastq_utils import (FastQBlockParser, FastQWriterPool, CODECS)
  
 from optparse import OptionParser
 
-def main(fastq_files, outdir, samplesheet):
+def main(fastq_files, outdir, samplesheet, codec=None, workers=1, max_open=256):
     
     samples = {}
     if samplesheet:
@@ -21,44 +22,77 @@ def main(fastq_files, outdir, samplesheet):
         for i,name in enumerate(names):
             samples[str(i)] = name
             
-    _split_fastq_batches(group_fastq_files(fastq_files),outdir,samples)
+    _split_fastq_batches(group_fastq_files(fastq_files),outdir,samples,codec,workers,max_open)
         
-def _split_fastq_batches(inputs, outdir, samples={}):
-            
-    # Loop over the fastq files
-    for fastq_files in inputs:
-        fastq_names = [os.path.basename(f) for f in fastq_files]
-        prefix = os.path.commonprefix(fastq_names).strip("_")
-        suffix = os.path.commonprefix([f[::-1] for f in fastq_names])[::-1]
-            
-        counts = _split_fastq(fastq_files,outdir,prefix,suffix,samples)
+def _split_fastq_batches(inputs, outdir, samples={}, codec=None, workers=1, max_open=256):
+    
+    if not os.path.exists(outdir):
+        os.mkdir(outdir) 
+    
+    # Split the lane/read batches, in separate processes if requested
+    args = [(fastq_files,outdir,samples,codec,max_open) for fastq_files in inputs]
+    if workers > 1 and len(args) > 1:
+        pool = multiprocessing.Pool(processes=min(workers,len(args)))
+        try:
+            batch_counts = pool.map(_split_fastq_batch,args,chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        batch_counts = map(_split_fastq_batch,args)
             
     # Write the multiplex metrics
     prefix = os.path.commonprefix([os.path.basename(f) for f in reduce(operator.add,inputs)]).strip("_")
-    metrics_file = _write_metrics(counts,outdir,prefix,samples)
+    metrics_file = _write_metrics(_merge_counts(inputs,batch_counts),outdir,prefix,samples)
+    
+def _split_fastq_batch(args):
+    fastq_files, outdir, samples, codec, max_open = args
+    fastq_names = [os.path.basename(f) for f in fastq_files]
+    prefix = os.path.commonprefix(fastq_names).strip("_")
+    suffix = os.path.commonprefix([f[::-1] for f in fastq_names])[::-1]
+    return _split_fastq(fastq_files,outdir,prefix,suffix,samples,codec,max_open)
+    
+def _merge_counts(inputs, batch_counts):
+    """Merge the counts of the lane/read batches into the number of records per index.
+    The reads of a lane contain the same records so they are counted once per lane"""
+    
+    lane_counts = {}
+    for fastq_files, counts in zip(inputs,batch_counts):
+        m = re.search(r'_(L\d+)_([RI]\d+)_', fastq_files[0])
+        lane = m.group(1) if m else fastq_files[0]
+        for index, count in counts.items():
+            lane_counts.setdefault(lane,{})
+            lane_counts[lane][index] = max(count,lane_counts[lane].get(index,0))
+    counts = {}
+    for lc in lane_counts.values():
+        for index, count in lc.items():
+            counts[index] = counts.get(index,0) + count
+    return counts
     
-def _split_fastq(fastq_input, outdir, outprefix, outsuffix, samples):
+def _split_fastq(fastq_input, outdir, outprefix, outsuffix, samples, codec=None, max_open=256):
 
     if not os.path.exists(outdir):
         os.mkdir(outdir) 
     
-    out_handles = {}    
+    # records are buffered per index and written in large blocks
+    writers = FastQWriterPool(codec=codec,max_open=max_open)
+    out_files = {}
     for file in fastq_input:
-        iter = FastQParser(file)
+        iter = FastQBlockParser(file,codec=codec)
         for record in iter:
             index = record[0].rfind(":")
             i = record[0][index+1:].strip()
-            # open a file handle to the index file if it's not already available
-            if i not in out_handles:
-                out_file = os.path.join(outdir,"%s_%s%s" % (outprefix,samples.get(i,i),outsuffix))
-                out_handles[i] = FastQWriter(out_file)
-            out_handles[i].write(record)
+            if i not in out_files:
+                out_files[i] = os.path.join(outdir,"%s_%s%s" % (outprefix,samples.get(i,i),outsuffix))
+            writers.write(out_files[i],record)
+        iter.close()
     
     # summarize the written records and close the file handles
+    writers.close()
+    written = writers.rwritten()
     counts = {}
-    for i,oh in out_handles.items():
-        counts[i] = oh.rwritten()
-        oh.close()
+    for i,out_file in out_files.items():
+        counts[i] = written[out_file]
         
     return counts
     
@@ -80,6 +114,13 @@ if __name__ == "__main__":
     parser = OptionParser()
     parser.add_option("-o", "--outdir", dest="outdir", default=os.getcwd())
     parser.add_option("-s", "--samplesheet", dest="samplesheet", default={})
+    parser.add_option("-c", "--codec", dest="codec", default=None, choices=CODECS,
+                      help="codec to use for compressed files, one of %s. Default is to use pigz or pbzip2 if available, "\
+                      "and otherwise to (de)compress in a separate thread" % ", ".join(CODECS))
+    parser.add_option("-w", "--workers", dest="workers", type="int", default=1,
+                      help="number of lane/read batches to split in parallel")
+    parser.add_option("-m", "--max-open", dest="max_open", type="int", default=256,
+                      help="maximum number of output files each worker keeps open")
     options, args = parser.parse_args()
     
-    main(args,options.outdir,options.samplesheet)
+    main(args,options.outdir,options.samplesheet,options.codec,options.workers,options.max_open)
@@ -0,0 +1,382 @@
+import os
+import unittest
+import tempfile
+import shutil
+import pickle
+import json
+import numpy as np
+from scilifelab.bcbio.qc import RunMetricsFileIndex, FlowcellRunMetrics, SampleRunMetrics, ExtendedPicardMetricsParser, encode_picard_metrics, picard_histogram, RTAChart, IlluminaXMLParser, parse_html_tables, parse_demultiplex_stats, FastQCData, ExtendedFastQCParser, FASTQC_MODULES
+
+filedir = os.path.abspath(os.path.dirname(os.path.realpath(__file__)))
+
+files = ['1_120829_AA001AAAXX_barcode/1_120829_AA001AAAXX_nophix.bc_metrics',
+         '1_120829_AA001AAAXX_barcode/1_120829_AA001AAAXX_nophix_1_1_fastq.txt',
+         '1_120829_AA001AAAXX_nophix.filter_metrics',
+         '1_120829_AA001AAAXX_nophix_1-sort-dup.align_metrics',
+         '1_120829_AA001AAAXX_nophix_1-sort-dup.dup_metrics',
+         '1_120829_AA001AAAXX_nophix_1-sort-dup.insert_metrics',
+         '1_120829_AA001AAAXX_nophix_10-sort-dup.align_metrics',
+         '1_120829_AA001AAAXX_nophix_1_1_fastq_screen.txt',
+         '11_120829_AA001AAAXX_nophix_1-sort-dup.align_metrics',
+         '2_120829_AA001AAAXX_2_nophix.filter_metrics',
+         'fastqc/1_120829_AA001AAAXX_nophix_1-sort-dup_fastqc/fastqc_data.txt',
+         'fastqc/1_120829_AA001AAAXX_nophix_10-sort-dup_fastqc/fastqc_data.txt',
+         'tmp/1_120829_AA001AAAXX_nophix_1-sort-dup.align_metrics',
+         ]
+
+class TestRunMetricsFileIndex(unittest.TestCase):
+    def setUp(self):
+        ## NB: RunMetrics ignores paths matching 'tmp' so don't use /tmp
+        self.rootdir = tempfile.mkdtemp(prefix="test_bcbio_qc_", dir=filedir)
+        for f in files:
+            if not os.path.exists(os.path.dirname(os.path.join(self.rootdir, f))):
+                os.makedirs(os.path.dirname(os.path.join(self.rootdir, f)))
+            open(os.path.join(self.rootdir, f), "w").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def _get(self, index, *args):
+        return sorted([os.path.relpath(x, self.rootdir) for x in index.get(*args)])
+
+    def test_1_index(self):
+        """Test classification of files by kind, lane and barcode id"""
+        index = RunMetricsFileIndex(self.rootdir, ignore=SampleRunMetrics.reignore)
+        self.assertEqual(len(index), len(files) - 1)
+        self.assertEqual(self._get(index, "picard", 1, 1), ['1_120829_AA001AAAXX_nophix_1-sort-dup.align_metrics',
+                                                            '1_120829_AA001AAAXX_nophix_1-sort-dup.dup_metrics',
+                                                            '1_120829_AA001AAAXX_nophix_1-sort-dup.insert_metrics'])
+        self.assertEqual(self._get(index, "picard", "11", "1"), ['11_120829_AA001AAAXX_nophix_1-sort-dup.align_metrics'])
+        self.assertEqual(self._get(index, "fastq_screen", 1, 1), ['1_120829_AA001AAAXX_nophix_1_1_fastq_screen.txt'])
+        self.assertEqual(self._get(index, "fastqc", 1, 1), ['fastqc/1_120829_AA001AAAXX_nophix_1-sort-dup_fastqc/fastqc_data.txt'])
+        self.assertEqual(self._get(index, "bc_metrics", 1), ['1_120829_AA001AAAXX_barcode/1_120829_AA001AAAXX_nophix.bc_metrics'])
+        self.assertEqual(self._get(index, "filter_metrics", 1), ['1_120829_AA001AAAXX_nophix.filter_metrics'])
+        self.assertEqual(self._get(index, "filter_metrics", 2, 2), ['2_120829_AA001AAAXX_2_nophix.filter_metrics'])
+        self.assertEqual(self._get(index, "picard", 3, 1), [])
+
+    def test_2_shared_index(self):
+        """Test sharing a flowcell file index with sample run metrics objects"""
+        fcobj = FlowcellRunMetrics(self.rootdir, "120829", "AA001AAAXX")
+        srm = SampleRunMetrics(self.rootdir, "AA001AAAXX", "120829", "1", "P1_101F_index1", 1, "J.Doe_00_01", file_index=fcobj.file_index)
+        self.assertIs(srm.file_index, fcobj.file_index)
+        self.assertEqual(srm.files, fcobj.files)
+
+    def test_3_pickle(self):
+        """Test pickling run metrics objects, as done when passing them from worker processes"""
+        srm = SampleRunMetrics(self.rootdir, "AA001AAAXX", "120829", "1", "P1_101F_index1", 1, "J.Doe_00_01")
+        new_srm = pickle.loads(pickle.dumps(srm, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(dict(srm), dict(new_srm))
+        self.assertIsInstance(new_srm, SampleRunMetrics)
+        self.assertEqual(new_srm.files, [])
+        self.assertIsNotNone(new_srm.log)
+
+    def test_4_sample_files(self):
+        """Test getting the files read for a sample and a flowcell"""
+        index = RunMetricsFileIndex(self.rootdir, ignore=SampleRunMetrics.reignore)
+        self.assertEqual([os.path.relpath(x, self.rootdir) for x in index.sample_files(1, 1)],
+                         ['1_120829_AA001AAAXX_barcode/1_120829_AA001AAAXX_nophix.bc_metrics',
+                          '1_120829_AA001AAAXX_nophix_1-sort-dup.align_metrics',
+                          '1_120829_AA001AAAXX_nophix_1-sort-dup.dup_metrics',
+                          '1_120829_AA001AAAXX_nophix_1-sort-dup.insert_metrics',
+                          '1_120829_AA001AAAXX_nophix_1_1_fastq_screen.txt',
+                          'fastqc/1_120829_AA001AAAXX_nophix_1-sort-dup_fastqc/fastqc_data.txt'])
+        self.assertEqual([os.path.relpath(x, self.rootdir) for x in index.flowcell_files()],
+                         ['1_120829_AA001AAAXX_barcode/1_120829_AA001AAAXX_nophix.bc_metrics',
+                          '1_120829_AA001AAAXX_nophix.filter_metrics'])
+
+    def test_5_derived_metrics(self):
+        """Test calculation of summaries used in reports"""
+        srm = SampleRunMetrics(self.rootdir, "AA001AAAXX", "120829", "1", "P1_101F_index1", 1, "J.Doe_00_01")
+        srm["bc_count"] = "19756915"
+        srm["fastqc"] = {"stats":{"Per sequence quality scores":{"Quality":["2", "30", "38"], "Count":["10.0", "30.0", "60.0"]}}}
+        srm["picard_metrics"] = {"DUP_metrics":{"PERCENT_DUPLICATION":"0.1234"}}
+        srm.calc_derived_metrics()
+        self.assertEqual(srm["derived"], {"avg_qv":32.0, "pct_q30":90.0, "read_count_m":19.8, "duplication_rate":0.1234})
+        srm["fastqc"] = {}
+        srm["bc_count"] = None
+        srm.calc_derived_metrics()
+        self.assertEqual(srm["derived"], {"avg_qv":None, "pct_q30":None, "read_count_m":None, "duplication_rate":0.1234})
+        fcobj = FlowcellRunMetrics(self.rootdir, "120829", "AA001AAAXX")
+        fcobj["illumina"]["Summary"] = {"read1":{"Read":"1", "1":{"key":"1", "ErrRatePhiX":"0.5"}, "2":{"key":"2", "ErrRatePhiX":"0.7"}},
+                                        "read3":{"Read":"3", "1":{"key":"1", "ErrRatePhiX":"1.5"}, "2":{"key":"2"}}}
+        fcobj.calc_derived_metrics()
+        self.assertEqual(fcobj["derived"], {"phix_error_rate":{"1":1.0}})
+
+align_metrics = """## net.sf.picard.metrics.StringHeader
+# net.sf.picard.analysis.CollectAlignmentSummaryMetrics INPUT=1_120829_AA001AAAXX_nophix_1-sort-dup.bam
+## METRICS CLASS	net.sf.picard.analysis.AlignmentSummaryMetrics
+CATEGORY	TOTAL_READS	PF_READS	PCT_PF_READS	MEAN_READ_LENGTH	BAD_CYCLES	STRAND_BALANCE	SAMPLE
+FIRST_OF_PAIR	1000	990	0.99	101	0	0.5	
+SECOND_OF_PAIR	1000	980	0.98	101	0	?	
+PAIR	2000	1970	0.985	101	0	0.5	
+
+"""
+
+insert_metrics = """## net.sf.picard.metrics.StringHeader
+# net.sf.picard.analysis.CollectInsertSizeMetrics INPUT=1_120829_AA001AAAXX_nophix_1-sort-dup.bam
+## METRICS CLASS	net.sf.picard.analysis.InsertSizeMetrics
+MEDIAN_INSERT_SIZE	MEAN_INSERT_SIZE	STANDARD_DEVIATION	PAIR_ORIENTATION
+180	185.2	NaN	FR
+
+## HISTOGRAM	java.lang.Integer
+insert_size	All_Reads.fr_count
+170	12
+180	30
+190	8
+
+"""
+
+class TestPicardMetrics(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_bcbio_qc_", dir=filedir)
+        self.files = []
+        for ext, data in [("align_metrics", align_metrics), ("insert_metrics", insert_metrics)]:
+            self.files.append(os.path.join(self.rootdir, "1_120829_AA001AAAXX_nophix_1-sort-dup.{}".format(ext)))
+            with open(self.files[-1], "w") as fh:
+                fh.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_1_strings(self):
+        """Test parsing picard metrics as strings"""
+        metrics = ExtendedPicardMetricsParser().extract_metrics(self.files)
+        self.assertEqual(metrics["AL_FIRST_OF_PAIR"]["PF_READS"], "990")
+        self.assertEqual(metrics["AL_SECOND_OF_PAIR"]["PF_READS"], "980")
+        self.assertEqual(metrics["INS_metrics"]["MEAN_INSERT_SIZE"], "185.2")
+        self.assertEqual(metrics["INS_hist"]["insert_size"], ["170", "180", "190"])
+
+    def test_2_typed(self):
+        """Test parsing picard metrics as numbers and arrays"""
+        metrics = ExtendedPicardMetricsParser(typed=True).extract_metrics(self.files)
+        self.assertEqual(metrics["AL_FIRST_OF_PAIR"]["PF_READS"], 990)
+        self.assertEqual(metrics["AL_SECOND_OF_PAIR"]["PCT_PF_READS"], 0.98)
+        self.assertEqual(metrics["AL_SECOND_OF_PAIR"]["STRAND_BALANCE"], "?")
+        self.assertIsNone(metrics["AL_PAIR"]["SAMPLE"])
+        self.assertEqual(metrics["INS_metrics"]["MEDIAN_INSERT_SIZE"], 180)
+        self.assertIsNone(metrics["INS_metrics"]["STANDARD_DEVIATION"])
+        self.assertEqual(metrics["INS_metrics"]["PAIR_ORIENTATION"], "FR")
+        self.assertEqual(metrics["INS_hist"]["All_Reads.fr_count"].dtype, np.int64)
+        self.assertEqual(metrics["INS_hist"]["All_Reads.fr_count"].sum(), 50)
+
+    def test_3_encode(self):
+        """Test json encoding of typed picard metrics"""
+        metrics = ExtendedPicardMetricsParser(typed=True).extract_metrics(self.files)
+        encoded = json.loads(json.dumps(encode_picard_metrics(metrics)))
+        self.assertEqual(encoded["INS_hist"]["insert_size"], [170, 180, 190])
+        hist = picard_histogram(encoded["INS_hist"])
+        self.assertTrue((hist["All_Reads.fr_count"] == metrics["INS_hist"]["All_Reads.fr_count"]).all())
+        strings = ExtendedPicardMetricsParser().extract_metrics(self.files)
+        self.assertTrue(len(json.dumps(encoded)) < len(json.dumps(strings)))
+
+chart_xml = """<?xml version="1.0"?>
+<FlowCellData Type="ErrorRate" Cycle="{cycle}">
+  <Layout NumLanes="2" RowsPerLane="2" ColsPerLane="2" />
+  <TileInfo>
+{tiles}
+  </TileInfo>
+</FlowCellData>
+"""
+
+class TestRTAChart(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_bcbio_qc_", dir=filedir)
+        os.makedirs(os.path.join(self.rootdir, "ErrorRate"))
+        self.files = []
+        for cycle in [1, 2, 10]:
+            tiles = []
+            for lane in [1, 2]:
+                for tile in [1, 2, 3, 4]:
+                    if lane == 2 and tile == 4 and cycle == 10:
+                        val = "NaN"
+                    elif lane == 1 and tile == 3:
+                        val = str(10.0 + cycle)
+                    else:
+                        val = str(lane + 0.01 * tile)
+                    tiles.append('    <TL Key="{}_{}" Value="{}" />'.format(lane, tile, val))
+            self.files.append(os.path.join(self.rootdir, "ErrorRate", "Chart_{}.xml".format(cycle)))
+            with open(self.files[-1], "w") as fh:
+                fh.write(chart_xml.format(cycle=cycle, tiles="\n".join(tiles)))
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_1_from_files(self):
+        """Test parsing chart files into a lane x tile x cycle array"""
+        chart = RTAChart.from_files(self.files[::-1])
+        self.assertEqual(chart.data.shape, (2, 4, 3))
+        self.assertEqual(chart.data.dtype, np.float32)
+        self.assertEqual(chart.cycles, [1, 2, 10])
+        self.assertAlmostEqual(chart.data[1, 1, 1], 2.02, places=5)
+        self.assertTrue(np.isnan(chart.data[1, 3, 2]))
+        self.assertEqual(chart.header["NumLanes"], "2")
+
+    def test_2_aggregates(self):
+        """Test lane aggregates and tile outliers"""
+        chart = RTAChart.from_files(self.files)
+        self.assertEqual(chart.lane_cycle_mean().shape, (2, 3))
+        self.assertAlmostEqual(chart.lane_mean()[1], np.nanmean(chart.data[1]), places=5)
+        self.assertEqual(chart.tile_outliers(), [(1, 3)])
+
+    def test_3_serialize(self):
+        """Test compact serialization"""
+        chart = RTAChart.from_files(self.files)
+        d = json.loads(json.dumps(chart.to_dict()))
+        new_chart = RTAChart.from_dict(d)
+        self.assertTrue(np.array_equal(np.isnan(chart.data), np.isnan(new_chart.data)))
+        self.assertTrue(np.allclose(np.nan_to_num(chart.data), np.nan_to_num(new_chart.data)))
+        self.assertEqual(new_chart.cycles, [1, 2, 10])
+
+    def test_4_parser(self):
+        """Test full RTA parsing with IlluminaXMLParser"""
+        data = IlluminaXMLParser().parse(self.files, fullRTA=True)
+        self.assertEqual(RTAChart.from_dict(data["ErrorRate"]).data.shape, (2, 4, 3))
+        self.assertIsNone(data["FWHM"])
+
+demultiplex_stats_htm = """<html>
+<head><title>AA001AAAXX Demultiplex Results</title></head>
+<body>
+<h1>Flowcell: AA001AAAXX</h1>
+<h2>Barcode lane statistics</h2>
+<div ID="ScrollableTableHeaderDiv"><table width="100%">
+<col width="4%">
+<tr><th>Lane</th><th>Sample ID</th><th>Sample Ref</th><th>Index</th><th>Description</th><th>Control</th><th>Project</th><th>Yield (Mbases)</th><th>% PF</th><th># Reads</th><th>% of raw clusters per lane</th><th>% Perfect Index Reads</th><th>% One Mismatch Reads (Index)</th><th>% of &gt;= Q30 Bases (PF)</th><th>Mean Quality Score (PF)</th></tr>
+</table></div>
+<div ID="ScrollableTableBodyDiv"><table width="100%">
+<col width="4%">
+<tr>
+<td>1</td>
+<td>P1_101F_index1</td>
+<td>hg19</td>
+<td>TGACCA</td>
+<td></td>
+<td>N</td>
+<td>J__Doe_00_01</td>
+<td>1,234</td>
+<td>100.00</td>
+<td>12,345,678</td>
+<td>50.00</td>
+<td>98.00</td>
+<td>2.00</td>
+<td>90.00</td>
+<td>36.00</td>
+</tr>
+</table></div>
+<p></p>
+<h2>Sample information</h2>
+<div ID="ScrollableTableHeaderDiv"><table width="100%">
+<tr><th>Sample<p></p>ID</th><th>Recipe</th><th>Operator</th><th>Directory</th></tr>
+</table></div>
+<div ID="ScrollableTableBodyDiv"><table width="100%">
+<tr><td>P1_101F_index1</td><td>R1</td><td>N</td><td>/path/to/Sample_P1_101F_index1</td></tr>
+</table></div>
+<p>CASAVA-1.8.2</p>
+</body>
+</html>
+"""
+
+class TestDemultiplexStats(unittest.TestCase):
+    def test_1_parse_html_tables(self):
+        """Test extracting html tables in a single pass"""
+        tables = parse_html_tables("<table><tr><th>a<p></p>b</th><th><b>c</b></th><th>&gt;=&#65;</th></tr><tr><td></td><td>\n</td><td>1<br>2</td></tr></table><table><tr><td>x</td></tr></table>")
+        self.assertEqual(tables, [[[("th", "None"), ("th", "c"), ("th", ">=A")], [("td", "None"), ("td", "\n"), ("td", "None")]], [[("td", "x")]]])
+
+    def test_2_parse_demultiplex_stats(self):
+        """Test parsing a Demultiplex_Stats.htm document"""
+        metrics = parse_demultiplex_stats(demultiplex_stats_htm)
+        self.assertEqual(len(metrics["Barcode_lane_statistics"]), 1)
+        bc = metrics["Barcode_lane_statistics"][0]
+        self.assertEqual(bc["Sample ID"], "P1_101F_index1")
+        self.assertEqual(bc["# Reads"], "12,345,678")
+        self.assertEqual(bc["% of >= Q30 Bases (PF)"], "90.00")
+        self.assertEqual(bc["Description"], "None")
+        self.assertEqual(metrics["Sample_information"], [{"Sample ID":"P1_101F_index1", "Recipe":"R1", "Operator":"N", "Directory":"/path/to/Sample_P1_101F_index1"}])
+
+fastqc_data = """##FastQC	0.10.1
+>>Basic Statistics	pass
+#Measure	Value	
+Filename	1_120829_AA001AAAXX_nophix_1-sort-dup.bam	
+Total Sequences	1000	
+Sequence length	101	
+%GC	48	
+>>END_MODULE
+>>Per base sequence quality	warn
+#Base	Mean	Median	Lower Quartile	Upper Quartile	10th Percentile	90th Percentile
+1	32.5	34.0	31.0	34.0	31.0	34.0
+2-3	30.25	33.0	30.0	34.0	26.0	34.0
+>>END_MODULE
+>>Per sequence quality scores	pass
+#Quality	Count
+2	10.0
+30	30.0
+38	60.0
+>>END_MODULE
+>>Sequence Duplication Levels	fail
+#Total Duplicate Percentage	55.5
+#Duplication Level	Relative count
+1	100.0
+2	20.5
+>>END_MODULE
+>>Overrepresented sequences	pass
+>>END_MODULE
+"""
+
+class TestFastQCData(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_bcbio_qc_", dir=filedir)
+        with open(os.path.join(self.rootdir, "fastqc_data.txt"), "w") as fh:
+            fh.write(fastqc_data)
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_1_columns(self):
+        """Test reading typed FastQC module columns and flags"""
+        data = FastQCData.from_file(os.path.join(self.rootdir, "fastqc_data.txt"))
+        self.assertEqual(data.version, "0.10.1")
+        self.assertEqual(data.modules(), ["Basic Statistics", "Per base sequence quality", "Per sequence quality scores",
+                                          "Sequence Duplication Levels", "Overrepresented sequences"])
+        self.assertEqual(data.status["Per base sequence quality"], "warn")
+        self.assertEqual(data.status["Sequence Duplication Levels"], "fail")
+        pbsq = data.columns("Per base sequence quality")
+        self.assertEqual(pbsq["Base"], ["1", "2-3"])
+        self.assertEqual(pbsq["Mean"].dtype, np.float64)
+        self.assertEqual(pbsq["Mean"].tolist(), [32.5, 30.25])
+        psqs = data.columns("Per sequence quality scores")
+        self.assertEqual(psqs["Quality"].dtype, np.int64)
+        self.assertEqual(psqs["Count"].tolist(), [10.0, 30.0, 60.0])
+        sdl = data.columns("Sequence Duplication Levels")
+        self.assertEqual(sdl["Total Duplicate Percentage"], 55.5)
+        self.assertEqual(sdl["Relative count"].tolist(), [100.0, 20.5])
+        self.assertEqual(data.columns("Basic Statistics")["Value"], ["1_120829_AA001AAAXX_nophix_1-sort-dup.bam", "1000", "101", "48"])
+        self.assertEqual(data.columns("Overrepresented sequences"), {})
+        self.assertEqual(data.columns("Kmer Content"), {})
+
+    def test_2_strings(self):
+        """Test that string columns are the same as when reading each module separately"""
+        fqparser = ExtendedFastQCParser(self.rootdir)
+        data = fqparser.get_fastqc_data()
+        for module in FASTQC_MODULES:
+            section = fqparser._fastqc_data_section(module)
+            if len(section) == 0:
+                expected = {}
+            else:
+                header = [x.strip("#") for x in section[0].rstrip("\t").split("\t")]
+                rows = np.array([l.split("\t") for l in section[1:]])
+                expected = {header[i]:rows[:,i].tolist() for i in range(0,len(header))}
+            self.assertEqual(data.strings(module), expected)
+        self.assertEqual(fqparser.get_fastqc_summary()["Per sequence quality scores"], {"Quality":["2", "30", "38"], "Count":["10.0", "30.0", "60.0"]})
+
+    def test_3_sample_metrics(self):
+        """Test reading FastQC metrics of a sample whose FastQC directory holds several files"""
+        fastqc_dir = os.path.join(self.rootdir, "fastqc", "1_120829_AA001AAAXX_nophix_1-sort-dup_fastqc")
+        os.makedirs(fastqc_dir)
+        index = RunMetricsFileIndex(None)
+        for f in ["summary.txt", "fastqc_report.html", "fastqc_data.txt"]:
+            with open(os.path.join(fastqc_dir, f), "w") as fh:
+                fh.write(fastqc_data if f == "fastqc_data.txt" else "PASS\tBasic Statistics\n")
+            index.add(os.path.join(fastqc_dir, f))
+        srm = SampleRunMetrics(self.rootdir, "AA001AAAXX", "120829", "1", "P1_101F_index1", 1, "J.Doe_00_01", file_index=index)
+        srm.read_fastqc_metrics()
+        self.assertEqual(srm["fastqc"]["stats"]["Per sequence quality scores"], {"Quality":["2", "30", "38"], "Count":["10.0", "30.0", "60.0"]})
+        self.assertEqual(srm["fastqc"]["status"]["Sequence Duplication Levels"], "fail")
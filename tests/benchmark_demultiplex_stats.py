@@ -0,0 +1,67 @@
+"""
+Benchmark parsing of Demultiplex_Stats.htm documents: the single pass
+table parser used by FlowcellRunMetrics against the previous implementation
+that builds a BeautifulSoup tree three times.
+usage:
+    python %s [-l lanes] [-s samples per lane] [-r repeats] [Demultiplex_Stats.htm]
+
+If no file is given, a document is generated.
+"""
+import sys
+import time
+from optparse import OptionParser
+from bs4 import BeautifulSoup
+
+from scilifelab.bcbio.qc import parse_demultiplex_stats
+from generate_test_data import generate_demultiplex_stats_htm
+
+def beautifulsoup_demultiplex_stats(htm_doc):
+    """Previous implementation of FlowcellRunMetrics.parse_demultiplex_stats_htm"""
+    soup = BeautifulSoup(htm_doc)
+    allrows = soup.findAll("tr")
+    column_gen=(row.findAll("th") for row in allrows)
+    parse_row = lambda row: row
+    headers = [h for h in map(parse_row, column_gen) if h]
+    bc_header = [str(x.string) for x in headers[0]]
+    smp_header = [str(x.string) for x in headers[1]]
+    smp_header[0] = "Sample ID"
+    metrics = {}
+    soup = BeautifulSoup(htm_doc)
+    table = soup.findAll("table")[1]
+    rows = table.findAll("tr")
+    column_gen = (row.findAll("td") for row in rows)
+    parse_row = lambda row: {bc_header[i]:str(row[i].string) for i in range(0, len(bc_header)) if row}
+    metrics["Barcode_lane_statistics"] =  map(parse_row, column_gen)
+    soup = BeautifulSoup(htm_doc)
+    table = soup.findAll("table")[3]
+    rows = table.findAll("tr")
+    column_gen = (row.findAll("td") for row in rows)
+    parse_row = lambda row: {smp_header[i]:str(row[i].string) for i in range(0, len(smp_header)) if row}
+    metrics["Sample_information"] = map(parse_row, column_gen)
+    return metrics
+
+def main(htm_doc, repeats):
+    results = []
+    print "\t".join(["parser", "seconds"])
+    for fn in [beautifulsoup_demultiplex_stats, parse_demultiplex_stats]:
+        t0 = time.time()
+        for i in range(repeats):
+            metrics = fn(htm_doc)
+        print "\t".join([fn.__name__, "%.3f" % ((time.time() - t0) / repeats)])
+        results.append(metrics)
+    assert results[0] == results[1], "parsers give different results"
+    print "{} barcode lane statistics rows, {} sample information rows".format(len(results[1]["Barcode_lane_statistics"]), len(results[1]["Sample_information"]))
+
+if __name__ == "__main__":
+    parser = OptionParser(usage=__doc__ % sys.argv[0])
+    parser.add_option("-l", "--lanes", dest="lanes", type="int", default=8)
+    parser.add_option("-s", "--samples", dest="samples", type="int", default=96)
+    parser.add_option("-r", "--repeats", dest="repeats", type="int", default=3)
+    options, args = parser.parse_args()
+
+    if args:
+        with open(args[0]) as fh:
+            htm_doc = fh.read()
+    else:
+        htm_doc = generate_demultiplex_stats_htm(no_lanes=options.lanes, no_samples=options.samples)
+    main(htm_doc, options.repeats)
@@ -0,0 +1,166 @@
+"""
+Benchmark statusdb access of the connection classes and the report
+commands against an in-memory CouchDB stand-in loaded with a synthetic
+dataset. For each operation, the number of requests, bytes transferred
+and wall time are reported. Every operation starts from a new process
+state, i.e. without shared sessions or cached views.
+usage:
+    python %s [-p projects] [-f flowcells] [-s samples per lane] [-r repeats] [--replica] [--save file] [--baseline file]
+
+With --save, request counts are written to a json file. With
+--baseline, request counts are compared to those of a saved file, and
+the exit status is 1 if any operation makes more requests.
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import tempfile
+import itertools
+from optparse import OptionParser
+
+from scilifelab.db import clear_sessions
+from scilifelab.db.replica import clear_replicas
+from scilifelab.db.statusdb import SampleRunMetricsConnection, FlowcellRunMetricsConnection, ProjectSummaryConnection
+from couchdb_standin import CouchStandin
+from generate_test_data import generate_statusdb
+
+def sample_status(s_con, fc_con, p_con, project_id, fc_id):
+    """Database access of pm report sample_status"""
+    project = p_con.get_entry(project_id)
+    samples = p_con.map_srm_to_name(project_id, include_all=False, fc_id=fc_id)
+    srm_samples = {x["name"]:x for x in s_con.get_sample_names(project_id)}
+    srm_keys = {k:("{}_{}".format(x["date"], x["flowcell"]), x["lane"], x["barcode_name"]) for k, x in srm_samples.items()}
+    read_counts = s_con.get_read_counts(project_id)
+    avg_qvs = s_con.get_avg_qv(project_id)
+    srm_entries = s_con.get_entries([k for k in samples.keys() if k in srm_samples and srm_samples[k]["flowcell"] == fc_id and
+                                     not (srm_keys[k] in read_counts and srm_keys[k] in avg_qvs)])
+    phix_error_rates = {}
+    res = []
+    for k, v in samples.items():
+        s = srm_samples.get(k, None)
+        if s is None or (not v["id"] is None and not s["flowcell"] == fc_id):
+            continue
+        fc = "{}_{}".format(s["date"], s["flowcell"])
+        if not fc in phix_error_rates:
+            phix_error_rates[fc] = fc_con.get_lane_phix_error_rates(fc)
+        if phix_error_rates[fc].get(str(s["lane"]), None) is None:
+            phix_error_rates[fc][str(s["lane"])] = fc_con.get_phix_error_rate(fc, s["lane"])
+        if k in srm_entries:
+            read_count, avg_qv = srm_entries[k]["bc_count"], s_con.calc_avg_qv(k, srm=srm_entries[k])
+        else:
+            read_count, avg_qv = read_counts.get(srm_keys[k], None), avg_qvs.get(srm_keys[k], None)
+        res.append((phix_error_rates[fc][str(s["lane"])], read_count, avg_qv, p_con.get_ordered_amount(project_id),
+                    project["samples"].get(v["sample"], {}).get("customer_name", None)))
+    return res
+
+def project_status(s_con, fc_con, p_con, project_id, fc_id):
+    """Database access of pm report project_status"""
+    project = p_con.get_entry(project_id)
+    samples = p_con.map_srm_to_name(project_id)
+    srm_sequences = s_con.get_sequences(project_id)
+    sequenced_amounts = p_con.get_sequenced_amounts(project_id)
+    ordered_amount = p_con.get_ordered_amount(project_id)
+    res = []
+    for k, v in samples.items():
+        if re.search("Unexpected", k):
+            continue
+        project_sample = project["samples"][v["sample"]]
+        res.append([project_sample.get("scilife_name", None), project_sample.get("status", None), ordered_amount,
+                    sequenced_amounts.get(v["sample"], project_sample.get("m_reads_sequenced", None)), srm_sequences.get(k, None)])
+    return res
+
+def get_samples(s_con, fc_con, p_con, project_id, fc_id):
+    return s_con.get_samples(fc_id)
+
+def map_name_to_srm(s_con, fc_con, p_con, project_id, fc_id):
+    return p_con.map_name_to_srm(project_id, use_bc_map=True)
+
+def read_counts(s_con, fc_con, p_con, project_id, fc_id):
+    return s_con.get_read_counts(project_id, group_level=2)
+
+OPERATIONS = [get_samples, map_name_to_srm, read_counts, sample_status, project_status]
+
+def connect(server, replica=None):
+    """Create connections as a new process would"""
+    clear_sessions()
+    clear_replicas()
+    kw = dict(username="user", password="pw", url=server.host, port=server.port, replica=replica)
+    return SampleRunMetricsConnection(**kw), FlowcellRunMetricsConnection(**kw), ProjectSummaryConnection(**kw)
+
+def measure(server, fn, *args):
+    server.stats.reset()
+    t0 = time.time()
+    value = fn(*args)
+    t = time.time() - t0
+    stats = server.stats.snapshot()
+    stats["seconds"] = t
+    return value, stats
+
+def run(server, project_id, fc_id, repeats=1, replica_dir=None):
+    """Run operations and collect request statistics.
+
+    :returns: list of (operation name, stats) tuples
+    """
+    results = []
+    replica = os.path.join(replica_dir, "replica.sqlite") if replica_dir else None
+    cons, stats = measure(server, connect, server, replica)
+    results.append(("connect", stats))
+    for op in OPERATIONS:
+        times = []
+        for i in range(repeats):
+            cons = connect(server, replica)
+            value, stats = measure(server, op, *(list(cons) + [project_id, fc_id]))
+            times.append(stats["seconds"])
+        stats["seconds"] = sum(times) / len(times)
+        results.append((op.__name__, stats))
+    return results
+
+def main(options):
+    docs = generate_statusdb(no_projects=options.projects, no_flowcells=options.flowcells, no_samples=options.samples, seed=1)
+    server = CouchStandin()
+    for dbname, dbdocs in docs.items():
+        server.load(dbname, dbdocs)
+    server.start()
+    ## Benchmark the project with the most samples
+    srm = [x for x in docs["samples"] if x.get("entity_type", None) == "sample_run_metrics"]
+    project_id = sorted([(len(list(g)), k) for k, g in itertools.groupby(sorted([x["sample_prj"] for x in srm]))])[-1][1]
+    fc_id = [x["flowcell"] for x in srm if x["sample_prj"] == project_id][0]
+    replica_dir = tempfile.mkdtemp(prefix="benchmark_statusdb_") if options.replica else None
+    try:
+        print "{} sample run metrics, {} flowcells, {} projects; project {}, flowcell {}".format(len(srm), options.flowcells, options.projects, project_id, fc_id)
+        results = run(server, project_id, fc_id, options.repeats, replica_dir)
+    finally:
+        server.stop()
+        if replica_dir:
+            shutil.rmtree(replica_dir)
+    print "\t".join(["operation", "requests", "kB sent", "kB received", "seconds", "requests by kind"])
+    for name, stats in results:
+        print "\t".join([name, str(stats["requests"]), "%.1f" % (stats["bytes_in"] / 1024.0), "%.1f" % (stats["bytes_out"] / 1024.0),
+                         "%.3f" % stats["seconds"], ",".join(["{}:{}".format(k, v) for k, v in sorted(stats["by_kind"].items())])])
+    counts = {name:stats["requests"] for name, stats in results}
+    if options.save:
+        with open(options.save, "w") as fh:
+            json.dump(counts, fh, indent=1, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as fh:
+            baseline = json.load(fh)
+        regressions = [(k, baseline[k], v) for k, v in sorted(counts.items()) if k in baseline and v > baseline[k]]
+        for k, before, after in regressions:
+            print "REGRESSION: {} makes {} requests, baseline {}".format(k, after, before)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    parser = OptionParser(usage=__doc__ % sys.argv[0])
+    parser.add_option("-p", "--projects", dest="projects", type="int", default=100)
+    parser.add_option("-f", "--flowcells", dest="flowcells", type="int", default=100)
+    parser.add_option("-s", "--samples", dest="samples", type="int", default=12)
+    parser.add_option("-r", "--repeats", dest="repeats", type="int", default=3)
+    parser.add_option("--replica", dest="replica", action="store_true", default=False)
+    parser.add_option("--save", dest="save", default=None)
+    parser.add_option("--baseline", dest="baseline", default=None)
+    options, args = parser.parse_args()
+    main(options)
@@ -0,0 +1,424 @@
+"""
+In-memory stand-in for a CouchDB server, implementing the subset of
+the http api used by scilifelab.db: databases, documents, inline
+attachments, _all_docs, _bulk_docs, _changes and views of design
+documents.
+
+Views are evaluated with the python map functions of
+scilifelab.db.statusdb.REPLICA_SCHEMAS; a view is available if a
+design document in the database defines it. Every request is counted,
+so that benchmarks and tests can check how many requests an operation
+makes and how many bytes it transfers.
+
+usage:
+    server = CouchStandin()
+    server.load("samples", docs)
+    server.start()
+    con = SampleRunMetricsConnection(username="u", password="p", url=server.host, port=server.port)
+    ...
+    server.stop()
+"""
+import json
+import base64
+import hashlib
+import urllib
+import urlparse
+import bisect
+import socket
+import threading
+import BaseHTTPServer
+import SocketServer
+
+from scilifelab.db.statusdb import REPLICA_SCHEMAS
+from scilifelab.db.replica import collate, _reduce
+
+class StandinError(Exception):
+    """Error returned as a CouchDB error response"""
+    def __init__(self, status, error, reason):
+        self.status = status
+        self.error = error
+        self.reason = reason
+
+class StandinDatabase(object):
+    """Documents, attachments and view indexes of a database.
+
+    :param name: database name
+    :param views: dict of view name, e.g. names/name, to LocalView
+    """
+    def __init__(self, name, views=None):
+        self.name = name
+        self.views = views or {}
+        self.docs = {}
+        self.attachments = {}
+        self.seqs = {}
+        self.deleted = {}
+        self.update_seq = 0
+        self.indexes = {}
+
+    def _rev(self, doc, old_rev=None):
+        n = int(old_rev.split("-")[0]) + 1 if old_rev else 1
+        return "{}-{}".format(n, hashlib.md5(json.dumps(doc, sort_keys=True)).hexdigest())
+
+    def put(self, doc):
+        """Create or update a document.
+
+        :returns: (document id, new revision)
+        """
+        doc = dict(doc)
+        doc_id = doc.setdefault("_id", hashlib.md5("{}_{}".format(self.name, self.update_seq)).hexdigest())
+        old = self.docs.get(doc_id, None)
+        if old is not None and doc.get("_rev", None) != old["_rev"]:
+            raise StandinError(409, "conflict", "Document update conflict.")
+        if old is None and doc_id in self.deleted and doc.get("_rev", None) not in (None, self.deleted[doc_id]):
+            raise StandinError(409, "conflict", "Document update conflict.")
+        attachments = {}
+        for k, v in doc.pop("_attachments", {}).items():
+            if v.get("stub", False):
+                if not (doc_id, k) in self.attachments:
+                    raise StandinError(412, "missing_stub", "Invalid attachment stub for {}".format(k))
+                attachments[k] = self.attachments[(doc_id, k)]
+            else:
+                data = base64.b64decode(v["data"])
+                attachments[k] = (v.get("content_type", "application/octet-stream"), data)
+        for k in [x for x in self.attachments.keys() if x[0] == doc_id]:
+            del self.attachments[k]
+        doc["_rev"] = self._rev(doc, old["_rev"] if old else self.deleted.get(doc_id, None))
+        if attachments:
+            doc["_attachments"] = {}
+            for k, (content_type, data) in attachments.items():
+                self.attachments[(doc_id, k)] = (content_type, data)
+                doc["_attachments"][k] = {"content_type" : content_type, "length" : len(data), "stub" : True,
+                                          "digest" : "md5-{}".format(base64.b64encode(hashlib.md5(data).digest()))}
+        self.deleted.pop(doc_id, None)
+        self.docs[doc_id] = doc
+        self._changed(doc_id)
+        return doc_id, doc["_rev"]
+
+    def delete(self, doc_id, rev):
+        """Delete a document.
+
+        :returns: revision of the deletion
+        """
+        old = self.docs.get(doc_id, None)
+        if old is None:
+            raise StandinError(404, "not_found", "missing")
+        if rev != old["_rev"]:
+            raise StandinError(409, "conflict", "Document update conflict.")
+        del self.docs[doc_id]
+        for k in [x for x in self.attachments.keys() if x[0] == doc_id]:
+            del self.attachments[k]
+        self.deleted[doc_id] = self._rev({"_id" : doc_id, "_deleted" : True}, rev)
+        self._changed(doc_id)
+        return self.deleted[doc_id]
+
+    def _changed(self, doc_id):
+        self.update_seq += 1
+        self.seqs[doc_id] = self.update_seq
+        self.indexes = {}
+
+    def get(self, doc_id):
+        if not doc_id in self.docs:
+            raise StandinError(404, "not_found", "deleted" if doc_id in self.deleted else "missing")
+        return self.docs[doc_id]
+
+    def changes(self, since=0, include_docs=False, limit=None, **kw):
+        changed = sorted([(seq, doc_id) for doc_id, seq in self.seqs.items() if seq > since])
+        if limit is not None:
+            changed = changed[:limit]
+        results = []
+        for seq, doc_id in changed:
+            if doc_id in self.docs:
+                change = {"seq" : seq, "id" : doc_id, "changes" : [{"rev" : self.docs[doc_id]["_rev"]}]}
+                if include_docs:
+                    change["doc"] = self.docs[doc_id]
+            else:
+                change = {"seq" : seq, "id" : doc_id, "changes" : [{"rev" : self.deleted[doc_id]}], "deleted" : True}
+            results.append(change)
+        return {"results" : results, "last_seq" : results[-1]["seq"] if results else self.update_seq}
+
+    def _index(self, name):
+        """Get sorted rows of a view, mapping all documents on first
+        use after a change"""
+        if not name in self.indexes:
+            if name == "_all_docs":
+                rows = [(collate(k), k, k, {"rev" : v["_rev"]}) for k, v in self.docs.items()]
+            else:
+                design, view = name.split("/")
+                if not view in self.docs.get("_design/{}".format(design), {}).get("views", {}):
+                    raise StandinError(404, "not_found", "missing_named_view")
+                if not name in self.views:
+                    raise StandinError(500, "standin_error", "no python map function for view {}".format(name))
+                rows = []
+                for doc_id, doc in self.docs.items():
+                    if doc_id.startswith("_design/"):
+                        continue
+                    for k, v in self.views[name].map_fn(doc):
+                        rows.append((collate(k), doc_id, k, v))
+            rows.sort(key=lambda row: (row[0], row[1]))
+            self.indexes[name] = (rows, [(row[0], row[1]) for row in rows])
+        return self.indexes[name]
+
+    def query(self, name, key=None, keys=None, startkey=None, endkey=None, start_key=None, end_key=None,
+              inclusive_end=True, descending=False, skip=0, limit=None, include_docs=False,
+              reduce=None, group=False, group_level=None, **kw):
+        """Query a view or _all_docs with CouchDB query options"""
+        rows, sortkeys = self._index(name)
+        startkey = start_key if startkey is None else startkey
+        endkey = end_key if endkey is None else endkey
+        if keys is not None:
+            selected = []
+            for k in keys:
+                ck = collate(k)
+                i = bisect.bisect_left(sortkeys, (ck,))
+                found = False
+                while i < len(rows) and rows[i][0] == ck:
+                    selected.append(rows[i])
+                    found = True
+                    i += 1
+                if not found and name == "_all_docs":
+                    selected.append((ck, k, k, None))
+        else:
+            if key is not None:
+                startkey = endkey = key
+            lo, hi = (endkey, startkey) if descending else (startkey, endkey)
+            i = 0 if lo is None else bisect.bisect_left(sortkeys, (collate(lo),))
+            selected = []
+            for row in rows[i:]:
+                if hi is not None and (row[0] > collate(hi) or (not inclusive_end and row[0] == collate(hi))):
+                    break
+                selected.append(row)
+            if descending:
+                selected.reverse()
+        reduce_fn = None if name == "_all_docs" else self.views[name].reduce
+        if reduce is None:
+            reduce = reduce_fn is not None
+        if reduce and reduce_fn is None:
+            raise StandinError(400, "query_parse_error", "Reduce is invalid for map-only views.")
+        if reduce:
+            if group:
+                group_level = 999
+            groups = []
+            for ck, doc_id, k, v in selected:
+                gk = k[:group_level] if group_level and isinstance(k, list) else (k if group_level else None)
+                if not groups or groups[-1][0] != gk:
+                    groups.append((gk, []))
+                groups[-1][1].append(v)
+            out = [{"key" : group_key, "value" : _reduce(reduce_fn, values)} for group_key, values in groups]
+            return {"rows" : out[skip:][:limit] if limit is not None else out[skip:]}
+        out = []
+        for ck, doc_id, k, v in selected:
+            if v is None and name == "_all_docs":
+                out.append({"key" : k, "error" : "not_found"})
+                continue
+            row = {"id" : doc_id, "key" : k, "value" : v}
+            if include_docs:
+                row["doc"] = self.docs.get(doc_id, None)
+            out.append(row)
+        out = out[skip:][:limit] if limit is not None else out[skip:]
+        return {"total_rows" : len(rows), "offset" : skip, "rows" : out}
+
+class RequestStats(object):
+    """Counts of requests and bytes transferred"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.by_kind = {}
+
+    def add(self, kind, bytes_in, bytes_out):
+        with self.lock:
+            self.requests += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.by_kind[kind] = self.by_kind.get(kind, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return {"requests" : self.requests, "bytes_in" : self.bytes_in, "bytes_out" : self.bytes_out, "by_kind" : dict(self.by_kind)}
+
+class StandinHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Request handler dispatching to the databases of the server"""
+    protocol_version = "HTTP/1.1"
+    ## Send each response in one write, avoiding delayed acks on
+    ## keep-alive connections
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._handle("HEAD")
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def _handle(self, method):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0) or 0))
+        url = urlparse.urlparse(self.path)
+        path = [urllib.unquote(x) for x in url.path.split("/") if x]
+        query = {}
+        for k, v in urlparse.parse_qsl(url.query, keep_blank_values=True):
+            try:
+                query[k] = json.loads(v)
+            except ValueError:
+                query[k] = v
+        kind = "server"
+        content_type = "application/json"
+        try:
+            with self.server.lock:
+                kind, status, data = self.server.standin.dispatch(method, path, query, json.loads(body) if body and method != "GET" else None)
+            if isinstance(data, tuple):
+                content_type, data = data
+            else:
+                data = json.dumps(data)
+        except StandinError as e:
+            status, data = e.status, json.dumps({"error" : e.error, "reason" : e.reason})
+        self.server.standin.stats.add(kind, len(body), len(data))
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if method != "HEAD":
+            self.wfile.write(data)
+
+class StandinHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def process_request(self, request, client_address):
+        self.connections.add(request)
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        self.connections.discard(request)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def close_connections(self):
+        """Close open keep-alive connections, ending their handler threads"""
+        for request in list(self.connections):
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+class CouchStandin(object):
+    """In-memory CouchDB stand-in.
+
+    :param host: host to listen on
+    :param port: port to listen on; 0 picks a free port
+    :param views: dict of database name to dict of view name to
+      LocalView; defaults to the views of REPLICA_SCHEMAS
+    """
+    def __init__(self, host="localhost", port=0, views=None):
+        if views is None:
+            views = {k:v.views for k, v in REPLICA_SCHEMAS.items()}
+        self.views = views
+        self.dbs = {}
+        self.stats = RequestStats()
+        self.httpd = StandinHTTPServer((host, port), StandinHandler)
+        self.httpd.standin = self
+        self.httpd.lock = threading.Lock()
+        self.httpd.connections = set()
+        self.host = host
+        self.port = self.httpd.server_address[1]
+        self.thread = None
+
+    def __repr__(self):
+        return "CouchStandin(http://{}:{})".format(self.host, self.port)
+
+    def create(self, dbname):
+        """Create a database if it doesn't exist"""
+        if not dbname in self.dbs:
+            self.dbs[dbname] = StandinDatabase(dbname, self.views.get(dbname, {}))
+        return self.dbs[dbname]
+
+    def load(self, dbname, docs):
+        """Add documents to a database without going through http"""
+        db = self.create(dbname)
+        for doc in docs:
+            db.put(doc)
+
+    def start(self):
+        """Serve requests in a background thread"""
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.close_connections()
+        self.httpd.server_close()
+
+    def dispatch(self, method, path, query, body):
+        """Handle a request.
+
+        :returns: (request kind, status, json object or (content type, data))
+        """
+        if not path:
+            return "server", 200, {"couchdb" : "Welcome", "version" : "1.2.0"}
+        if path[0] == "_all_dbs":
+            return "server", 200, sorted(self.dbs.keys())
+        if method == "PUT" and len(path) == 1:
+            if path[0] in self.dbs:
+                raise StandinError(412, "file_exists", "The database could not be created, the file already exists.")
+            self.create(path[0])
+            return "db", 201, {"ok" : True}
+        if not path[0] in self.dbs:
+            raise StandinError(404, "not_found", "no_db_file")
+        db = self.dbs[path[0]]
+        if len(path) == 1:
+            if method == "POST":
+                doc_id, rev = db.put(body)
+                return "doc", 201, {"ok" : True, "id" : doc_id, "rev" : rev}
+            return "db", 200, {"db_name" : db.name, "doc_count" : len(db.docs), "update_seq" : db.update_seq}
+        if path[1] == "_changes":
+            return "changes", 200, db.changes(**query)
+        if path[1] == "_bulk_docs":
+            res = []
+            for doc in body["docs"]:
+                try:
+                    if doc.get("_deleted", False):
+                        res.append({"id" : doc["_id"], "rev" : db.delete(doc["_id"], doc.get("_rev", None))})
+                    else:
+                        doc_id, rev = db.put(doc)
+                        res.append({"id" : doc_id, "rev" : rev})
+                except StandinError as e:
+                    res.append({"id" : doc.get("_id", None), "error" : e.error, "reason" : e.reason})
+            return "bulk_docs", 201, res
+        if path[1] == "_all_docs":
+            if body and "keys" in body:
+                query["keys"] = body["keys"]
+            return "all_docs", 200, db.query("_all_docs", **query)
+        if path[1] == "_design" and len(path) == 5 and path[3] == "_view":
+            if body and "keys" in body:
+                query["keys"] = body["keys"]
+            return "view", 200, db.query("{}/{}".format(path[2], path[4]), **query)
+        if path[1] == "_design":
+            path = [path[0], "_design/{}".format(path[2])] + path[3:]
+        doc_id = path[1]
+        if len(path) == 3:
+            if not (doc_id, path[2]) in db.attachments:
+                raise StandinError(404, "not_found", "Document is missing attachment")
+            return "attachment", 200, db.attachments[(doc_id, path[2])]
+        if method in ("GET", "HEAD"):
+            return "doc", 200, db.get(doc_id)
+        if method == "PUT":
+            body["_id"] = doc_id
+            return "doc", 201, {"ok" : True, "id" : doc_id, "rev" : db.put(body)[1]}
+        if method == "DELETE":
+            return "doc", 200, {"ok" : True, "id" : doc_id, "rev" : db.delete(doc_id, query.get("rev", None))}
+        raise StandinError(405, "method_not_allowed", "Only GET,HEAD,PUT,POST,DELETE allowed")
@@ -1,4 +1,5 @@
 
+import os
 import tempfile
 import random
 import datetime
@@ -107,4 +108,115 @@ def _write_samplesheet(csv_data, dst_file=None):
             out_handle.write(",".join([str(item) for item in row]))
             out_handle.write("\n")
     return dst_file
-   
\ No newline at end of file
+   
+def generate_demultiplex_stats_htm(barcode=generate_fc_barcode(), no_lanes=8, no_samples=96, dst_file=None):
+    """Generate a CASAVA 1.8 Demultiplex_Stats.htm document, returning
+    the document or writing it to dst_file
+    """
+    bc_header = ['Lane', 'Sample ID', 'Sample Ref', 'Index', 'Description', 'Control', 'Project', 'Yield (Mbases)', '% PF', '# Reads', '% of raw clusters per lane', '% Perfect Index Reads', '% One Mismatch Reads (Index)', '% of &gt;= Q30 Bases (PF)', 'Mean Quality Score (PF)']
+    smp_header = ['Sample<p></p>ID', 'Recipe', 'Operator', 'Directory']
+    project = generate_project()
+    def table(rows, cell="td"):
+        out = ['<div ID="ScrollableTableBodyDiv"><table width="100%">', '<col width="4%">']
+        for row in rows:
+            out.append("<tr>")
+            out += ["<{}>{}</{}>".format(cell, x, cell) for x in row]
+            out.append("</tr>")
+        out.append("</table></div>")
+        return out
+    bc_rows = []
+    smp_rows = []
+    for lane in range(1, no_lanes + 1):
+        for i in range(no_samples):
+            sample = generate_sample()
+            bc_rows.append([lane, sample, "hg19", generate_barcode(), "", "N", project, random.randint(100, 3000), "100.00",
+                            random.randint(10**5, 10**7), "{:.2f}".format(random.uniform(0, 5)), "{:.2f}".format(random.uniform(90, 100)),
+                            "{:.2f}".format(random.uniform(0, 5)), "{:.2f}".format(random.uniform(80, 95)), "{:.2f}".format(random.uniform(30, 38))])
+            smp_rows.append([sample, "R1", "N", "{}/Project_{}/Sample_{}".format(barcode, project, sample)])
+    doc = ['<html>', '<head>', '<title>{} Demultiplex Results</title>'.format(barcode), '</head>', '<body>',
+           '<h1>Flowcell: {}</h1>'.format(barcode), '<h2>Barcode lane statistics</h2>']
+    doc += table([bc_header], "th") + table(bc_rows)
+    doc += ['<p></p>', '<h2>Sample information</h2>']
+    doc += table([smp_header], "th") + table(smp_rows)
+    doc += ['<p>CASAVA-1.8.2</p>', '</body>', '</html>']
+    doc = "\n".join(doc)
+    if dst_file is None:
+        return doc
+    with open(dst_file, "w") as fh:
+        fh.write(doc)
+    return dst_file
+
+def generate_statusdb(no_projects=100, no_flowcells=100, no_lanes=8, no_samples=12, seed=None):
+    """Generate documents of the samples, flowcells and projects
+    databases of statusdb, including the design documents of the views
+    used by the connection classes. Each lane of a flowcell holds
+    no_samples samples of one project.
+
+    :param no_projects: number of projects
+    :param no_flowcells: number of flowcells
+    :param no_lanes: lanes per flowcell
+    :param no_samples: samples per lane
+    :param seed: random seed, for reproducible data
+
+    :returns: dict of database name to list of documents
+    """
+    from scilifelab.db import encode_attachment
+    from scilifelab.db.statusdb import DESIGN_DOCS, DESIGN_DOCS_VERSION
+    rand = random.Random(seed)
+    projects = []
+    for i in range(no_projects):
+        project_id = "{}.{}_{:02d}_{:02d}".format(rand.choice(string.ascii_uppercase), "".join([rand.choice(string.ascii_lowercase) for j in xrange(6)]).capitalize(), 10 + i // 100, i % 100)
+        projects.append({"_id" : "project_{}".format(i), "entity_type" : "project_summary", "project_id" : project_id,
+                         "project_number" : "P{}".format(100 + i), "uppnex_id" : "b2012{:03d}".format(i),
+                         "customer_reference" : "Customer reference {}".format(i),
+                         "min_m_reads_per_sample_ordered" : rand.choice([10, 20, 40]), "samples" : {}})
+    samples = []
+    flowcells = []
+    for i in range(no_flowcells):
+        date = (datetime.date(2012, 1, 1) + datetime.timedelta(days=i)).strftime("%y%m%d")
+        fc_id = "{}{:04d}ACXX".format(rand.choice("ABCD"), i)
+        fc_name = "{}_{}".format(date, fc_id)
+        phix = {}
+        summary = {"read1" : {}, "read3" : {}}
+        for lane in range(1, no_lanes + 1):
+            project = rand.choice(projects)
+            sequences = set()
+            phix[str(lane)] = round(rand.uniform(0.1, 2.5), 2)
+            for read in summary.keys():
+                summary[read][str(lane)] = {"ErrRatePhiX" : str(phix[str(lane)]), "ClustersPF" : str(rand.randint(10**6, 10**7))}
+            for j in range(no_samples):
+                sample = "{}_{}".format(project["project_number"], 101 + (i * no_lanes + lane + j) % 96)
+                sequence = "".join([rand.choice("ACGT") for k in xrange(6)])
+                while sequence in sequences:
+                    sequence = "".join([rand.choice("ACGT") for k in xrange(6)])
+                sequences.add(sequence)
+                name = "{}_{}_{}_{}".format(lane, date, fc_id, sequence)
+                doc_id = "srm_{}_{}_{}".format(i, lane, j)
+                count = [rand.randint(0, 10**5) for k in range(41)]
+                samples.append({"_id" : doc_id, "entity_type" : "sample_run_metrics", "name" : name, "barcode_name" : sample,
+                                "barcode_id" : j + 1, "sequence" : sequence, "sample_prj" : project["project_id"],
+                                "flowcell" : fc_id, "date" : date, "lane" : str(lane), "bc_count" : str(rand.randint(10**6, 3 * 10**7)),
+                                "fastqc" : {"stats" : {"Per sequence quality scores" : {"Quality" : range(41), "Count" : count}}},
+                                "picard_metrics" : {"metric_{}".format(k) : rand.random() for k in range(50)},
+                                "derived" : {"avg_qv" : round(float(sum([q * c for q, c in enumerate(count)])) / sum(count), 1)}})
+                project_sample = project["samples"].setdefault(sample, {"scilife_name" : sample, "customer_name" : "cust_{}".format(sample),
+                                                                        "status" : rand.choice(["P", "NP", "P"]), "sample_run_metrics" : {}})
+                project_sample["sample_run_metrics"][name] = doc_id
+                project_sample["m_reads_sequenced"] = round(project_sample.get("m_reads_sequenced", 0) + int(samples[-1]["bc_count"]) / 1e6, 1)
+        flowcells.append({"_id" : "fc_{}".format(i), "entity_type" : "flowcell_run_metrics", "name" : fc_name,
+                          "illumina" : {"Summary" : summary}, "derived" : {"phix_error_rate" : phix},
+                          "_attachments" : {"illumina.json.gz" : encode_attachment({"Summary" : summary})}})
+    docs = {"samples" : samples, "flowcells" : flowcells, "projects" : projects}
+    ## Views that exist in statusdb but are not in DESIGN_DOCS
+    existing = {"samples" : {"_design/names" : ["name", "name_fc", "name_proj"]},
+                "flowcells" : {"_design/names" : ["name"]},
+                "projects" : {"_design/project" : ["project_id"]}}
+    for dbname in docs.keys():
+        design_docs = {}
+        for design, views in existing[dbname].items():
+            design_docs[design] = {"_id" : design, "language" : "javascript", "views" : {v : {"map" : "function(doc) {}"} for v in views}}
+        for design, views in DESIGN_DOCS[dbname].items():
+            design_docs.setdefault(design, {"_id" : design, "language" : "javascript", "views" : {}})["views"].update(views)
+            design_docs[design]["version"] = DESIGN_DOCS_VERSION
+        docs[dbname].extend(design_docs.values())
+    return docs
@@ -15,6 +15,8 @@ config_defaults['project']['repos']  = os.path.join(filedir, "data", "repos")
 config_defaults['config']['ignore'] = ["slurm*", "tmp*"]
 config_defaults['log']['level']  = "INFO"
 config_defaults['log']['file']  = os.path.join(filedir, "data", "log", "pm.log")
+## Keep parsed run information files in memory only
+os.environ.pop("PM_YAML_CACHE", None)
 
 
 def safe_makedir(dname):
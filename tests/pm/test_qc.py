@@ -0,0 +1,67 @@
+"""
+Test qc extension
+"""
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from mock import Mock, patch
+from scilifelab.utils.manifest import FileManifest
+from scilifelab.pm.ext.ext_qc import bulk_update_fn, RunMetricsController
+
+class Row(object):
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+class PmQCUpdateTest(unittest.TestCase):
+    def test_1_bulk_update_fn(self):
+        """Test that bulk update only returns new and modified objects"""
+        dbobjs = {"id1": {"_id":"id1", "_rev":"1-a", "name":"unchanged", "creation_time":"t0", "value":1},
+                  "id2": {"_id":"id2", "_rev":"1-b", "name":"changed", "creation_time":"t0", "value":1}}
+        def view(name, **kw):
+            if name == "names/id_to_name":
+                return [Row(id=k, value=v["name"]) for k, v in dbobjs.items()]
+            return [Row(id=k, doc=dbobjs[k]) for k in kw["keys"]]
+        db = Mock()
+        db.view = Mock(side_effect=view)
+        objs = [{"_id":"new1", "name":"unchanged", "value":1},
+                {"_id":"new2", "name":"changed", "value":2},
+                {"_id":"new3", "name":"new", "value":3}]
+        new_objs = bulk_update_fn(db, objs)
+        self.assertEqual([x["name"] for x in new_objs], ["changed", "new"])
+        self.assertEqual(new_objs[0]["_id"], "id2")
+        self.assertEqual(new_objs[0]["_rev"], "1-b")
+        self.assertEqual(new_objs[0]["creation_time"], "t0")
+        self.assertEqual(new_objs[1]["_id"], "new3")
+        self.assertEqual(db.view.call_count, 2)
+
+class PmQCManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix="test_qc_manifest_")
+        self.metrics = os.path.join(self.path, "metrics.txt")
+        with open(self.metrics, "w") as fh:
+            fh.write("metrics")
+        self.kw = dict(fc_date="120924", fc_name="AC003CCCXX")
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _controller(self, manifest):
+        ctrl = RunMetricsController.__new__(RunMetricsController)
+        ctrl._manifest = manifest
+        ctrl.log = Mock()
+        return ctrl
+
+    def test_1_changed_refreshes_fingerprints(self):
+        """Test that refreshed fingerprints of touched but unmodified files are committed"""
+        manifest = FileManifest(os.path.join(self.path, "manifest.json"), content_hash=True)
+        ctrl = self._controller(manifest)
+        self.assertTrue(ctrl._changed(self.kw, [self.metrics]))
+        manifest.commit()
+        t = time.time() + 10
+        os.utime(self.metrics, (t, t))
+        self.assertFalse(ctrl._changed(self.kw, [self.metrics]))
+        with patch("scilifelab.utils.manifest.md5sum") as md5sum:
+            self.assertFalse(ctrl._changed(self.kw, [self.metrics]))
+            self.assertEqual(md5sum.call_count, 0)
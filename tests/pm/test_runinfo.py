@@ -77,6 +77,14 @@ class PmFlowcellTest(PmTest):
         print fc
         print fc.lane_files
 
+    def test_6b_parse_file_name(self):
+        """Test parsing of pre-casava file names"""
+        self.eq(parse_file_name("1_120829_AA001AAAXX_nophix.bc_metrics"), ("1", "AA001AAAXX", None))
+        self.eq(parse_file_name("1_120829_AA001AAAXX_nophix_10_1_fastq.txt"), ("1", "AA001AAAXX", "10"))
+        self.eq(parse_file_name("1_120829_AA001AAAXX_nophix_12-sort-dup.bam"), ("1", "AA001AAAXX", "12"))
+        self.eq(parse_file_name("1_120829_AA001AAAXX_nophix_unmatched_1_fastq.txt"), ("1", "AA001AAAXX", "unmatched"))
+        self.eq(parse_file_name("bcbb_software_versions.txt"), None)
+
     def test_7_unique_lanes(self):
         """Test that flowcell returns object with unique lanes"""
         fc = Flowcell(runinfo)
@@ -85,6 +93,36 @@ class PmFlowcellTest(PmTest):
         print fc.as_yaml()
         print new_fc.data
         print new_fc.as_yaml()
+        self.eq(fc.lanes(), ['1','2'])
+        self.eq(sorted(new_fc.lanes(), key=int), [str(i) for i in range(1, 12)])
+
+    def test_7b_subset_views(self):
+        """Test that subsets are row views and clones copy on write"""
+        fc = Flowcell(runinfo)
+        newfc = fc.subset("lane", "1").subset("name", "P1_101F_index1")
+        self.eq(len(newfc), 1)
+        self.eq(newfc.get_entry("1_1", "sample_prj"), "J.Doe_00_01")
+        newfc.append_to_entry("1_1", "results", "1_120829_AA001AAAXX_nophix_1-sort-dup.bam")
+        self.eq(fc.get_entry("1_1", "results"), ["1_120829_AA001AAAXX_nophix_1-sort-dup.bam"])
+        clone = fc.clone()
+        clone.append_to_entry("1_1", "results", "1_120829_AA001AAAXX_nophix_1-sort.bam")
+        clone.set_entry("1_2", "sample_prj", "J.Doe_00_03")
+        self.eq(len(fc.get_entry("1_1", "results")), 1)
+        self.eq(len(clone.get_entry("1_1", "results")), 2)
+        self.eq(fc.projects(), ['J.Doe_00_01', 'J.Doe_00_02'])
+        self.eq(len(clone.subset("sample_prj", "J.Doe_00_03")), 1)
+
+    def test_7c_clone_subset_views(self):
+        """Test that writes to a subset of a clone are seen by the clone only"""
+        fc = Flowcell(runinfo)
+        clone = fc.clone()
+        newfc = clone.subset("lane", "1").subset("name", "P1_101F_index1")
+        newfc.append_to_entry("1_1", "results", "1_120829_AA001AAAXX_nophix_1-sort-dup.bam")
+        self.eq(clone.get_entry("1_1", "results"), ["1_120829_AA001AAAXX_nophix_1-sort-dup.bam"])
+        self.eq(newfc.get_entry("1_1", "results"), ["1_120829_AA001AAAXX_nophix_1-sort-dup.bam"])
+        self.eq(fc.get_entry("1_1", "results"), [])
+        newfc.append_to_entry("1_1", "results", "1_120829_AA001AAAXX_nophix_1-sort.bam")
+        self.eq(len(clone.get_entry("1_1", "results")), 2)
 
 
     def test_8_get_flowcell_csv(self):
@@ -1,17 +1,41 @@
 import os
+import json
 import unittest
+import subprocess
+from distutils.spawn import find_executable
 import ConfigParser
-from scilifelab.db.statusdb import SampleRunMetricsConnection
+from mock import Mock
+from couchdb.http import ResourceNotFound
+import scilifelab.db
+import base64
+from scilifelab.db import LazyView, LRUCache, row_id, row_value, get_session, clear_sessions, ConnectionError, encode_attachment, decode_attachment, attachment_digest, attachment_name, update_design_doc
+from scilifelab.db.statusdb import SampleRunMetricsConnection, FlowcellRunMetricsConnection, BarcodeNameIndex, match_project_name_to_barcode_name, DESIGN_DOCS, DESIGN_DOCS_VERSION, REPLICA_SCHEMAS
+from scilifelab.db.replica import ReplicaStore, ReplicaSchema, LocalView, collate, clear_replicas
+from couchdb_standin import CouchStandin
+from generate_test_data import generate_statusdb
+import benchmark_statusdb
 
 filedir = os.path.abspath(__file__)
 
 class TestDbConnection(unittest.TestCase):
     def setUp(self):
+        self.server = None
+        self.port = 5984
         if not os.path.exists(os.path.join(os.getenv("HOME"), "dbcon.ini")):
-            self.url = None
-            self.user = None
-            self.pw = None
-            self.examples = {}
+            ## Use a local stand-in server with generated data
+            docs = generate_statusdb(no_projects=5, no_flowcells=5, no_samples=4, seed=1)
+            self.server = CouchStandin()
+            for dbname, dbdocs in docs.items():
+                self.server.load(dbname, dbdocs)
+            self.server.start()
+            self.url = self.server.host
+            self.port = self.server.port
+            self.user = "user"
+            self.pw = "pw"
+            srm = docs["samples"][0]
+            self.examples = {"sample":srm["name"],
+                             "flowcell":srm["flowcell"],
+                             "project":srm["sample_prj"]}
         else:
             config = ConfigParser.ConfigParser()
             config.readfp(open(os.path.join(os.getenv("HOME"), "dbcon.ini")))
@@ -22,20 +46,25 @@ class TestDbConnection(unittest.TestCase):
                              "flowcell":config.get("examples", "flowcell"),
                              "project":config.get("examples", "project")}
 
+    def tearDown(self):
+        if self.server:
+            clear_sessions()
+            self.server.stop()
+
     def test_1_connection(self):
         """Test database connection"""
-        sample_con = SampleRunMetricsConnection(username=self.user, password=self.pw, url=self.url)
-        self.assertEqual(sample_con.url_string, "http://{}:5984".format(self.url))
+        sample_con = SampleRunMetricsConnection(username=self.user, password=self.pw, url=self.url, port=self.port)
+        self.assertEqual(sample_con.url_string, "http://{}:{}".format(self.url, self.port))
 
     def test_2_get_flowcell(self):
         """Test getting a flowcell for a given sample"""
-        sample_con = SampleRunMetricsConnection(username=self.user, password=self.pw, url=self.url)
+        sample_con = SampleRunMetricsConnection(username=self.user, password=self.pw, url=self.url, port=self.port)
         fc = sample_con.get_entry(self.examples["sample"], "flowcell")
         self.assertEqual(str(fc), self.examples["flowcell"])
 
     def test_3_get_sample_ids(self):
         """Test getting sample ids given flowcell and sample_prj"""
-        sample_con = SampleRunMetricsConnection(username=self.user, password=self.pw, url=self.url)
+        sample_con = SampleRunMetricsConnection(username=self.user, password=self.pw, url=self.url, port=self.port)
         sample_ids = sample_con.get_sample_ids(fc_id=self.examples["flowcell"])
         print "Number of samples before subsetting: " + str(len(sample_ids))
         sample_ids = sample_con.get_sample_ids(fc_id=self.examples["flowcell"], sample_prj=self.examples["project"])
@@ -43,9 +72,385 @@ class TestDbConnection(unittest.TestCase):
 
     def test_4_get_samples(self):
         """Test getting samples given flowcell and sample_prj."""
-        sample_con = SampleRunMetricsConnection(username=self.user, password=self.pw, url=self.url)
+        sample_con = SampleRunMetricsConnection(username=self.user, password=self.pw, url=self.url, port=self.port)
         samples = sample_con.get_samples(fc_id=self.examples["flowcell"])
         print "Number of samples before subsetting: " + str(len(samples))
         samples = sample_con.get_samples(fc_id=self.examples["flowcell"], sample_prj=self.examples["project"])
         print "Number of samples after subsetting: " + str(len(samples))
-                
+
+class Row(object):
+    def __init__(self, key, id):
+        self.key = key
+        self.id = id
+
+class TestLazyView(unittest.TestCase):
+    def setUp(self):
+        rows = [Row("sample{}".format(i), "id{}".format(i)) for i in range(5)]
+        def view(name, **kw):
+            if "key" in kw:
+                return [r for r in rows if r.key == kw["key"]]
+            if "keys" in kw:
+                return [r for r in rows if r.key in kw["keys"]]
+            return rows
+        self.db = Mock()
+        self.db.view = Mock(side_effect=view)
+
+    def test_1_lru_cache(self):
+        """Test that the LRU cache discards least recently used items"""
+        cache = LRUCache(2)
+        cache["a"] = 1
+        cache["b"] = 2
+        cache["a"]
+        cache["c"] = 3
+        self.assertEqual(len(cache), 2)
+        self.assertTrue("a" in cache)
+        self.assertFalse("b" in cache)
+
+    def test_2_lazy_view(self):
+        """Test lazy view lookups by key"""
+        view = LazyView(self.db, "names/name", value_fn=lambda row: row.id, reduce=False)
+        self.assertEqual(self.db.view.call_count, 0)
+        self.assertEqual(view.get("sample1"), "id1")
+        self.assertEqual(view["sample1"], "id1")
+        self.assertIsNone(view.get("nosample"))
+        self.assertFalse("nosample" in view)
+        self.assertRaises(KeyError, view.__getitem__, "nosample")
+        ## Cached lookups, including misses, don't query the database
+        self.assertEqual(self.db.view.call_count, 2)
+        self.db.view.assert_called_with("names/name", key="nosample", reduce=False)
+        self.assertEqual(view.get_many(["sample1", "sample2", "sample3"]), {"sample1":"id1", "sample2":"id2", "sample3":"id3"})
+        self.db.view.assert_called_with("names/name", keys=["sample2", "sample3"], reduce=False)
+
+class DocRow(object):
+    def __init__(self, key, doc):
+        self.key = key
+        self.doc = doc
+
+class TestGetDocs(unittest.TestCase):
+    def test_1_get_docs(self):
+        """Test fetching documents in batches"""
+        docs = {"id{}".format(i):{"_id":"id{}".format(i), "name":"sample{}".format(i), "sequence":"ACGT"} for i in range(5)}
+        con = SampleRunMetricsConnection.__new__(SampleRunMetricsConnection)
+        con.log = Mock()
+        con.db = Mock()
+        con.db.view = Mock(side_effect=lambda name, **kw: [DocRow(k, docs.get(k, None)) for k in kw["keys"]])
+        res = con.get_docs(["id0", "id1", "id2", "id3", "noid"], batch_size=2)
+        self.assertEqual([x["_id"] for x in res], ["id0", "id1", "id2", "id3"])
+        self.assertEqual(con.db.view.call_count, 3)
+        res = con.get_docs(["id0"], fields=["name"])
+        self.assertEqual(res, [{"_id":"id0", "name":"sample0"}])
+
+class TestAttachments(unittest.TestCase):
+    def test_1_encode_attachment(self):
+        """Test encoding and decoding of attachments"""
+        obj = {"Barcode_lane_statistics":[{"Lane":"1", "# Reads":"1000"}], "Sample_information":[]}
+        att = encode_attachment(obj)
+        self.assertEqual(att["content_type"], "application/x-gzip")
+        self.assertEqual(decode_attachment(base64.b64decode(att["data"])), obj)
+        self.assertEqual(attachment_digest(att), attachment_digest(encode_attachment(obj)))
+        self.assertEqual(attachment_digest({"digest":"md5-abc", "stub":True}), "md5-abc")
+
+    def test_2_get_part(self):
+        """Test lazy loading of flowcell parts stored as attachments"""
+        stats = {"Barcode_lane_statistics":[{"Lane":"1"}]}
+        att = encode_attachment(stats)
+        doc = {"_id":"id1", "illumina":{"Summary":{}}, "_attachments":{attachment_name("illumina.Demultiplex_Stats"):{"digest":attachment_digest(att), "stub":True}}}
+        con = FlowcellRunMetricsConnection.__new__(FlowcellRunMetricsConnection)
+        con.log = Mock()
+        con.db = Mock()
+        con.db.get_attachment = Mock(return_value=Mock(read=Mock(return_value=base64.b64decode(att["data"]))))
+        self.assertEqual(con.get_demultiplex_stats("120924_BC0JHTACXX", doc=doc), stats)
+        con.db.get_attachment.assert_called_with(doc, "illumina.Demultiplex_Stats.json.gz")
+        self.assertIsNone(con.get_samplesheet("120924_BC0JHTACXX", doc=doc))
+        doc["illumina"]["Demultiplex_Stats"] = stats
+        con.db.get_attachment.reset_mock()
+        self.assertEqual(con.get_demultiplex_stats("120924_BC0JHTACXX", doc=doc), stats)
+        self.assertFalse(con.db.get_attachment.called)
+
+class TestDerivedMetrics(unittest.TestCase):
+    def test_1_phix_error_rate(self):
+        """Test that precomputed phix error rates are read from the derived view"""
+        con = FlowcellRunMetricsConnection.__new__(FlowcellRunMetricsConnection)
+        con.log = Mock()
+        con.derived_view = {"120924_BC0JHTACXX":{"phix_error_rate":{"1":0.75}}}
+        con.get_entry = Mock()
+        self.assertEqual(con.get_phix_error_rate("120924_BC0JHTACXX", "1"), 0.75)
+        self.assertFalse(con.get_entry.called)
+        con.get_entry = Mock(return_value={"illumina":{"Summary":{"read1":{"2":{"ErrRatePhiX":"0.5"}}, "read3":{"2":{"ErrRatePhiX":"1.5"}}}}})
+        self.assertEqual(con.get_phix_error_rate("120924_BC0JHTACXX", "2"), 1.0)
+
+    def test_2_avg_qv(self):
+        """Test that a precomputed average quality is used"""
+        con = SampleRunMetricsConnection.__new__(SampleRunMetricsConnection)
+        con.log = Mock()
+        self.assertEqual(con.calc_avg_qv("1_120924_BC0JHTACXX_ACGT", srm={"derived":{"avg_qv":35.2}}), 35.2)
+        srm = {"fastqc":{"stats":{"Per sequence quality scores":{"Quality":["2", "30", "38"], "Count":["10.0", "30.0", "60.0"]}}}}
+        self.assertEqual(con.calc_avg_qv("1_120924_BC0JHTACXX_ACGT", srm=srm), 32.0)
+
+class TestBarcodeNameIndex(unittest.TestCase):
+    barcode_names = ["P1_101F_index1", "P1_101_index2", "P1_102B_index3", "P1_1020_index4", "P10_101F_index5",
+                     "12_B_index3", "12_index4", "123_A_index1", "1_120924_index2", "ab12_x", "P1_101", "P1_103FF", None]
+    project_sample_names = ["P1_101F", "P1_101", "P1_102B", "P1_102", "P1_103F", "P10_101F", "P1_1", "P2_101",
+                            "12", "123", "12_B", "12_index4", "ab12_x", "ab12", "1"]
+
+    def _match(self, project_sample_name, barcode_name):
+        """Original matching, where names that raise do not match"""
+        try:
+            return match_project_name_to_barcode_name(project_sample_name, barcode_name)
+        except (AttributeError, TypeError):
+            return False
+
+    def test_1_match(self):
+        """Test that the index gives the same matches as match_project_name_to_barcode_name"""
+        index = BarcodeNameIndex([(x, i) for i, x in enumerate(self.barcode_names)])
+        for name in self.project_sample_names:
+            expected = [i for i, x in enumerate(self.barcode_names) if self._match(name, x)]
+            self.assertEqual(index.match(name), expected, name)
+
+    def test_2_match_examples(self):
+        """Test matching project sample names to barcode names"""
+        index = BarcodeNameIndex([(x, x) for x in self.barcode_names])
+        self.assertEqual(index.match("P1_101F"), ["P1_101F_index1", "P1_101_index2", "P1_101"])
+        self.assertEqual(index.match("P1_102B"), ["P1_102B_index3", "P1_1020_index4"])
+        self.assertEqual(index.match("12"), ["12_B_index3", "12_index4", "ab12_x"])
+        self.assertEqual(index.match("P2_101"), [])
+
+class ReduceRow(object):
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+class TestReportViews(unittest.TestCase):
+    def test_1_update_design_doc(self):
+        """Test adding and updating views of a design document"""
+        design = {"_id":"_design/names", "_rev":"1-abc", "language":"javascript", "views":{"name":{"map":"function(doc) {emit(doc.name, null);}"}}}
+        db = Mock()
+        db.get = Mock(return_value=design)
+        self.assertTrue(update_design_doc(db, "_design/names", DESIGN_DOCS["samples"]["_design/names"], 1))
+        saved = db.save.call_args[0][0]
+        self.assertEqual(sorted(saved["views"].keys()), ["fc_proj_name", "name", "proj_fc_sample", "proj_name"])
+        self.assertEqual(saved["version"], 1)
+        db.save.reset_mock()
+        self.assertFalse(update_design_doc(db, "_design/names", DESIGN_DOCS["samples"]["_design/names"], 1))
+        self.assertFalse(db.save.called)
+        self.assertTrue(update_design_doc(db, "_design/names", DESIGN_DOCS["samples"]["_design/names"], 2))
+        db.save.reset_mock()
+        self.assertFalse(update_design_doc(db, "_design/names", {"name":{"map":"function(doc) {}"}}, 1))
+        self.assertFalse(db.save.called)
+        self.assertEqual(design["version"], 2)
+        self.assertEqual(design["views"]["name"], {"map":"function(doc) {emit(doc.name, null);}"})
+
+    def test_1b_install_views(self):
+        """Test installing the design documents of a connection class"""
+        con = FlowcellRunMetricsConnection.__new__(FlowcellRunMetricsConnection)
+        con.log = Mock()
+        con.db = Mock()
+        con.db.name = "flowcells"
+        con.session = Mock()
+        db = con.session.db.return_value
+        db.get = Mock(side_effect=lambda design, default: default)
+        con.install_views()
+        con.session.db.assert_called_with("flowcells")
+        self.assertEqual(sorted([x[0][0]["_id"] for x in db.save.call_args_list]), sorted(DESIGN_DOCS["flowcells"].keys()))
+        self.assertEqual(set([x[0][0]["version"] for x in db.save.call_args_list]), set([DESIGN_DOCS_VERSION]))
+
+    def test_2_reduce_queries(self):
+        """Test querying report views with group_level"""
+        con = SampleRunMetricsConnection.__new__(SampleRunMetricsConnection)
+        con.log = Mock()
+        con.db = Mock()
+        con.db.view = Mock(return_value=[ReduceRow(["J.Doe_00_01", "120924_BC0JHTACXX"], 2000), ReduceRow(["J.Doe_00_01", "121015_BB002BBBXX"], 1000)])
+        self.assertEqual(con.get_read_counts("J.Doe_00_01", group_level=2), {("120924_BC0JHTACXX",):2000, ("121015_BB002BBBXX",):1000})
+        con.db.view.assert_called_with("reports/read_count", startkey=["J.Doe_00_01"], endkey=["J.Doe_00_01", {}], group_level=2)
+        fc_con = FlowcellRunMetricsConnection.__new__(FlowcellRunMetricsConnection)
+        fc_con.db = Mock()
+        fc_con.db.view = Mock(return_value=[ReduceRow(["120924_BC0JHTACXX", "1"], {"sum":1.5, "count":2, "min":0.5, "max":1.0, "sumsqr":1.25})])
+        self.assertEqual(fc_con.get_lane_phix_error_rates("120924_BC0JHTACXX"), {"1":0.75})
+
+    def test_3_sample_names(self):
+        """Test getting sample run metrics names of a project without retrieving documents"""
+        con = SampleRunMetricsConnection.__new__(SampleRunMetricsConnection)
+        con.log = Mock()
+        con.proj_fc_sample_view = Mock()
+        row = Row(["J.Doe_00_01", "BC0JHTACXX"], "1")
+        row.value = {"name":"1_120924_BC0JHTACXX_1", "barcode_name":"P1_101F", "date":"120924", "lane":"1"}
+        con.proj_fc_sample_view.query = Mock(return_value=[row])
+        self.assertEqual(con.get_sample_names("J.Doe_00_01", "BC0JHTACXX"),
+                         [{"_id":"1", "name":"1_120924_BC0JHTACXX_1", "barcode_name":"P1_101F", "sample_prj":"J.Doe_00_01", "flowcell":"BC0JHTACXX", "date":"120924", "lane":"1"}])
+        con.proj_fc_sample_view.query.assert_called_with(key=["J.Doe_00_01", "BC0JHTACXX"])
+        con.proj_fc_sample_view.query = Mock(side_effect=ResourceNotFound)
+        con.get_project_samples = Mock(return_value=[])
+        self.assertEqual(con.get_sample_names("J.Doe_00_01"), [])
+        con.get_project_samples.assert_called_with("J.Doe_00_01", fields=["name", "barcode_name", "sample_prj", "flowcell", "date", "lane"])
+
+class TestReplica(unittest.TestCase):
+    def setUp(self):
+        self.remote = Mock()
+        self.remote.name = "samples"
+        self.srm = [{"_id":"1", "_rev":"1-a", "entity_type":"sample_run_metrics", "name":"1_120924_BC0JHTACXX_1", "flowcell":"BC0JHTACXX", "date":"120924",
+                     "lane":"1", "barcode_name":"P1_101F", "sample_prj":"J.Doe_00_01", "bc_count":"1000", "sequence":"ACGT"},
+                    {"_id":"2", "_rev":"1-a", "entity_type":"sample_run_metrics", "name":"1_120924_BC0JHTACXX_2", "flowcell":"BC0JHTACXX", "date":"120924",
+                     "lane":"1", "barcode_name":"P1_102F", "sample_prj":"J.Doe_00_01", "bc_count":"500", "sequence":"TGCA"},
+                    {"_id":"3", "_rev":"1-a", "entity_type":"sample_run_metrics", "name":"2_121015_BB002BBBXX_1", "flowcell":"BB002BBBXX", "date":"121015",
+                     "lane":"2", "barcode_name":"P2_101", "sample_prj":"J.Doe_00_02", "bc_count":"200", "sequence":"AAAA"}]
+        self.remote.changes = Mock(return_value={"results":[{"id":x["_id"], "doc":x} for x in self.srm], "last_seq":3})
+        self.store = ReplicaStore(":memory:", REPLICA_SCHEMAS)
+
+    def test_1_sync(self):
+        """Test incremental sync from the changes feed"""
+        self.assertEqual(self.store.sync(self.remote), 3)
+        self.remote.changes.assert_called_with(since=0, include_docs=True, limit=1000)
+        self.assertEqual(self.store.last_seq("samples"), 3)
+        self.remote.changes = Mock(return_value={"results":[{"id":"2", "deleted":True}], "last_seq":4})
+        self.assertEqual(self.store.sync(self.remote), 1)
+        self.remote.changes.assert_called_with(since=3, include_docs=True, limit=1000)
+        self.assertEqual([x["_id"] for x in self.store.docs("samples", "flowcell", ["BC0JHTACXX"])], ["1"])
+
+    def test_2_views(self):
+        """Test reading views from the replica"""
+        db = self.store.database(self.remote)
+        self.assertEqual([row.id for row in db.view("names/name", key="1_120924_BC0JHTACXX_2", reduce=False)], ["2"])
+        self.assertEqual([row.value for row in db.view("names/fc_proj_name", startkey=["BC0JHTACXX"], endkey=["BC0JHTACXX", {}], reduce=False)],
+                         ["1_120924_BC0JHTACXX_1", "1_120924_BC0JHTACXX_2"])
+        self.assertEqual([(row.key, row.value) for row in db.view("reports/read_count", startkey=["J.Doe_00_01"], endkey=["J.Doe_00_01", {}], group_level=2)],
+                         [(["J.Doe_00_01", "120924_BC0JHTACXX"], 1500)])
+        self.assertEqual([row.value["barcode_name"] for row in db.view("names/proj_fc_sample", key=["J.Doe_00_01", "BC0JHTACXX"], reduce=False)],
+                         ["P1_101F", "P1_102F"])
+        self.assertEqual(db.get("3")["name"], "2_121015_BB002BBBXX_1")
+        self.assertFalse(self.remote.view.called)
+        db.view("names/name", descending=True)
+        self.assertTrue(self.remote.view.called)
+
+    def test_3_collate(self):
+        """Test that view rows follow the CouchDB collation order"""
+        keys = [{}, ["a", {}], ["a", 10], ["a", 9], ["a"], "b", "B", "a", 10, 9, 1.5, True, False, None]
+        self.assertEqual(sorted(keys, key=collate), [None, False, True, 1.5, 9, 10, "B", "a", "b", ["a"], ["a", 9], ["a", 10], ["a", {}], {}])
+        schemas = {"samples" : ReplicaSchema(REPLICA_SCHEMAS["samples"].fields,
+                                             {"reports/lane_count" : LocalView(lambda doc: [([doc["flowcell"], int(doc["lane"]) * 5, doc["name"]], int(doc["bc_count"]))], "flowcell", "_sum")})}
+        db = ReplicaStore(":memory:", schemas).database(self.remote)
+        self.assertEqual([(row.key, row.value) for row in db.view("reports/lane_count", group_level=2)],
+                         [(["BB002BBBXX", 10], 200), (["BC0JHTACXX", 5], 1500)])
+        self.srm[2]["flowcell"] = "BC0JHTACXX"
+        db = ReplicaStore(":memory:", schemas).database(self.remote)
+        self.assertEqual([(row.key, row.value) for row in db.view("reports/lane_count", startkey=["BC0JHTACXX"], endkey=["BC0JHTACXX", {}], group_level=2)],
+                         [(["BC0JHTACXX", 5], 1500), (["BC0JHTACXX", 10], 200)])
+
+    def test_4_sync_budget(self):
+        """Test that a sync stops requesting changes when its time budget is spent"""
+        self.remote.changes = Mock(side_effect=lambda since, **kw: {"results":[{"id":str(since + 1), "doc":dict(self.srm[since % 3], _id=str(since + 1))}], "last_seq":since + 1})
+        clock = scilifelab.db.replica.time
+        scilifelab.db.replica.time = Mock()
+        scilifelab.db.replica.time.time = Mock(side_effect=[0, 1, 2, 11])
+        try:
+            self.assertEqual(self.store.sync(self.remote, batch_size=1, timeout=10), 3)
+        finally:
+            scilifelab.db.replica.time = clock
+        self.assertEqual(self.store.last_seq("samples"), 3)
+        self.remote.changes = Mock(return_value={"results":[], "last_seq":3})
+        self.assertEqual(self.store.sync(self.remote, batch_size=1, timeout=10), 0)
+        self.remote.changes.assert_called_with(since=3, include_docs=True, limit=1)
+
+## Evaluates the map functions of design documents with node, for
+## comparison with their replica twins
+MAP_JS = """
+var input = JSON.parse(require('fs').readFileSync(0, 'utf8'));
+var out = {};
+Object.keys(input.views).forEach(function (name) {
+    var rows = [];
+    var doc_id = null;
+    var emit = function (key, value) {rows.push([doc_id, key, value === undefined ? null : value]);};
+    var map = eval('(' + input.views[name] + ')');
+    input.docs.forEach(function (doc) {doc_id = doc._id; map(doc);});
+    out[name] = rows;
+});
+process.stdout.write(JSON.stringify(out));
+"""
+
+class TestReplicaViews(unittest.TestCase):
+    """Check that the views of DESIGN_DOCS and their twins in
+    REPLICA_SCHEMAS agree"""
+    def setUp(self):
+        self.docs = generate_statusdb(no_projects=5, no_flowcells=5, no_samples=4, seed=1)
+
+    def test_1_twins(self):
+        """Test that every design document view has a replica twin"""
+        for dbname, designs in DESIGN_DOCS.items():
+            for design, views in designs.items():
+                for view in views:
+                    self.assertIn("{}/{}".format(design[len("_design/"):], view), REPLICA_SCHEMAS[dbname].views)
+
+    @unittest.skipIf(not find_executable("node"), "node is not installed")
+    def test_2_map_rows(self):
+        """Test that design document views and their replica twins map the test data to the same rows"""
+        for dbname, designs in DESIGN_DOCS.items():
+            views = dict(("{}/{}".format(design[len("_design/"):], view), v["map"]) for design, dviews in designs.items() for view, v in dviews.items())
+            proc = subprocess.Popen(["node", "-e", MAP_JS], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            out = json.loads(proc.communicate(json.dumps({"views" : views, "docs" : self.docs[dbname]}))[0])
+            self.assertEqual(proc.returncode, 0)
+            for name in views:
+                self.assertEqual(sorted([[x["_id"], k, v] for x in self.docs[dbname] for k, v in REPLICA_SCHEMAS[dbname].views[name].map_fn(x)]),
+                                 sorted(out[name]), "{} view {} differs from its replica twin".format(dbname, name))
+
+class TestRequestCounts(unittest.TestCase):
+    """Catch regressions in the number of requests made by report
+    operations, using the local stand-in server"""
+    ## Upper bounds of request counts for the generated dataset. They
+    ## don't depend on the number of samples; sample_status makes one
+    ## PhiX error rate request per flowcell, i.e. one here.
+    max_requests = {"connect" : 9, "get_samples" : 2, "map_name_to_srm" : 4, "read_counts" : 1, "sample_status" : 10, "project_status" : 8}
+
+    def setUp(self):
+        docs = generate_statusdb(no_projects=5, no_flowcells=5, no_samples=4, seed=1)
+        self.server = CouchStandin()
+        for dbname, dbdocs in docs.items():
+            self.server.load(dbname, dbdocs)
+        self.server.start()
+        srm = docs["samples"][0]
+        self.project_id = srm["sample_prj"]
+        self.fc_id = srm["flowcell"]
+
+    def tearDown(self):
+        clear_sessions()
+        self.server.stop()
+
+    def test_1_request_counts(self):
+        """Test request counts of report operations"""
+        results = dict(benchmark_statusdb.run(self.server, self.project_id, self.fc_id))
+        for name, n in self.max_requests.items():
+            self.assertTrue(results[name]["requests"] <= n, "{} makes {} requests, expected at most {}".format(name, results[name]["requests"], n))
+
+class TestSession(unittest.TestCase):
+    def setUp(self):
+        self.check_url = scilifelab.db.check_url
+        scilifelab.db.check_url = Mock(return_value=True)
+
+    def tearDown(self):
+        scilifelab.db.check_url = self.check_url
+        clear_sessions()
+
+    def test_1_shared_session(self):
+        """Test that connections to the same url share a session"""
+        session = get_session("http://localhost:5984")
+        self.assertIs(session, get_session("http://localhost:5984"))
+        self.assertIsNot(session, get_session("http://otherhost:5984"))
+        self.assertEqual(scilifelab.db.check_url.call_count, 2)
+        db = Mock()
+        db.name = "samples"
+        self.assertIs(session.view(db, "names/name"), session.view(db, "names/name"))
+        view = session.view(db, "names/name", value_fn=row_id, cache_size=10, reduce=False)
+        self.assertIs(view, session.view(db, "names/name", reduce=False, cache_size=10, value_fn=row_id))
+        self.assertIsNot(view, session.view(db, "names/name", value_fn=row_id, cache_size=0, reduce=False))
+        self.assertIsNot(view, session.view(db, "names/name", value_fn=row_value, cache_size=10, reduce=False))
+        self.assertEqual(session.view(db, "names/name", value_fn=row_id, cache_size=0, reduce=False).cache.size, 0)
+
+    def test_2_offline_replica(self):
+        """Test that connections with a replica read from it when the server is unreachable"""
+        scilifelab.db.check_url = Mock(return_value=False)
+        self.assertRaises(ConnectionError, SampleRunMetricsConnection, url="localhost", username="u", password="p")
+        try:
+            con = SampleRunMetricsConnection(url="localhost", username="u", password="p", replica=":memory:")
+            scilifelab.db.check_url.assert_called_with("http://localhost:5984", scilifelab.db.SYNC_TIMEOUT)
+            self.assertEqual(con.get_sample_ids(fc_id="BC0JHTACXX"), [])
+            self.assertRaises(ConnectionError, con.db.view, "names/name", descending=True)
+        finally:
+            clear_replicas()
@@ -1,8 +1,11 @@
 import os
+import shutil
+import hashlib
+import tempfile
 import unittest
 import ConfigParser
 from scilifelab.report import sequencing_success, set_status
-from scilifelab.report.rl import make_example_sample_note, make_note, sample_note_paragraphs, sample_note_headers
+from scilifelab.report.rl import get_template, make_example_sample_note, make_note, make_notes, sample_note_paragraphs, sample_note_headers
 from scilifelab.db.statusdb import SampleRunMetricsConnection, FlowcellRunMetricsConnection, ProjectSummaryConnection
 
 filedir = os.path.abspath(os.path.realpath(os.path.dirname(__file__)))
@@ -59,6 +62,34 @@ class TestSampleDeliveryNote(unittest.TestCase):
         """Make example note"""
         make_example_sample_note(os.path.join(filedir, "test.pdf"))
 
+    def test_1b_make_notes(self):
+        """Make notes in worker processes, reusing compiled templates"""
+        self.assertIs(sample_note_paragraphs()["Results"]["tpl"], sample_note_paragraphs()["Results"]["tpl"])
+        kw = {k:"N/A" for k in parameters.keys()}
+        notes = [(os.path.join(filedir, "test_notes_{}.pdf".format(i)), kw) for i in range(3)]
+        try:
+            self.assertEqual(make_notes(notes, sample_note_headers, sample_note_paragraphs, workers=2), [x[0] for x in notes])
+            self.assertTrue(all(os.path.exists(x[0]) for x in notes))
+        finally:
+            for outfile, kw in notes:
+                if os.path.exists(outfile):
+                    os.unlink(outfile)
+
+    def test_1c_template_module_directory(self):
+        """Keep compiled templates in PM_MAKO_MODULE_DIR"""
+        module_directory = tempfile.mkdtemp()
+        os.environ["PM_MAKO_MODULE_DIR"] = module_directory
+        text = "${FC_id} in module directory"
+        try:
+            self.assertEqual(get_template(text).render(FC_id="BC0JHTACXX"), "BC0JHTACXX in module directory")
+            filename = os.path.join(module_directory, "rl_{}.mako".format(hashlib.md5(text).hexdigest()))
+            with open(filename) as fh:
+                self.assertEqual(fh.read(), text)
+            self.assertEqual([x for x in os.listdir(module_directory) if x.endswith(".tmp")], [])
+        finally:
+            del os.environ["PM_MAKO_MODULE_DIR"]
+            shutil.rmtree(module_directory)
+
     def test_2_make_note(self):
         """Make a note subset by example flowcell and project"""
         s_con = SampleRunMetricsConnection(username=self.user, password=self.pw, url=self.url)
@@ -0,0 +1,241 @@
+import os
+import unittest
+import tempfile
+import shutil
+import mock
+import numpy as np
+from distutils.spawn import find_executable
+from scilifelab.utils.fastq_utils import FastQParser, FastQBlockParser, FastQWriter, FastQWriterPool, QualityChunk, fastq_chunks, avgQ, gtQ30, select_codec, COMPRESS_PROGS
+
+records = [["@read1 1:N:0:1", "ACGT", "+", "IIII"],
+           ["@read2 1:N:0:1", "ACGTAC", "+", "#+5?II"],
+           ["@read3 1:N:0:1", "AC", "+", "?@"]]
+
+def _avgQ(record, offset=33):
+    return round(float(sum([ord(x) - offset for x in record[3]]))/len(record[3]), 1)
+
+def _gtQ30(record, offset=33):
+    return round(100.0*len([x for x in record[3] if ord(x) - offset >= 30])/len(record[3]), 1)
+
+class TestQualityChunk(unittest.TestCase):
+    def test_1_avgQ(self):
+        """Test average quality per record of a chunk"""
+        chunk = QualityChunk(records)
+        self.assertEqual(len(chunk), 3)
+        self.assertEqual(list(chunk.avgQ()), [_avgQ(r) for r in records])
+        self.assertEqual([avgQ(r) for r in records], [_avgQ(r) for r in records])
+        self.assertEqual(avgQ(["@r", "AC", "+", "?@"]), 30.5)
+
+    def test_2_gtQ30(self):
+        """Test percentage of bases >= Q30 per record of a chunk"""
+        chunk = QualityChunk(records)
+        self.assertEqual(list(chunk.gtQ30()), [_gtQ30(r) for r in records])
+        self.assertEqual([gtQ30(r) for r in records], [_gtQ30(r) for r in records])
+
+    def test_3_position_histogram(self):
+        """Test per position quality histogram of a chunk"""
+        hist = QualityChunk(records).position_histogram(max_qual=40)
+        self.assertEqual(hist.shape, (6, 41))
+        self.assertEqual(list(hist.sum(axis=1)), [3, 3, 2, 2, 1, 1])
+        self.assertEqual(hist[0, 40], 1)
+        self.assertEqual(hist[0, 2], 1)
+        self.assertEqual(hist[0, 30], 1)
+        self.assertEqual(hist[5, 40], 1)
+        self.assertEqual(list(QualityChunk(records).position_histogram(max_qual=30)[:, 30]), [2, 2, 1, 2, 1, 1])
+
+    def test_4_below_offset(self):
+        """Test quality characters below the phred offset"""
+        record = ["@r", "ACG", "+", "!#I"]
+        self.assertEqual(avgQ(record, offset=64), _avgQ(record, offset=64))
+        self.assertTrue(avgQ(record, offset=64) < 0)
+        self.assertEqual(gtQ30(record, offset=64), 0.0)
+        self.assertEqual(QualityChunk([record], offset=64).position_histogram(max_qual=40)[:, 0].sum(), 2)
+
+    def test_5_empty_records(self):
+        """Test records without bases"""
+        empty = ["@r", "", "+", ""]
+        chunk = QualityChunk([empty, records[0], empty, records[2], empty])
+        self.assertEqual(list(chunk.avgQ()), [0.0, _avgQ(records[0]), 0.0, _avgQ(records[2]), 0.0])
+        self.assertEqual(list(chunk.gtQ30()), [0.0, _gtQ30(records[0]), 0.0, _gtQ30(records[2]), 0.0])
+        self.assertEqual(list(chunk.position_histogram(max_qual=40).sum(axis=1)), [2, 2, 1, 1])
+        self.assertEqual(avgQ(empty), 0.0)
+
+class TestFastqChunks(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_fastq_utils_")
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_1_fastq_chunks(self):
+        """Test reading fastq records in chunks"""
+        fn = os.path.join(self.rootdir, "test.fastq.gz")
+        fh = FastQWriter(fn)
+        for i in range(5):
+            for r in records:
+                fh.write(r)
+        fh.close()
+        chunks = list(fastq_chunks(FastQParser(fn), size=4))
+        self.assertEqual([len(c) for c in chunks], [4, 4, 4, 3])
+        self.assertEqual(chunks[0][:3], records)
+        avgq = np.concatenate([QualityChunk(c).avgQ() for c in chunks])
+        self.assertEqual(list(avgq), [_avgQ(r) for r in records] * 5)
+
+class TestFastQBlockParser(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_fastq_utils_")
+        self.records = [["@read%d 1:N:0:%d" % (i, i % 3), "ACGT"*(i % 5 + 1), "+", "I#?@"*(i % 5 + 1)] for i in range(100)]
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def _write(self, fn, text=None):
+        if text is not None:
+            with open(fn, "w") as fh:
+                fh.write(text)
+            return fn
+        fh = FastQWriter(fn)
+        for r in self.records:
+            fh.write(r)
+        fh.close()
+        return fn
+
+    def test_1_parse(self):
+        """Test that block parser records equal those of FastQParser for plain and gzipped input"""
+        for fn in ["test.fastq", "test.fastq.gz"]:
+            fn = self._write(os.path.join(self.rootdir, fn))
+            for block_size in [7, 100, 4*1024*1024]:
+                fp = FastQBlockParser(fn, block_size=block_size)
+                records = list(fp)
+                self.assertEqual([r.tolist() for r in records], list(FastQParser(fn)))
+                self.assertEqual(records, self.records)
+                self.assertEqual(fp.rread(), len(self.records))
+
+    def test_2_record(self):
+        """Test record views"""
+        fn = self._write(os.path.join(self.rootdir, "test.fastq"), "@r1\nACGT\n+\nIIII\n@r2\r\nAC\r\n+\r\n##\r\n\n")
+        r1, r2 = list(FastQBlockParser(fn))
+        self.assertEqual(r1[0], "@r1")
+        self.assertEqual(r1[-1], "IIII")
+        self.assertEqual(r1[1:3], ["ACGT", "+"])
+        self.assertEqual(len(r1), 4)
+        header, seq, plus, qual = r2
+        self.assertEqual([header, seq, plus, qual], ["@r2", "AC", "+", "##"])
+        self.assertRaises(IndexError, r1.__getitem__, 4)
+        self.assertEqual(r1.raw(), "@r1\nACGT\n+\nIIII\n")
+
+    def test_3_ends(self):
+        """Test parsing files without final newline and with truncated records"""
+        fn = self._write(os.path.join(self.rootdir, "test.fastq"), "@r1\nACGT\n+\nIIII")
+        self.assertEqual(list(FastQBlockParser(fn)), [["@r1", "ACGT", "+", "IIII"]])
+        fn = self._write(os.path.join(self.rootdir, "test.fastq"), "@r1\nACGT\n+\nIIII\n@r2\nAC\n")
+        self.assertRaises(ValueError, list, FastQBlockParser(fn))
+        fn = self._write(os.path.join(self.rootdir, "test.fastq"), "")
+        self.assertEqual(list(FastQBlockParser(fn)), [])
+
+    def test_4_chunks_and_seek(self):
+        """Test reading chunks, mixing next and iteration, and seeking"""
+        fn = self._write(os.path.join(self.rootdir, "test.fastq.gz"))
+        fp = FastQBlockParser(fn, block_size=50)
+        self.assertEqual(fp.next(), self.records[0])
+        chunks = list(fastq_chunks(fp, size=30))
+        self.assertEqual([len(c) for c in chunks], [30, 30, 30, 9])
+        self.assertEqual(sum(chunks, []), self.records[1:])
+        fp.seek(0)
+        self.assertEqual(list(fp), self.records)
+
+    def test_5_write(self):
+        """Test writing record views"""
+        fn = self._write(os.path.join(self.rootdir, "test.fastq"))
+        out = os.path.join(self.rootdir, "out.fastq.gz")
+        fw = FastQWriter(out)
+        for r in FastQBlockParser(fn):
+            fw.write(r)
+        fw.close()
+        self.assertEqual(fw.rwritten(), len(self.records))
+        self.assertEqual(list(FastQParser(out)), self.records)
+
+class TestCodecs(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_fastq_utils_")
+        self.records = [["@read%d 1:N:0:1" % i, "ACGTN"*20, "+", "I#?@5"*20] for i in range(1000)]
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_1_select_codec(self):
+        """Test codec selection"""
+        self.assertIsNone(select_codec("test.fastq"))
+        self.assertEqual(select_codec("test.fastq.gz", "python"), "python")
+        with mock.patch("scilifelab.utils.fastq_utils.find_executable", return_value="/usr/bin/pigz"):
+            self.assertEqual(select_codec("test.fastq.gz"), "pigz")
+            self.assertEqual(select_codec("test.fastq.gz", "thread"), "thread")
+        with mock.patch("scilifelab.utils.fastq_utils.find_executable", return_value=None):
+            self.assertEqual(select_codec("test.fastq.bz2", "auto"), "thread")
+
+    def test_2_roundtrip(self):
+        """Test writing and reading compressed files with all available codecs"""
+        codecs = ["python", "thread"] + [c for c in ["gzip", "pigz", "bzip2", "pbzip2"] if find_executable(c)]
+        for suffix in [".gz", ".bz2"]:
+            for codec in codecs:
+                if codec not in ["python", "thread"] and codec not in COMPRESS_PROGS[suffix]:
+                    continue
+                fn = os.path.join(self.rootdir, "test_%s.fastq%s" % (codec, suffix))
+                fw = FastQWriter(fn, codec)
+                for r in self.records:
+                    fw.write(r)
+                fw.close()
+                for read_codec in codecs:
+                    if read_codec not in ["python", "thread"] and read_codec not in COMPRESS_PROGS[suffix]:
+                        continue
+                    self.assertEqual(list(FastQParser(fn, read_codec)), self.records)
+                    fp = FastQBlockParser(fn, block_size=1000, codec=read_codec)
+                    self.assertEqual(list(fp), self.records)
+                    fp.seek(0)
+                    self.assertEqual(fp.next(), self.records[0])
+                    fp.close()
+
+    def test_3_errors(self):
+        """Test that decompression errors are raised"""
+        fn = os.path.join(self.rootdir, "test.fastq.gz")
+        with open(fn, "w") as fh:
+            fh.write("not gzipped\n")
+        self.assertRaises(IOError, list, FastQParser(fn, "thread"))
+        self.assertRaises(IOError, list, FastQParser(fn, "gzip"))
+        self.assertRaises(IOError, FastQParser, fn, "nosuchprogram")
+
+class TestFastQWriterPool(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_fastq_utils_")
+        self.records = [["@read%d 1:N:0:%d" % (i, i % 5), "ACGT", "+", "IIII"] for i in range(200)]
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_1_write(self):
+        """Test buffered writing to more files than may be open at once"""
+        for suffix, codec in [("", None), (".gz", "python"), (".gz", "thread"), (".bz2", "bzip2")]:
+            if codec == "bzip2" and not find_executable(codec):
+                continue
+            pool = FastQWriterPool(codec=codec, buffer_size=100, max_open=2)
+            fn = lambda r: os.path.join(self.rootdir, "out_%s.fastq%s" % (r[0][-1], suffix))
+            for r in self.records:
+                pool.write(fn(r), r)
+                self.assertTrue(len(pool._handles) <= (5 if suffix == ".bz2" else 2))
+            pool.close()
+            self.assertEqual(pool.rwritten(), dict([(fn(r), 40) for r in self.records]))
+            for i in range(5):
+                records = list(FastQParser(os.path.join(self.rootdir, "out_%d.fastq%s" % (i, suffix)), codec))
+                self.assertEqual(records, [r for r in self.records if r[0].endswith(str(i))])
+
+    def test_2_write_bz2(self):
+        """Test that bzip2 outputs are kept open, so that they are readable by bz2.BZ2File"""
+        pool = FastQWriterPool(codec="python", buffer_size=100, max_open=2)
+        fn = lambda r: os.path.join(self.rootdir, "out_%s.fastq%s" % (r[0][-1], ".bz2" if r[0][-1] in "01" else ""))
+        for r in self.records:
+            pool.write(fn(r), r)
+        self.assertEqual(sorted([os.path.basename(x) for x in pool._handles.keys() if x.endswith(".bz2")]), ["out_0.fastq.bz2", "out_1.fastq.bz2"])
+        pool.close()
+        for i in range(5):
+            records = list(FastQParser(fn(["@read 1:N:0:%d" % i]), "python"))
+            self.assertEqual(records, [r for r in self.records if r[0].endswith(str(i))])
@@ -0,0 +1,64 @@
+import os
+import time
+import unittest
+import tempfile
+import shutil
+from scilifelab.utils.manifest import FileManifest, fingerprint, md5sum
+
+class TestFileManifest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "manifest", "fc.json")
+        self.files = [os.path.join(self.tmpdir, x) for x in ["a.txt", "b.txt"]]
+        for f in self.files:
+            with open(f, "w") as fh:
+                fh.write(os.path.basename(f))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _touch(self, f, content=None):
+        """Rewrite a file with a modification time in the future"""
+        if content is not None:
+            with open(f, "w") as fh:
+                fh.write(content)
+        t = time.time() + 10
+        os.utime(f, (t, t))
+
+    def test_1_changed(self):
+        """Test that new groups and modified files are changed"""
+        m = FileManifest(self.path)
+        self.assertTrue(m.changed("sample", self.files))
+        m.commit()
+        self.assertFalse(m.changed("sample", self.files))
+        self.assertTrue(m.changed("sample", self.files[0:1]))
+        self._touch(self.files[0])
+        self.assertTrue(m.changed("sample", self.files))
+
+    def test_2_commit(self):
+        """Test that only committed groups are saved"""
+        m = FileManifest(self.path)
+        m.changed("sample1", self.files[0:1])
+        m.changed("sample2", self.files[1:])
+        m.commit(["sample1"])
+        m.save()
+        m = FileManifest(self.path)
+        self.assertEqual(m.groups.keys(), ["sample1"])
+        self.assertFalse(m.changed("sample1", self.files[0:1]))
+        self.assertTrue(m.changed("sample2", self.files[1:]))
+        m.discard(["sample2"])
+        m.commit()
+        self.assertEqual(m.groups.keys(), ["sample1"])
+
+    def test_3_content_hash(self):
+        """Test that touched but unmodified files are unchanged with content_hash"""
+        m = FileManifest(self.path, content_hash=True)
+        m.changed("sample", self.files)
+        m.commit()
+        self.assertEqual(m.groups["sample"][self.files[0]]["md5"], md5sum(self.files[0]))
+        self._touch(self.files[0])
+        self.assertFalse(m.changed("sample", self.files))
+        m.commit()
+        self.assertEqual(m.groups["sample"][self.files[0]]["mtime_ns"], fingerprint(self.files[0])["mtime_ns"])
+        self._touch(self.files[0], "modified")
+        self.assertTrue(m.changed("sample", self.files))
@@ -0,0 +1,73 @@
+import os
+import time
+import unittest
+import tempfile
+import shutil
+from mock import patch
+import scilifelab.utils.yaml_io as yaml_io
+from scilifelab.utils.yaml_io import YamlCache, load, dump
+
+class TestYamlCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "cache", "yaml_cache.pickle")
+        self.runinfo = os.path.join(self.tmpdir, "run_info.yaml")
+        with open(self.runinfo, "w") as fh:
+            fh.write(dump([{"lane":"1", "multiplex":[{"barcode_id":1, "name":"P1_101F_index1"}]}]))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_1_load_dump(self):
+        """Test loading and dumping yaml"""
+        self.assertEqual(load(dump({"fc_name":"AA001AAAXX", "details":[]})), {"fc_name":"AA001AAAXX", "details":[]})
+
+    def test_2_cache(self):
+        """Test that unchanged files are not parsed again"""
+        cache = YamlCache(self.path)
+        data = cache.load(self.runinfo)
+        self.assertEqual(data[0]["multiplex"][0]["name"], "P1_101F_index1")
+        data[0]["lane"] = "2"
+        cache.save()
+        self.assertTrue(os.path.exists(self.path))
+        cache = YamlCache(self.path)
+        with patch("scilifelab.utils.yaml_io.load") as mock_load:
+            self.assertEqual(cache.load(self.runinfo)[0]["lane"], "1")
+            self.assertFalse(mock_load.called)
+
+    def test_3_modified(self):
+        """Test that modified files are parsed again"""
+        cache = YamlCache(self.path)
+        cache.load(self.runinfo)
+        with open(self.runinfo, "w") as fh:
+            fh.write(dump([{"lane":"3", "multiplex":[]}]))
+        t = time.time() + 10
+        os.utime(self.runinfo, (t, t))
+        self.assertEqual(cache.load(self.runinfo)[0]["lane"], "3")
+
+    def test_4_max_entries(self):
+        """Test that least recently used entries are dropped from a full cache"""
+        runinfo = [self.runinfo]
+        for i in range(2):
+            runinfo.append(os.path.join(self.tmpdir, "run_info_{}.yaml".format(i)))
+            shutil.copy(self.runinfo, runinfo[-1])
+        cache = YamlCache(self.path, max_entries=2)
+        cache.load(runinfo[0])
+        cache.load(runinfo[1])
+        cache.load(runinfo[0])
+        cache.load(runinfo[2])
+        self.assertEqual(list(cache.entries.keys()), [runinfo[0], runinfo[2]])
+        cache.save()
+        self.assertEqual(len(YamlCache(self.path, max_entries=1).entries), 1)
+
+    def test_5_shared_cache(self):
+        """Test that the shared cache is kept in memory unless a cache file is given"""
+        with patch.dict(os.environ, clear=False):
+            os.environ.pop("PM_YAML_CACHE", None)
+            with patch.object(yaml_io, "_CACHE", None), patch("atexit.register") as register:
+                self.assertIsNone(yaml_io.get_cache().path)
+                self.assertFalse(register.called)
+            os.environ["PM_YAML_CACHE"] = self.path
+            with patch.object(yaml_io, "_CACHE", None), patch("atexit.register") as register:
+                self.assertEqual(yaml_io.get_cache().path, self.path)
+                register.assert_called_once_with(yaml_io._CACHE.save)